@@ -18,9 +18,29 @@ from typing import List, Dict, Any, Optional
 import tempfile
 import os
 import shutil
+import codecs
+import csv
+import re
 import matplotlib.pyplot as plt
 import seaborn as sns
 import base64
+import hashlib
+import json
+import functools
+from collections import OrderedDict
+import threading
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import openpyxl
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import datasift_export
+
+# Copy-on-write: projeções e fatias dividem memória com a tabela base até alguém escrever nelas.
+pd.set_option("mode.copy_on_write", True)
 
 # --- PAGE CONFIGURATION & THEME ---
 st.set_page_config(
@@ -203,7 +223,7 @@ To proceed, you must confirm that the data to be used has been properly handled
 
 MANUAL_CONTENT = {
     "Introduction": """**Welcome to Data Sift!**\n\nThis program is a spreadsheet filter tool designed to optimize your work with large volumes of data by offering two main functionalities:\n\n1.  **Filtering:** To clean your database by removing rows that are not of interest.\n2.  **Stratification:** To divide your database into specific subgroups.""",
-    "1. Global Settings": """**1. Global Settings**\n\nThis section contains the essential settings that are shared between both tools.\n\n- **Select Spreadsheet:**\n  Opens a window to select the source data file. It supports `.xlsx`, `.xls`, and `.csv` formats.\n\n- **Age Column / Sex/Gender / Data Column:**\n  Fields to **select** the column names in your spreadsheet. The **Data Column** is specifically used to automatically run the stratification study and generate charts.\n\n- **Output Format:**\n  A selection menu to choose the format of the generated files. Choose `Excel (.xlsx)` for Microsoft Excel or `CSV (.csv)` for a lighter format.""",
+    "1. Global Settings": """**1. Global Settings**\n\nThis section contains the essential settings that are shared between both tools.\n\n- **Select Spreadsheet:**\n  Opens a window to select the source data file. It supports `.xlsx`, `.xls`, `.csv`, `.parquet` and `.zip` formats.\n\n- **Lean load:**\n  Reads the header first and loads only the columns the current configuration uses (plus any extra columns, which can be saved as a profile). Tick *Full-width output* to export every column.\n\n- **Out-of-core mode:**\n  For CSV/Parquet files larger than memory. Filtering runs straight from disk and always exports CSV; analysis and stratification are disabled.\n\n- **Age Column / Sex/Gender / Data Column:**\n  Fields to **select** the column names in your spreadsheet. The **Data Column** is specifically used to automatically run the stratification study and generate charts.\n\n- **Output Format:**\n  A selection menu to choose the format of the generated files. Choose `Excel (.xlsx)` for Microsoft Excel or `CSV (.csv)` for a lighter format.""",
     "2. Filter Tool": """**2. Filter Tool**\n\nThe purpose of this tool is to **"clean"** your spreadsheet by **removing** rows that match specific criteria. The result is a **single file** containing only the data that "survived" the filters.\n\n**How Exclusion Rules Work:**\nEach row you add is a condition to **remove** data. If a row in your spreadsheet matches an active rule, it **will be excluded** from the final file.\n\n- **[✓] (Activation Checkbox):** Toggles a rule on or off without deleting it.\n\n- **Column:** The name of the column where the filter will be applied.\n\n- **Operator and Value:** Operators define the rule's logic to set exclusion ranges.\n\n- **Compound Logic:** Expands the rule to create `AND` / `OR` conditions.\n\n- **Condition:** Allows applying a secondary filter based on sex and/or age conditions.\n\n- **Actions:** The `X` button deletes the rule. The 'Clone' button duplicates it.""",
     "3. Stratification Tool": """**3. Stratification Tool**\n\nThis tool splits your spreadsheet into **multiple smaller files**, where each file represents a subgroup of interest.\n\n**Statistical and Practical approaches & Charts:**\nAutomatically evaluates the selected Data Column and Age Column to suggest the most relevant age cuts. If Reference Limits are provided, Haeckel's formula is executed.\n\n**How Stratification Works:**\n- **Stratification Options by Sex/Gender:** Select the genders you want to include.\n- **Age Range Definitions:** Create the specific age boundaries.\n- **Generate Stratified Sheets:** Starts the splitting process."""
 }
@@ -242,29 +262,106 @@ DEFAULT_FILTERS = [
 def get_data_processor():
     return DataProcessor()
 
+class Predicate:
+    """
+    Nó da árvore em que as regras de filtro são compiladas. Os valores digitados viram
+    parâmetros (?) do DuckDB em vez de texto no SQL, e ramos constantes são dobrados na
+    construção: um AND com FALSE (ex.: coluna ausente) vira FALSE e some de um OR.
+    """
+    __slots__ = ('kind', 'args')
+    SQL_OPS = ('=', '!=', '<', '>', '<=', '>=')
+
+    def __init__(self, kind: str, *args):
+        self.kind, self.args = kind, args
+
+    @classmethod
+    def all_of(cls, nodes) -> 'Predicate':
+        kept = []
+        for node in nodes:
+            if node is cls.FALSE: return cls.FALSE
+            if node is not cls.TRUE: kept.append(node)
+        if not kept: return cls.TRUE
+        return kept[0] if len(kept) == 1 else cls('AND', *kept)
+
+    @classmethod
+    def any_of(cls, nodes) -> 'Predicate':
+        kept = []
+        for node in nodes:
+            if node is cls.TRUE: return cls.TRUE
+            if node is not cls.FALSE: kept.append(node)
+        if not kept: return cls.FALSE
+        return kept[0] if len(kept) == 1 else cls('OR', *kept)
+
+    def to_sql(self, params: list) -> str:
+        """SQL do nó; os valores são acrescentados a `params` na ordem dos '?'."""
+        kind, args = self.kind, self.args
+        if kind == 'const': return "TRUE" if args[0] else "FALSE"
+        if kind in ('AND', 'OR'): return "(" + f" {kind} ".join(node.to_sql(params) for node in args) + ")"
+        if kind == 'num':
+            expr, op, value = args
+            params.append(value)
+            return f"({expr} IS NOT NULL AND {expr} {op} ?)"
+        if kind == 'between':
+            expr, low, high = args
+            params.extend([low, high])
+            return f"({expr} IS NOT NULL AND {expr} BETWEEN ? AND ?)"
+        if kind == 'text':
+            col, op, value = args
+            params.append(value)
+            return f"(CAST({col} AS VARCHAR) IS NOT NULL AND LOWER(TRIM(CAST({col} AS VARCHAR))) {op} ?)"
+        if kind == 'empty':
+            col, is_empty = args
+            if is_empty: return f"({col} IS NULL OR TRIM(CAST({col} AS VARCHAR)) = '')"
+            return f"({col} IS NOT NULL AND TRIM(CAST({col} AS VARCHAR)) != '')"
+        raise ValueError(f"Unknown predicate node: {kind}")
+
+    def compile(self):
+        """(sql, params) prontos para con.execute()."""
+        params = []
+        return self.to_sql(params), params
+
+Predicate.TRUE = Predicate('const', True)
+Predicate.FALSE = Predicate('const', False)
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def _popcount(packed: np.ndarray) -> int:
+    """Bits set in a np.packbits bitmap (the padding bits are always 0)."""
+    return int(_POPCOUNT[packed].sum(dtype=np.int64))
+
 class DataProcessor:
     OPERATOR_MAP = {'=': '=', '==': '=', 'Is not equal to': '!=', '≥': '>=', '≤': '<=', 'is equal to': '=', 'Not equal to': '!='}
+    MAX_CACHED_PLANS = 512
+
+    def __init__(self):
+        # Planos compilados por hash do conjunto de regras + esquema da planilha. O processor
+        # é um cache_resource compartilhado entre usuários, daí o lock.
+        self._plans = OrderedDict()
+        self._plans_lock = threading.Lock()
 
-    def _build_single_sql_cond(self, col: str, op: str, val: Any) -> str:
-        if not op: return "FALSE"
+    def _build_single_cond(self, col: str, op: str, val: Any, num_col: Optional[str] = None) -> Predicate:
+        """
+        `num_col` is the column's pre-parsed numeric form (see DatasetSession.numeric_expr);
+        without it the value is parsed inline from text.
+        """
         op = self.OPERATOR_MAP.get(op, op)
+        if op not in Predicate.SQL_OPS: return Predicate.FALSE
         if str(val).lower() == 'empty':
-            if op in ('=', '=='): return f"({col} IS NULL OR TRIM(CAST({col} AS VARCHAR)) = '')"
-            if op == '!=': return f"({col} IS NOT NULL AND TRIM(CAST({col} AS VARCHAR)) != '')"
-            return "FALSE"
+            if op == '=': return Predicate('empty', col, True)
+            if op == '!=': return Predicate('empty', col, False)
+            return Predicate.FALSE
         try:
             v_num = float(str(val).replace(',', '.'))
-            safe_cast = f"TRY_CAST(REPLACE(CAST({col} AS VARCHAR), ',', '.') AS DOUBLE)"
-            return f"({safe_cast} IS NOT NULL AND {safe_cast} {op} {v_num})"
+            if num_col == DatasetSession.NO_NUMERIC: return Predicate.FALSE
+            safe_cast = num_col or f"TRY_CAST(REPLACE(CAST({col} AS VARCHAR), ',', '.') AS DOUBLE)"
+            return Predicate('num', safe_cast, op, v_num)
         except ValueError:
-            v_str = str(val).replace("'", "''").lower().strip()
-            return f"(CAST({col} AS VARCHAR) IS NOT NULL AND LOWER(TRIM(CAST({col} AS VARCHAR))) {op} '{v_str}')"
+            return Predicate('text', col, op, str(val).lower().strip())
 
-    def _create_main_sql(self, f: Dict, col: str) -> str:
+    def _create_main_predicate(self, f: Dict, safe_col: str, num_col: Optional[str] = None) -> Predicate:
         op1, val1 = f.get('p_op1'), f.get('p_val1')
-        safe_col = f'"{col}"'
         if not f.get('p_expand'):
-            return self._build_single_sql_cond(safe_col, op1, val1)
+            return self._build_single_cond(safe_col, op1, val1, num_col)
         op_central = f.get('p_op_central', '').upper()
         op2, val2 = f.get('p_op2'), f.get('p_val2')
         if op_central == 'BETWEEN':
@@ -272,156 +369,237 @@ class DataProcessor:
                 v1_num = float(str(val1).replace(',', '.'))
                 v2_num = float(str(val2).replace(',', '.'))
                 min_v, max_v = sorted([v1_num, v2_num])
-                safe_cast = f"TRY_CAST(REPLACE(CAST({safe_col} AS VARCHAR), ',', '.') AS DOUBLE)"
-                return f"({safe_cast} IS NOT NULL AND {safe_cast} BETWEEN {min_v} AND {max_v})"
-            except ValueError: return "FALSE"
-        cond1 = self._build_single_sql_cond(safe_col, op1, val1)
-        cond2 = self._build_single_sql_cond(safe_col, op2, val2)
-        return f"({cond1} {op_central} {cond2})"
-
-    def _create_conditional_sql(self, f: Dict, global_config: Dict) -> str:
-        if not f.get('c_check'): return "TRUE"
+                if num_col == DatasetSession.NO_NUMERIC: return Predicate.FALSE
+                safe_cast = num_col or f"TRY_CAST(REPLACE(CAST({safe_col} AS VARCHAR), ',', '.') AS DOUBLE)"
+                return Predicate('between', safe_cast, min_v, max_v)
+            except ValueError: return Predicate.FALSE
+        cond1 = self._build_single_cond(safe_col, op1, val1, num_col)
+        cond2 = self._build_single_cond(safe_col, op2, val2, num_col)
+        return Predicate.all_of([cond1, cond2]) if op_central == 'AND' else Predicate.any_of([cond1, cond2])
+
+    def _create_conditional_predicate(self, f: Dict, global_config: Dict, session: 'DatasetSession') -> Predicate:
+        if not f.get('c_check'): return Predicate.TRUE
         conds = []
         col_idade = global_config.get('coluna_idade')
         if f.get('c_idade_check') and col_idade:
-            safe_idade = f'"{col_idade}"'
+            safe_idade, num_idade = session.quote(col_idade), session.numeric_expr(col_idade)
             op1, val1 = f.get('c_idade_op1'), f.get('c_idade_val1')
-            if op1 and val1: conds.append(self._build_single_sql_cond(safe_idade, op1, val1))
+            if op1 and val1: conds.append(self._build_single_cond(safe_idade, op1, val1, num_idade))
             op2, val2 = f.get('c_idade_op2'), f.get('c_idade_val2')
-            if op2 and val2: conds.append(self._build_single_sql_cond(safe_idade, op2, val2))
+            if op2 and val2: conds.append(self._build_single_cond(safe_idade, op2, val2, num_idade))
         col_sexo = global_config.get('coluna_sexo')
         if f.get('c_sexo_check') and col_sexo:
             val_sexo = f.get('c_sexo_val')
             if val_sexo:
-                safe_sexo = f'"{col_sexo}"'
-                conds.append(self._build_single_sql_cond(safe_sexo, '=', val_sexo))
-        return " AND ".join(conds) if conds else "TRUE"
+                safe_sexo = session.quote(col_sexo)
+                conds.append(self._build_single_cond(safe_sexo, '=', val_sexo, session.numeric_expr(col_sexo)))
+        return Predicate.all_of(conds)
 
-    def apply_filters(self, df_input: pd.DataFrame, filters_config: List[Dict], global_config: Dict, progress_bar) -> pd.DataFrame:
+    def apply_filters(self, session: 'DatasetSession', filters_config: List[Dict], global_config: Dict, progress_bar) -> np.ndarray:
+        """Returns the positions of the rows that survive every active rule."""
         start_time = time.perf_counter()
         active_filters = [f for f in filters_config if f['p_check']]
         
         if not active_filters:
             end_time = time.perf_counter()
             progress_bar.progress(1.0, text=f"No active filter rules. (Time: {end_time - start_time:.4f}s)")
-            return df_input
-
-        exclusion_clauses = []
-        for i, f_config in enumerate(active_filters):
-            progress_bar.progress((i + 1) / len(active_filters), text=f"Mapping SQL rule {i+1}...")
-            col_config_str = f_config.get('p_col', '')
-            cols_to_check = [c.strip() for c in col_config_str.split(';') if c.strip()]
-            if not cols_to_check: continue
-
-            main_conds = []
-            for sub_col in cols_to_check:
-                if sub_col in df_input.columns:
-                    main_conds.append(self._create_main_sql(f_config, sub_col))
-                else:
-                    main_conds.append("FALSE")
+            return session.all_rows()
 
-            combined_main_sql = " AND ".join([f"({c})" for c in main_conds]) if main_conds else "FALSE"
-            cond_sql = self._create_conditional_sql(f_config, global_config)
-            rule_sql = f"({combined_main_sql}) AND ({cond_sql})"
-            exclusion_clauses.append(f"NOT ({rule_sql})")
+        # Each rule's exclusion set is cached as a bitmap keyed by the rule definition,
+        # so a rerun only evaluates the rules that changed since the last click.
+        rule_sqls, rule_labels = self._compile_rules(session, active_filters, global_config, progress_bar)
 
-        if not exclusion_clauses:
+        if not rule_sqls:
             end_time = time.perf_counter()
             progress_bar.progress(1.0, text=f"Processing complete! (Time: {end_time - start_time:.4f}s)")
-            return df_input
-
-        where_clause = " AND ".join(exclusion_clauses)
-        local_df = df_input.copy()
-        local_df['_temp_row_id'] = range(len(local_df))
-        
-        con = duckdb.connect()
-        con.register('local_df', local_df)
-        query = f"SELECT _temp_row_id FROM local_df WHERE {where_clause}"
+            return session.all_rows()
 
         try:
-            progress_bar.progress(0.8, text="Executing DuckDB Engine (SQL)...")
-            valid_ids_df = con.execute(query).df()
-            filtered_df = local_df[local_df['_temp_row_id'].isin(valid_ids_df['_temp_row_id'])].copy()
-            filtered_df.drop(columns=['_temp_row_id'], inplace=True)
-            con.close()
+            n_changed = sum(1 for key in rule_sqls if not session.has_exclusion_bitmap(key))
+            progress_bar.progress(0.8, text=f"Executing DuckDB Engine (SQL): {n_changed} new or changed rule(s), {len(rule_sqls) - n_changed} cached...")
+            bitmaps = session.exclusion_bitmaps(rule_sqls)
+            excluded = np.bitwise_or.reduce(list(bitmaps.values()))
+            keep_mask = np.unpackbits(~excluded, count=session.n_rows).astype(bool)
+            kept_rows = np.flatnonzero(keep_mask)
+            st.session_state.filter_attribution = self._exclusion_attribution(rule_labels, bitmaps, session.n_rows)
             
             end_time = time.perf_counter()
             tempo_execucao = end_time - start_time
             progress_bar.progress(1.0, text=f"Filtering complete! Processing time: {tempo_execucao:.4f} seconds.")
-            return filtered_df
+            return kept_rows
         except Exception as e:
-            con.close()
             st.session_state.filter_error = f"SQL Processing Error: {e}"
-            return df_input
-    
-    def apply_stratification(self, df_input: pd.DataFrame, strata_config: Dict, global_config: Dict, progress_bar) -> Dict[str, pd.DataFrame]:
+            return session.all_rows()
+
+    def export_filtered(self, session: 'FileDatasetSession', filters_config: List[Dict], global_config: Dict, progress_bar) -> Optional[int]:
+        """
+        Out-of-core filtering: DuckDB streams the source file through the rules' WHERE clause
+        and writes the survivors to `session.output_path`. Returns the number of rows written.
+        """
+        start_time = time.perf_counter()
+        active_filters = [f for f in filters_config if f['p_check']]
+        rule_sqls, _ = self._compile_rules(session, active_filters, global_config, progress_bar)
+        # NULL counts as excluded, as in the in-memory engine.
+        where_sql = " AND ".join(f"NOT COALESCE({sql}, TRUE)" for sql, _ in rule_sqls.values()) or "TRUE"
+        params = [v for _, rule_params in rule_sqls.values() for v in rule_params]
+        try:
+            progress_bar.progress(0.8, text="Streaming the file through DuckDB (out-of-core)...")
+            n_written = session.copy_where(where_sql, params)
+            end_time = time.perf_counter()
+            progress_bar.progress(1.0, text=f"Filtering complete! Processing time: {end_time - start_time:.4f} seconds.")
+            return n_written
+        except Exception as e:
+            st.session_state.filter_error = f"SQL Processing Error: {e}"
+            return None
+
+    def _compile_rules(self, session: 'DatasetSession', active_filters: List[Dict], global_config: Dict, progress_bar):
+        """
+        Returns ({rule_key: (sql, params)}, [(rule description, rule_key)]) for the active rules.
+        The compiled plan is cached by rule-set hash, so identical configurations on the same
+        column layout (any rerun, any user) skip compilation.
+        """
+        definitions = [{k: v for k, v in f.items() if k != 'id'} for f in active_filters]
+        plan_key = hashlib.sha1(json.dumps([session.schema_fingerprint, definitions, global_config], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        with self._plans_lock:
+            plan = self._plans.get(plan_key)
+            if plan is not None: self._plans.move_to_end(plan_key)
+
+        if plan is None:
+            plan = []
+            for i, f_config in enumerate(active_filters):
+                progress_bar.progress((i + 1) / len(active_filters), text=f"Compiling rule {i+1}...")
+                col_config_str = f_config.get('p_col', '')
+                cols_to_check = [c.strip() for c in col_config_str.split(';') if c.strip()]
+                if not cols_to_check:
+                    plan.append(None)
+                    continue
+                main_pred = Predicate.all_of([
+                    self._create_main_predicate(f_config, session.quote(sub_col), session.numeric_expr(sub_col))
+                    if session.has_column(sub_col) else Predicate.FALSE
+                    for sub_col in cols_to_check
+                ])
+                rule_pred = Predicate.all_of([main_pred, self._create_conditional_predicate(f_config, global_config, session)])
+                plan.append(rule_pred.compile())
+            with self._plans_lock:
+                self._plans[plan_key] = plan
+                while len(self._plans) > self.MAX_CACHED_PLANS: self._plans.popitem(last=False)
+        else:
+            progress_bar.progress(0.5, text="Reusing compiled rule plan...")
+
+        rule_sqls, rule_labels = {}, []
+        for f_config, compiled in zip(active_filters, plan):
+            if compiled is None: continue
+            key = session.rule_key(f_config, global_config)
+            rule_sqls[key] = compiled
+            rule_labels.append((self._describe_rule(f_config), key))
+        return rule_sqls, rule_labels
+
+    def _describe_rule(self, f: Dict) -> str:
+        desc = f"{f.get('p_col', '')} {f.get('p_op1', '')} {f.get('p_val1', '')}"
+        if f.get('p_expand'):
+            desc += f" {f.get('p_op_central', '')} {f.get('p_op2', '')} {f.get('p_val2', '')}"
+        return desc + (" (conditional)" if f.get('c_check') else "")
+
+    def _exclusion_attribution(self, rule_labels: List[tuple], bitmaps: Dict[str, np.ndarray], n_rows: int) -> pd.DataFrame:
+        """
+        Per-rule audit table: rows each rule excludes on its own, rows only it excludes,
+        and rows it shares with another rule. Computed on the packed cached bitmaps, one per
+        rule position (identical rules share a cached bitmap but still overlap each other):
+        `once`/`twice` accumulate rows hit by at least one / two rules, and counts are popcounts.
+        """
+        once = np.zeros_like(next(iter(bitmaps.values())))
+        twice = np.zeros_like(once)
+        for _, key in rule_labels:
+            twice |= once & bitmaps[key]
+            once |= bitmaps[key]
+
+        report = []
+        for label, key in rule_labels:
+            total = _popcount(bitmaps[key])
+            unique = _popcount(bitmaps[key] & ~twice)
+            report.append({'Rule': label, 'Excluded (total)': total, 'Excluded (only this rule)': unique,
+                           'Shared with other rules': total - unique,
+                           '% of rows': round(100 * total / n_rows, 2) if n_rows else 0.0})
+        excluded = _popcount(once)
+        report.append({'Rule': 'All active rules', 'Excluded (total)': excluded, 'Excluded (only this rule)': None,
+                       'Shared with other rules': None, '% of rows': round(100 * excluded / n_rows, 2) if n_rows else 0.0})
+        return pd.DataFrame(report)
+
+    def apply_stratification(self, session: 'DatasetSession', strata_config: Dict, global_config: Dict, progress_bar, rows: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """
+        Splits the dataset (or only `rows` of it, e.g. the last filtered result) into strata.
+        Each stratum is returned as an int32 array of row positions in `session.df`;
+        frames are only built when a stratum is exported (see StrataExport).
+        """
         col_idade = global_config.get('coluna_idade')
         col_sexo = global_config.get('coluna_sexo')
 
         age_strata = strata_config.get('ages', [])
         sex_strata = strata_config.get('sexes', [])
 
-        if age_strata and not (col_idade and col_idade in df_input.columns):
+        if age_strata and not (col_idade and session.has_column(col_idade)):
             st.session_state.stratification_error = f"Age column '{col_idade}' not found or not mapped in Global Settings."
             return {}
-        if sex_strata and not (col_sexo and col_sexo in df_input.columns):
+        if sex_strata and not (col_sexo and session.has_column(col_sexo)):
             st.session_state.stratification_error = f"Sex/Gender column '{col_sexo}' not found or not mapped in Global Settings."
             return {}
 
-        safe_idade = f'"{col_idade}"' if col_idade else ""
-        safe_sexo = f'"{col_sexo}"' if col_sexo else ""
-
-        final_strata_to_process = []
-        if not age_strata and sex_strata:
-            for sex_rule in sex_strata: final_strata_to_process.append({'age': None, 'sex': sex_rule})
-        elif age_strata and not sex_strata:
-            for age_rule in age_strata: final_strata_to_process.append({'age': age_rule, 'sex': None})
-        else:
-            for sex_rule in sex_strata:
-                for age_rule in age_strata:
-                    final_strata_to_process.append({'age': age_rule, 'sex': sex_rule})
+        safe_idade = session.quote(col_idade) if col_idade else ""
+        safe_sexo = session.quote(col_sexo) if col_sexo else ""
+        num_idade = session.numeric_expr(col_idade) if col_idade else None
+        num_sexo = session.numeric_expr(col_sexo) if col_sexo else None
 
-        total_files = len(final_strata_to_process)
-        generated_dfs = {}
+        if not age_strata and not sex_strata:
+            progress_bar.progress(1.0, text="Stratification complete!")
+            return {}
 
-        local_df = df_input.copy()
-        local_df['_temp_row_id'] = range(len(local_df))
-        
-        con = duckdb.connect()
-        con.register('local_df', local_df)
-
-        for i, stratum in enumerate(final_strata_to_process):
-            progress = (i + 1) / total_files
-            conditions = []
-            age_rule = stratum.get('age')
-            if age_rule:
-                if age_rule.get('op1') and age_rule.get('val1'):
-                    conditions.append(self._build_single_sql_cond(safe_idade, age_rule['op1'], age_rule['val1']))
-                if age_rule.get('op2') and age_rule.get('val2'):
-                    conditions.append(self._build_single_sql_cond(safe_idade, age_rule['op2'], age_rule['val2']))
-
-            sex_rule = stratum.get('sex')
+        # One query marks, for every row, which age rules and which sex rules it matches;
+        # strata are (sex, age) pairs in the same order the old per-stratum loop used.
+        age_list = age_strata or [None]
+        sex_list = sex_strata or [None]
+        age_preds, sex_preds = [], []
+        for age_rule in age_list:
+            conds = []
+            if age_rule and age_rule.get('op1') and age_rule.get('val1'):
+                conds.append(self._build_single_cond(safe_idade, age_rule['op1'], age_rule['val1'], num_idade))
+            if age_rule and age_rule.get('op2') and age_rule.get('val2'):
+                conds.append(self._build_single_cond(safe_idade, age_rule['op2'], age_rule['val2'], num_idade))
+            age_preds.append(Predicate.all_of(conds))
+        for sex_rule in sex_list:
             if sex_rule and sex_rule.get('value'):
-                conditions.append(self._build_single_sql_cond(safe_sexo, '=', sex_rule['value']))
+                sex_preds.append(self._build_single_cond(safe_sexo, '=', sex_rule['value'], num_sexo))
+            else:
+                sex_preds.append(Predicate.TRUE)
 
-            where_clause = " AND ".join([f"({c})" for c in conditions]) if conditions else "TRUE"
-            query = f"SELECT _temp_row_id FROM local_df WHERE {where_clause}"
+        progress_bar.progress(0.1, text=f"Labelling rows for {len(age_list) * len(sex_list)} strata in one pass...")
+        try:
+            age_member, sex_member, row_pos = session.rule_membership(age_preds, sex_preds, rows=rows)
+        except Exception as e:
+            st.session_state.stratification_error = f"SQL error while generating strata: {e}"
+            return {}
+
+        # Row -> stratum membership list (a row may fall in several strata when age
+        # rules overlap), then a single stable argsort splits it into strata.
+        member = age_member[:, None, :] & sex_member[:, :, None]  # rows x sex x age
+        row_idx, sex_idx, age_idx = np.nonzero(member)
+        stratum_ids = sex_idx * len(age_list) + age_idx
+        order = np.argsort(stratum_ids, kind='stable')
+        bounds = np.searchsorted(stratum_ids[order], np.arange(len(age_list) * len(sex_list) + 1))
+        members_sorted = row_pos[row_idx[order]]
+
+        total_files = len(age_list) * len(sex_list)
+        generated_strata = {}
+        for k, sex_rule in enumerate(sex_list):
+            for a, age_rule in enumerate(age_list):
+                j = k * len(age_list) + a
+                filename = self._generate_stratum_name(age_rule, sex_rule)
+                progress_bar.progress(0.1 + 0.9 * (j + 1) / total_files, text=f"Generating stratum {j+1}/{total_files}: {filename}...")
+                stratum_rows = members_sorted[bounds[j]:bounds[j + 1]]
+                if len(stratum_rows):
+                    generated_strata[filename] = stratum_rows.astype(np.int32)
 
-            filename = self._generate_stratum_name(age_rule, sex_rule)
-            progress_bar.progress(progress, text=f"Generating stratum {i+1}/{total_files}: {filename}...")
-            
-            try:
-                valid_ids_df = con.execute(query).df()
-                if not valid_ids_df.empty:
-                    stratum_df = local_df[local_df['_temp_row_id'].isin(valid_ids_df['_temp_row_id'])].copy()
-                    stratum_df.drop(columns=['_temp_row_id'], inplace=True)
-                    generated_dfs[filename] = stratum_df
-            except Exception as e:
-                st.session_state.stratification_error = f"SQL error while generating {filename}: {e}"
-
-        con.close()
         progress_bar.progress(1.0, text="Stratification complete!")
-        return generated_dfs
+        return generated_strata
 
     def _generate_stratum_name(self, age_rule: Optional[Dict], sex_rule: Optional[Dict]) -> str:
         name_parts = []
@@ -462,88 +640,1056 @@ class DataProcessor:
         final_name = "_".join(part for part in name_parts if part)
         return final_name if final_name else "Group_All"
 
+class DatasetSession:
+    """
+    Conexão DuckDB dona de UMA planilha carregada. É criada uma única vez por
+    upload (uploaded_file.file_id) e guardada em st.session_state: os dados são
+    copiados uma só vez para uma tabela tipada e todo clique seguinte (filtro,
+    estratificação, validações de idade/sexo, agregados do Harris-Boyd) consulta
+    essa tabela, sem novo register() nem cópia do DataFrame.
+
+    Linhas são identificadas pela posição no DataFrame original (rowid da tabela),
+    então resultados derivados circulam como arrays de posições.
+
+    Na carga, cada coluna de texto é convertida UMA vez para uma coluna-sombra
+    DOUBLE ("12,5" -> 12.5); as regras comparam direto contra ela. Colunas de
+    texto sem nenhum valor numérico não ganham sombra, e as falhas de conversão
+    por coluna ficam em `parse_report`.
+
+    O conjunto de linhas excluídas por cada regra de filtro fica em cache como
+    bitmap; ao religar/desligar uma regra só as regras alteradas são reavaliadas.
+    """
+    TABLE = "dataset"
+    MAX_CACHED_BITMAPS = 256
+    MAX_CACHED_CUBES = 4  # uma análise usa até 3 (cada sexo e o total)
+    NO_NUMERIC = "NULL"  # numeric_expr() de colunas sem nenhum valor numérico
+    _NUMERIC_TYPES = ('TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT', 'UTINYINT',
+                      'USMALLINT', 'UINTEGER', 'UBIGINT', 'FLOAT', 'DOUBLE', 'DECIMAL')
+
+    def __init__(self, df: pd.DataFrame, dataset_id: str):
+        self.dataset_id = dataset_id
+        self.df = df
+        self.n_rows = len(df)
+        self._bitmaps = OrderedDict()
+        self._lab_values = {}
+        self._ages = {}
+        self._cubes = OrderedDict()
+        self.con = duckdb.connect()
+        self.con.register('_upload', df)
+        # DuckDB renomeia colunas que só diferem por maiúsculas ('a' -> 'a_1'),
+        # então o nome SQL de cada coluna é mapeado pela posição.
+        schema = self.con.execute("DESCRIBE SELECT * FROM _upload").fetchall()
+        self._sql_names = dict(zip(df.columns, [row[0] for row in schema]))
+        self._numeric_exprs = self._load_with_shadows(df, [row[1] for row in schema])
+        self.con.unregister('_upload')
+        self.schema_fingerprint = self._fingerprint_schema()
+
+    def _load_with_shadows(self, df: pd.DataFrame, sql_types: List[str]) -> Dict[str, str]:
+        """Cria a tabela com as colunas-sombra numéricas e devolve {coluna: expressão numérica}."""
+        numeric_exprs, shadows = {}, {}
+        for i, (col, sql_type) in enumerate(zip(df.columns, sql_types)):
+            if sql_type.startswith(self._NUMERIC_TYPES):
+                numeric_exprs[col] = self.quote(col)
+            elif sql_type == 'VARCHAR' or sql_type.startswith('ENUM'):
+                shadows[col] = f'"__datasift_num_{i}"'
+            else:
+                numeric_exprs[col] = self.NO_NUMERIC
+
+        shadow_sql = "".join(
+            f", TRY_CAST(REPLACE(CAST({self.quote(col)} AS VARCHAR), ',', '.') AS DOUBLE) AS {shadow}"
+            for col, shadow in shadows.items()
+        )
+        self.con.execute(f"CREATE TABLE {self.TABLE} AS SELECT *{shadow_sql} FROM _upload")
+
+        self.parse_report = pd.DataFrame(columns=['Column', 'Numeric values', 'Unparsed values'])
+        if not shadows: return numeric_exprs
+
+        counts_sql = ", ".join(
+            f"count({self.quote(col)}) FILTER (WHERE TRIM(CAST({self.quote(col)} AS VARCHAR)) <> ''), count({shadow})"
+            for col, shadow in shadows.items()
+        )
+        counts = self.con.execute(f"SELECT {counts_sql} FROM {self.TABLE}").fetchone()
+        report = []
+        for j, (col, shadow) in enumerate(shadows.items()):
+            filled, parsed = counts[2 * j], counts[2 * j + 1]
+            if parsed:
+                numeric_exprs[col] = shadow
+                report.append({'Column': col, 'Numeric values': parsed, 'Unparsed values': filled - parsed})
+            else:
+                numeric_exprs[col] = self.NO_NUMERIC
+                self.con.execute(f"ALTER TABLE {self.TABLE} DROP COLUMN {shadow}")
+        self.parse_report = pd.DataFrame(report, columns=self.parse_report.columns)
+        return numeric_exprs
+
+    def _fingerprint_schema(self) -> str:
+        """Hash de {coluna: (nome SQL, expressão numérica)}; planos de regra compilados valem para qualquer planilha com o mesmo hash."""
+        layout = [(col, self._sql_names[col], self._numeric_exprs.get(col)) for col in self._sql_names]
+        return hashlib.sha1(json.dumps(layout, default=str).encode('utf-8')).hexdigest()
+
+    @property
+    def columns(self) -> list:
+        return list(self._sql_names)
+
+    def has_column(self, col: str) -> bool:
+        return col in self._sql_names
+
+    def view(self, rows: Optional[np.ndarray] = None) -> 'DatasetView':
+        return DatasetView(self.df, rows)
+
+    def lab_values(self, col: str) -> np.ndarray:
+        """parse_lab_values da coluna inteira, calculado uma vez por planilha e reaproveitado por toda análise."""
+        if col not in self._lab_values: self._lab_values[col] = parse_lab_values(self.df[col]).to_numpy()
+        return self._lab_values[col]
+
+    def age_cube(self, age_col: str, data_col: str, rows: Optional[np.ndarray] = None) -> 'AgeStatsCube':
+        """AgeStatsCube das `rows` (None = todas), montado uma vez por seleção e compartilhado por gráfico e tabelas."""
+        rows_hash = 'all' if rows is None else hashlib.sha1(np.ascontiguousarray(rows, dtype=np.int64).tobytes()).hexdigest()
+        key = f"{self.dataset_id}|{self.schema_fingerprint}|{age_col}|{data_col}|{rows_hash}"
+        if key in self._cubes:
+            self._cubes.move_to_end(key)
+            return self._cubes[key]
+        if age_col not in self._ages:
+            self._ages[age_col] = pd.to_numeric(self.df[age_col], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        ages, values = self._ages[age_col], self.lab_values(data_col)
+        if rows is not None: ages, values = ages[rows], values[rows]
+        cube = self._cubes[key] = AgeStatsCube(ages, values, key)
+        while len(self._cubes) > self.MAX_CACHED_CUBES: self._cubes.popitem(last=False)
+        return cube
+
+    def engine_memory_bytes(self) -> int:
+        """Memória em uso pelo DuckDB desta sessão (tabela tipada, colunas-sombra, buffers)."""
+        try: return int(self.con.execute("SELECT sum(memory_usage_bytes) FROM duckdb_memory()").fetchone()[0] or 0)
+        except duckdb.Error: return 0
+
+    def quote(self, col: str) -> str:
+        name = self._sql_names.get(col, col)
+        return '"' + str(name).replace('"', '""') + '"'
+
+    def numeric_expr(self, col: str) -> str:
+        """Expressão SQL com o valor numérico (DOUBLE) de `col`, já normalizado na carga."""
+        return self._numeric_exprs.get(col, self.NO_NUMERIC)
+
+    def rule_key(self, rule: Dict, global_config: Dict) -> str:
+        """Chave do bitmap de uma regra: definição da regra (sem o id) + colunas globais + planilha."""
+        definition = {k: v for k, v in rule.items() if k != 'id'}
+        payload = json.dumps([self.dataset_id, definition, global_config], sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def has_exclusion_bitmap(self, key: str) -> bool:
+        return key in self._bitmaps
+
+    def exclusion_bitmaps(self, rule_sqls: Dict[str, tuple]) -> Dict[str, np.ndarray]:
+        """
+        Bitmap (np.packbits, 1 bit por linha) das linhas que cada regra exclui.
+        Só as regras ainda sem bitmap em cache são avaliadas, todas numa única
+        varredura; NULL conta como excluído, igual a um WHERE NOT (...).
+        """
+        missing = [key for key in rule_sqls if key not in self._bitmaps]
+        if missing:
+            select_sql = ", ".join(f"COALESCE({rule_sqls[key][0]}, TRUE) AS r{j}" for j, key in enumerate(missing))
+            params = [v for key in missing for v in rule_sqls[key][1]]
+            res = self.con.execute(f"SELECT {select_sql} FROM {self.TABLE}", params).fetchnumpy()
+            for j, key in enumerate(missing):
+                self._bitmaps[key] = np.packbits(np.asarray(res[f"r{j}"], dtype=bool))
+        for key in rule_sqls: self._bitmaps.move_to_end(key)
+        while len(self._bitmaps) > self.MAX_CACHED_BITMAPS: self._bitmaps.popitem(last=False)
+        return {key: self._bitmaps[key] for key in rule_sqls}
+
+    def all_rows(self) -> np.ndarray:
+        return np.arange(self.n_rows)
+
+    def rows_where(self, where_sql: str, params: Optional[list] = None) -> np.ndarray:
+        """Posições (ordenadas) das linhas em que `where_sql` é verdadeiro."""
+        res = self.con.execute(f"SELECT rowid FROM {self.TABLE} WHERE {where_sql}", params or []).fetchnumpy()
+        return np.sort(np.asarray(res['rowid'], dtype=np.int64))
+
+    def rule_membership(self, *pred_groups, rows: Optional[np.ndarray] = None):
+        """
+        Avalia todas as listas de predicados numa única varredura. Para cada lista devolve uma
+        matriz booleana (linhas x predicados; NULL = fora), e por último as posições das linhas,
+        em ordem crescente, restritas a `rows` se informado.
+        """
+        exprs, params = [], []
+        for g, preds in enumerate(pred_groups):
+            for j, pred in enumerate(preds):
+                exprs.append(f"COALESCE({pred.to_sql(params)}, FALSE) AS g{g}_{j}")
+        res = self.con.execute(
+            f"SELECT rowid, {', '.join(exprs)} FROM {self.TABLE} WHERE {self._in_rows(rows)} ORDER BY rowid", params
+        ).fetchnumpy()
+        matrices = [
+            np.column_stack([np.asarray(res[f"g{g}_{j}"], dtype=bool) for j in range(len(preds))])
+            for g, preds in enumerate(pred_groups)
+        ]
+        return (*matrices, np.asarray(res['rowid'], dtype=np.int64))
+
+    def _in_rows(self, rows: Optional[np.ndarray]) -> str:
+        """Cláusula SQL que restringe a consulta às posições em `rows` (None = todas)."""
+        if rows is None: return "TRUE"
+        self.con.register('_rows', pd.DataFrame({'pos': np.asarray(rows, dtype=np.int64)}))
+        return "rowid IN (SELECT pos FROM _rows)"
+
+    def rows_with_value(self, col: str, value: Any, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """Linhas cujo valor de `col`, como texto, é igual a str(value)."""
+        return self.rows_where(f"CAST({self.quote(col)} AS VARCHAR) = ? AND {self._in_rows(rows)}", [str(value)])
+
+    def distinct_values(self, col: str, limit: int) -> list:
+        """Valores não nulos de `col` na ordem em que aparecem (no máximo `limit`)."""
+        q = self.quote(col)
+        res = self.con.execute(
+            f"SELECT {q} FROM {self.TABLE} WHERE {q} IS NOT NULL GROUP BY {q} ORDER BY min(rowid) LIMIT {int(limit)}"
+        ).fetchall()
+        return [r[0] for r in res]
+
+    def non_numeric_ratio(self, col: str) -> float:
+        """Fração dos valores não nulos de `col` que não são numéricos."""
+        q = self.quote(col)
+        total, numeric = self.con.execute(
+            f"SELECT count({q}), count(TRY_CAST({q} AS DOUBLE)) FROM {self.TABLE}"
+        ).fetchone()
+        return (total - numeric) / total if total else 0.0
+
+    def numeric_range(self, col: str, rows: Optional[np.ndarray] = None):
+        """(mín, máx) dos valores numéricos de `col`, opcionalmente só nas `rows` informadas."""
+        q = self.quote(col)
+        return self.con.execute(
+            f"SELECT min(TRY_CAST({q} AS DOUBLE)), max(TRY_CAST({q} AS DOUBLE)) FROM {self.TABLE} WHERE {self._in_rows(rows)}"
+        ).fetchone()
+
+    def close(self):
+        try: self.con.close()
+        except Exception: pass
+
+class DatasetView:
+    """
+    Seleção de linhas sobre a tabela base da sessão. Guarda só as posições (int32, ou None para
+    todas); `frame(columns)` projeta as colunas pedidas e materializa as linhas na hora, então
+    resultado filtrado, subgrupos por sexo e estratos não duplicam a planilha no session_state.
+    """
+    __slots__ = ('base', 'rows')
+
+    def __init__(self, base: pd.DataFrame, rows: Optional[np.ndarray] = None):
+        self.base, self.rows = base, rows
+
+    def __len__(self) -> int:
+        return len(self.base) if self.rows is None else len(self.rows)
+
+    def frame(self, columns: Optional[List[str]] = None, parsed: Optional[Dict[str, np.ndarray]] = None) -> pd.DataFrame:
+        """`parsed` troca colunas pelos arrays já convertidos (do tamanho da base), antes de selecionar as linhas."""
+        df = self.base if columns is None else self.base[[c for c in dict.fromkeys(columns) if c]]
+        if parsed: df = df.assign(**parsed)
+        return df if self.rows is None else df.take(self.rows)
+
+class FileDatasetSession(DatasetSession):
+    """
+    Modo out-of-core: a planilha NÃO é carregada no pandas. O upload é gravado uma vez
+    em disco (CSV transcodificado para UTF-8, que é o que o read_csv do DuckDB aceita)
+    e `dataset` vira uma VIEW sobre read_csv/read_parquet. Cada filtro é uma única
+    consulta em streaming gravada num arquivo temporário, servido no download.
+
+    CSV é lido com all_varchar, então os valores saem no arquivo exatamente como
+    vieram; as regras usam a mesma conversão numérica inline de antes das colunas-sombra.
+    Não há rowid nem bitmaps de regra: cada execução relê o arquivo. As regras chegam
+    com parâmetros (?), então o resultado é lido em lotes Arrow e escrito pelo CSVWriter
+    do PyArrow em vez de um COPY.
+    """
+    SUPPORTED = ('.csv', '.parquet')
+    BATCH_ROWS = 100_000
+    _CHUNK = 1 << 20
+
+    def __init__(self, uploaded_file, dataset_id: str):
+        self.dataset_id = dataset_id
+        self.df = None
+        self.n_rows = None
+        self.parse_report = pd.DataFrame(columns=['Column', 'Numeric values', 'Unparsed values'])
+        self._bitmaps = OrderedDict()
+        self._memo = {}
+        ext = os.path.splitext(uploaded_file.name.lower())[1]
+        self.source_path = self._spool(uploaded_file, ext)
+        self.output_path = tempfile.NamedTemporaryFile(delete=False, suffix='.csv').name
+        self.con = duckdb.connect()
+        self.con.execute(f"SET temp_directory = {self.literal(tempfile.gettempdir())}")
+        if ext == '.parquet':
+            reader = f"read_parquet({self.literal(self.source_path)})"
+        else:
+            reader = f"read_csv({self.literal(self.source_path)}, header = true, all_varchar = true)"
+        self.con.execute(f"CREATE VIEW {self.TABLE} AS SELECT * FROM {reader}")
+        schema = self.con.execute(f"DESCRIBE SELECT * FROM {self.TABLE}").fetchall()
+        self._sql_names = {row[0]: row[0] for row in schema}
+        self._numeric_exprs = {}
+        for col, sql_type in ((row[0], row[1]) for row in schema):
+            if sql_type.startswith(self._NUMERIC_TYPES):
+                self._numeric_exprs[col] = self.quote(col)
+            elif sql_type == 'VARCHAR':
+                self._numeric_exprs[col] = f"TRY_CAST(REPLACE(CAST({self.quote(col)} AS VARCHAR), ',', '.') AS DOUBLE)"
+            else:
+                self._numeric_exprs[col] = self.NO_NUMERIC
+        self.schema_fingerprint = self._fingerprint_schema()
+
+    @staticmethod
+    def literal(text: str) -> str:
+        """Literal SQL de texto: SET e CREATE VIEW não aceitam parâmetros (?), então a aspa é escapada."""
+        return "'" + str(text).replace("'", "''") + "'"
+
+    def _spool(self, uploaded_file, ext: str) -> str:
+        """Grava o upload em disco em blocos; CSV em latin-1 é convertido para UTF-8 no caminho."""
+        path = tempfile.NamedTemporaryFile(delete=False, suffix=ext).name
+        for encoding in (('utf-8', 'latin-1') if ext == '.csv' else (None,)):
+            uploaded_file.seek(0)
+            try:
+                with open(path, 'wb') as out:
+                    if encoding is None:
+                        shutil.copyfileobj(uploaded_file, out, self._CHUNK)
+                        break
+                    decoder = codecs.getincrementaldecoder(encoding)()
+                    while chunk := uploaded_file.read(self._CHUNK):
+                        out.write(decoder.decode(chunk).encode('utf-8'))
+                    out.write(decoder.decode(b'', final=True).encode('utf-8'))
+                break
+            except UnicodeDecodeError:
+                continue
+        return path
+
+    def copy_where(self, where_sql: str, params: Optional[list] = None) -> int:
+        """
+        Grava as linhas que satisfazem `where_sql` em `output_path` e devolve o nº de linhas.
+        O resultado chega em lotes Arrow e é escrito lote a lote, sem materializar a tabela,
+        no mesmo formato do export em memória (frame_to_csv_bytes): UTF-8 com BOM, ';' e
+        vírgula decimal nas colunas de ponto flutuante.
+        """
+        reader = self.con.execute(f"SELECT * FROM {self.TABLE} WHERE {where_sql}", params or []).fetch_record_batch(self.BATCH_ROWS)
+        decimal_cols = [i for i, field in enumerate(reader.schema)
+                        if pa.types.is_floating(field.type) or pa.types.is_decimal(field.type)]
+        schema = reader.schema
+        for i in decimal_cols: schema = schema.set(i, schema.field(i).with_type(pa.string()))
+        n_rows = 0
+        with open(self.output_path, 'wb') as out:
+            out.write(codecs.BOM_UTF8)
+            with pa_csv.CSVWriter(out, schema, write_options=pa_csv.WriteOptions(delimiter=';')) as writer:
+                for batch in reader:
+                    columns = batch.columns
+                    for i in decimal_cols: columns[i] = pc.replace_substring(columns[i].cast(pa.string()), '.', ',')
+                    writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+                    n_rows += batch.num_rows
+        return n_rows
+
+    def _memoized(self, key, compute):
+        # Cada consulta é uma varredura do arquivo; os reruns do Streamlit reaproveitam o resultado.
+        if key not in self._memo: self._memo[key] = compute()
+        return self._memo[key]
+
+    def distinct_values(self, col: str, limit: int) -> list:
+        q = self.quote(col)
+        return self._memoized(('distinct', col, limit), lambda: [r[0] for r in self.con.execute(
+            f"SELECT DISTINCT {q} FROM {self.TABLE} WHERE {q} IS NOT NULL LIMIT {int(limit)}").fetchall()])
+
+    def non_numeric_ratio(self, col: str) -> float:
+        return self._memoized(('non_numeric', col), lambda: super(FileDatasetSession, self).non_numeric_ratio(col))
+
+    def close(self):
+        super().close()
+        for path in (self.source_path, self.output_path):
+            try: os.remove(path)
+            except OSError: pass
+
 # --- CACHED UTILITY FUNCTIONS ---
 
-@st.cache_data(show_spinner="Reading file...")
-def _read_csv_engine(path, sep, decimal, encoding):
+def _parse_csv(source, sep, decimal, encoding, engine='pyarrow', usecols=None):
     """
     Lê CSV com PyArrow (rápido). Se o PyArrow falhar — por exemplo em linhas/campos
     muito grandes, que geram 'straddling object straddles two block boundaries' —,
     refaz a leitura com o parser C padrão do pandas, que não tem essa limitação de
     blocos. Colunas, valores e dtypes resultantes são equivalentes aos do PyArrow.
+    Quando a amostra já mostra linhas enormes, sniff_csv_dialect pede o parser C direto.
+    `source` é um caminho ou um buffer em memória (bytes/memoryview); o buffer é lido por um
+    pa.BufferReader novo a cada tentativa, sem cópia.
     """
+    def src(): return pa.BufferReader(source) if isinstance(source, (bytes, memoryview)) else source
+    if engine == 'pyarrow':
+        try:
+            df = pd.read_csv(src(), sep=sep, decimal=decimal, encoding=encoding, engine='pyarrow', usecols=usecols)
+            # Coluna em bytes = UTF-8 inválido depois da amostra do sniff; o parser C levanta o erro abaixo.
+            if not _has_binary_columns(df): return df
+        except Exception:
+            pass
     try:
-        return pd.read_csv(path, sep=sep, decimal=decimal, encoding=encoding, engine='pyarrow')
-    except Exception:
-        return pd.read_csv(path, sep=sep, decimal=decimal, encoding=encoding, engine='c', low_memory=False)
+        return pd.read_csv(src(), sep=sep, decimal=decimal, encoding=encoding, engine='c', low_memory=False, usecols=usecols)
+    except UnicodeDecodeError:
+        if encoding == FALLBACK_CSV_ENCODING: raise
+        return _parse_csv(source, sep, decimal, FALLBACK_CSV_ENCODING, engine, usecols)
+
+def _has_binary_columns(df: pd.DataFrame) -> bool:
+    """O PyArrow devolve bytes (e não texto) nas colunas que não decodificam no encoding pedido."""
+    for col in df.columns[df.dtypes == object]:
+        first = df[col].first_valid_index()
+        if first is not None and isinstance(df[col].at[first], bytes): return True
+    return False
         
-def load_dataframe(uploaded_file):
+CSV_SAMPLE_BYTES = 256 * 1024
+# O sniff só vê a amostra: se um byte fora do UTF-8 aparece depois dela, a leitura recomeça neste encoding.
+FALLBACK_CSV_ENCODING = 'latin-1'
+_COMMA_DECIMAL = re.compile(r'^-?\d+,\d+$')
+_DOT_DECIMAL = re.compile(r'^-?\d+\.\d+$')
+
+def sniff_csv_dialect(raw: bytes) -> Dict[str, Any]:
+    """
+    Decide separador, marca decimal e encoding olhando só os primeiros CSV_SAMPLE_BYTES do
+    arquivo (`raw`), e valida o palpite parseando a amostra; um palpite errado custa reler a
+    amostra, não o arquivo inteiro. `engine` é 'c' quando há linhas grandes demais para os
+    blocos do PyArrow.
+    """
+    raw = raw[:CSV_SAMPLE_BYTES]
+    complete = raw if len(raw) < CSV_SAMPLE_BYTES else raw[:raw.rfind(b'\n') + 1] or raw
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(complete, final=False)
+        encoding = 'utf-8'
+    except UnicodeDecodeError:
+        encoding = 'latin-1'
+    text = complete.decode(encoding, errors='replace').lstrip('\ufeff')
+    lines = [line for line in text.splitlines() if line.strip()][:200]
+
+    candidates = []
+    try: candidates.append(csv.Sniffer().sniff("\n".join(lines[:50]), delimiters=';,\t|').delimiter)
+    except csv.Error: pass
+    # Separador cuja contagem por linha é a mais estável (e maior que zero) na amostra.
+    def consistency(sep):
+        counts = [line.count(sep) for line in lines[:100]]
+        return (min(counts) > 0 and len(set(counts)) == 1, float(np.median(counts)) if counts else 0.0)
+    candidates += sorted([';', ',', '\t', '|'], key=consistency, reverse=True)
+
+    sep = ','
+    for candidate in dict.fromkeys(candidates):
+        try:
+            sample_df = pd.read_csv(io.StringIO("\n".join(lines)), sep=candidate, dtype=str, engine='c')
+        except Exception: continue
+        if sample_df.shape[1] > 1 or candidate == candidates[-1]:
+            sep = candidate
+            break
+
+    decimal = '.'
+    if sep != ',':
+        fields = [field.strip().strip('"') for line in lines[1:] for field in line.split(sep)]
+        if sum(1 for v in fields if _COMMA_DECIMAL.match(v)) > sum(1 for v in fields if _DOT_DECIMAL.match(v)):
+            decimal = ','
+    engine = 'c' if lines and max(len(line) for line in lines) > CSV_SAMPLE_BYTES // 2 else 'pyarrow'
+    return {'sep': sep, 'decimal': decimal, 'encoding': encoding, 'engine': engine}
+
+CSV_BLOCK_BYTES = 16 << 20
+CSV_CHUNK_ROWS = 200_000
+MEMORY_BUDGET_MB = float(os.environ.get("DATASIFT_MEMORY_BUDGET_MB", "4096"))
+MAX_ROWS = int(os.environ.get("DATASIFT_MAX_ROWS", "0"))  # 0 = sem limite
+
+class MemoryBudgetExceeded(Exception):
+    """A tabela em memória passaria do orçamento; `projected_bytes` é a estimativa feita durante a leitura."""
+    def __init__(self, projected_bytes: float, budget_bytes: float):
+        super().__init__(f"estimated {projected_bytes / 2**20:,.0f} MB in memory (budget {budget_bytes / 2**20:,.0f} MB)")
+        self.projected_bytes = projected_bytes
+
+def _arrow_csv_chunks(source: memoryview, dialect: Dict[str, Any], usecols: Optional[tuple]):
+    """Blocos pandas via pyarrow.csv.open_csv; None se o cabeçalho tem nomes repetidos (o pandas renomeia, o Arrow não)."""
+    reader = pa_csv.open_csv(
+        pa.BufferReader(source),
+        read_options=pa_csv.ReadOptions(encoding=dialect['encoding'], block_size=CSV_BLOCK_BYTES),
+        parse_options=pa_csv.ParseOptions(delimiter=dialect['sep']),
+        convert_options=pa_csv.ConvertOptions(include_columns=list(usecols) if usecols is not None else None,
+                                              decimal_point=dialect['decimal'], strings_can_be_null=True),
+    )
+    if len(set(reader.schema.names)) != len(reader.schema.names): return None
+    if any(pa.types.is_binary(field.type) for field in reader.schema):
+        raise UnicodeDecodeError(dialect['encoding'], b'', 0, 1, "column with bytes outside the encoding")
+    return (batch.to_pandas() for batch in reader)
+
+def _pandas_csv_chunks(source: memoryview, dialect: Dict[str, Any], usecols: Optional[tuple]):
+    return pd.read_csv(pa.BufferReader(source), sep=dialect['sep'], decimal=dialect['decimal'], encoding=dialect['encoding'],
+                       engine='c', low_memory=False, usecols=usecols, chunksize=CSV_CHUNK_ROWS)
+
+def read_csv_chunked(source: memoryview, dialect: Dict[str, Any], usecols: Optional[tuple] = None, on_progress=None,
+                     max_rows: int = MAX_ROWS, budget_bytes: float = MEMORY_BUDGET_MB * 2**20) -> pd.DataFrame:
+    """
+    Lê o CSV em blocos (PyArrow em streaming; parser C do pandas em `chunksize` quando o sniff pede
+    o parser C ou quando um bloco posterior contradiz os tipos inferidos no primeiro).
+    `on_progress(rows, bytes_read, total_bytes)` a cada bloco. Para em `max_rows` linhas (0 = sem
+    limite). Os bytes lidos são estimados pelo tamanho médio de linha da amostra (os leitores leem
+    o buffer em memória adiantado, então a posição do stream não serve). Depois de cada bloco a
+    memória da tabela final é projetada para o total estimado de linhas; se a projeção passar de
+    `budget_bytes`, levanta MemoryBudgetExceeded antes de ler o resto.
+    Se aparecer um byte inválido no encoding do sniff (depois da amostra), a leitura recomeça em
+    FALLBACK_CSV_ENCODING e `dialect['encoding']` é atualizado.
+    """
+    try:
+        return _read_csv_chunks_once(source, dialect, usecols, on_progress, max_rows, budget_bytes)
+    except UnicodeDecodeError:
+        if dialect['encoding'] == FALLBACK_CSV_ENCODING: raise
+        dialect['encoding'] = FALLBACK_CSV_ENCODING
+        return _read_csv_chunks_once(source, dialect, usecols, on_progress, max_rows, budget_bytes)
+
+def _read_csv_chunks_once(source: memoryview, dialect: Dict[str, Any], usecols: Optional[tuple], on_progress,
+                          max_rows: int, budget_bytes: float) -> pd.DataFrame:
+    total_bytes = len(source)
+    sample = bytes(source[:CSV_SAMPLE_BYTES])
+    row_bytes = len(sample) / max(sample.count(b'\n'), 1)
+    expected_rows = max(total_bytes / row_bytes, 1.0)
+    if max_rows: expected_rows = min(expected_rows, max_rows)
+    def consume(chunks):
+        parts, rows, mem = [], 0, 0
+        for chunk in chunks:
+            capped = bool(max_rows) and rows + len(chunk) >= max_rows
+            if capped: chunk = chunk.iloc[:max_rows - rows]
+            parts.append(chunk)
+            rows += len(chunk)
+            mem += int(chunk.memory_usage(index=False, deep=True).sum())
+            projected = mem if capped else mem * max(expected_rows / max(rows, 1), 1.0)
+            if budget_bytes and projected > budget_bytes: raise MemoryBudgetExceeded(projected, budget_bytes)
+            if on_progress: on_progress(rows, total_bytes if capped else min(int(rows * row_bytes), total_bytes), total_bytes)
+            if capped: break
+        if on_progress and parts: on_progress(rows, total_bytes, total_bytes)
+        return pd.concat(parts, ignore_index=True) if parts else None
+
+    if dialect['engine'] == 'pyarrow':
+        try:
+            chunks = _arrow_csv_chunks(source, dialect, usecols)
+            if chunks is not None:
+                df = consume(chunks)
+                if df is not None: return df
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            pass
+    df = consume(_pandas_csv_chunks(source, dialect, usecols))
+    return df if df is not None else _parse_csv(source, dialect['sep'], dialect['decimal'], dialect['encoding'], 'c', usecols)
+
+def _csv_progress_reporter(file_label: str):
+    """Barra de progresso com linhas e bytes lidos (mesmo contrato de _excel_progress_reporter)."""
+    bar = st.progress(0.0, text=f"Reading {file_label}...")
+    def report(rows, bytes_read, total_bytes):
+        bar.progress(min(bytes_read / total_bytes, 1.0) if total_bytes else 0.0,
+                     text=f"Reading {file_label}: {rows:,} rows · ~{bytes_read / 2**20:,.1f} of {total_bytes / 2**20:,.1f} MB")
+    return report, bar.empty
+
+def read_csv_sniffed(source: memoryview, label: str, usecols: Optional[tuple] = None) -> pd.DataFrame:
+    """`source` é a visão (memoryview) dos bytes do upload; nada é copiado para disco."""
+    dialect = sniff_csv_dialect(bytes(source[:CSV_SAMPLE_BYTES]))
+    report, clear = _csv_progress_reporter(label)
+    try: return read_csv_chunked(source, dialect, usecols, on_progress=report)
+    finally:
+        clear()
+        st.session_state.csv_dialect = {'file': label, **dialect}  # encoding pode ter mudado na leitura
+
+ZIP_SOURCE_COLUMN = "Source File"
+
+def _read_zip_member(z: zipfile.ZipFile, member: str, usecols: Optional[tuple]):
+    """Lê um membro direto do arquivo ZIP (sem extrair para disco). Roda em threads: nada de st.* aqui."""
+    data = z.read(member)
+    if member.lower().endswith('.csv'):
+        dialect = sniff_csv_dialect(data[:CSV_SAMPLE_BYTES])
+        return _parse_csv(data, dialect['sep'], dialect['decimal'], dialect['encoding'], dialect['engine'], usecols), dialect
+    return read_excel_streaming(io.BytesIO(data), usecols=usecols), None
+
+def read_zip_members(z: zipfile.ZipFile, members: List[str], usecols: Optional[tuple] = None) -> pd.DataFrame:
+    """
+    Lê TODOS os membros válidos em paralelo (threads: a descompressão do zlib e o parser
+    do PyArrow liberam o GIL) e concatena na ordem do arquivo. Com mais de um membro, a
+    coluna ZIP_SOURCE_COLUMN diz de qual arquivo veio cada linha.
+    """
+    with ThreadPoolExecutor(max_workers=min(len(members), os.cpu_count() or 1)) as pool:
+        results = list(pool.map(lambda m: _read_zip_member(z, m, usecols), members))
+    dialects = [d for _, d in results if d is not None]
+    if dialects:
+        label = members[0] if len(members) == 1 else f"{members[0]} (+{len(members) - 1} files)"
+        st.session_state.csv_dialect = {'file': label, **dialects[0]}
+    if len(results) == 1: return results[0][0]
+    frames = [frame.assign(**{ZIP_SOURCE_COLUMN: os.path.basename(member)}) for (frame, _), member in zip(results, members)]
+    return pd.concat(frames, ignore_index=True)
+
+def read_upload_header(uploaded_file) -> Optional[List[str]]:
+    """
+    Só os nomes das colunas, sem ler a tabela: amostra do CSV, esquema do Parquet ou primeira
+    linha do xlsx. None para formatos sem leitura de cabeçalho (ZIP), que são lidos inteiros.
+    """
+    file_name = uploaded_file.name.lower()
+    try:
+        uploaded_file.seek(0)
+        if file_name.endswith('.csv'):
+            raw = uploaded_file.read(CSV_SAMPLE_BYTES)
+            dialect = sniff_csv_dialect(raw)
+            header = pd.read_csv(io.BytesIO(raw), sep=dialect['sep'], encoding=dialect['encoding'], nrows=0).columns
+            return [str(c) for c in header]
+        if file_name.endswith('.parquet'):
+            return list(pq.read_schema(uploaded_file).names)
+        if file_name.endswith(('.xlsx', '.xls')):
+            wb = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+            try: raw_header = next(wb.worksheets[0].iter_rows(max_row=1, values_only=True), None)
+            finally: wb.close()
+            return _excel_header(raw_header) if raw_header else None
+        return None
+    except Exception:
+        return None
+    finally:
+        uploaded_file.seek(0)
+
+def _excel_header(raw_header) -> List[str]:
+    """Nomes de coluna como o pd.read_excel gera: vazias viram 'Unnamed: i', repetidas ganham '.1', '.2'..."""
+    names, seen = [], {}
+    for i, value in enumerate(raw_header):
+        name = f"Unnamed: {i}" if value is None or str(value).strip() == "" else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else: seen[name] = 0
+        names.append(name)
+    return names
+
+# Textos que o pd.read_excel trata como ausentes por padrão (na_values); o openpyxl os entrega como str.
+EXCEL_NA_STRINGS = frozenset(['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                              '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'])
+
+def _rows_to_arrow(rows: list, names: List[str]) -> pa.Table:
+    """Um bloco de linhas (tuplas do openpyxl) vira uma tabela Arrow tipada; colunas com tipos mistos viram texto."""
+    columns = []
+    for j in range(len(names)):
+        values = [row[j] for row in rows]
+        try: columns.append(pa.array(values, from_pandas=True))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            columns.append(pa.array([None if v is None else str(v) for v in values], type=pa.string()))
+    return pa.Table.from_arrays(columns, names=names)
+
+def _concat_arrow_chunks(chunks: List[pa.Table]) -> pa.Table:
+    try: return pa.concat_tables(chunks, promote_options="permissive")
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Uma coluna mudou de tipo entre blocos (ex.: números e depois texto): passa a ser texto.
+        def as_text(column):
+            return pa.array([None if v is None else str(v) for v in column.to_pylist()], type=pa.string())
+        names = chunks[0].column_names
+        mixed = [j for j, n in enumerate(names) if len({c.schema.field(j).type for c in chunks} - {pa.null()}) > 1]
+        for j in mixed:
+            chunks = [c.set_column(j, names[j], as_text(c.column(j))) for c in chunks]
+        return pa.concat_tables(chunks, promote_options="permissive")
+
+def read_excel_streaming(source, chunk_rows: int = 50_000, on_progress=None, usecols: Optional[tuple] = None) -> pd.DataFrame:
+    """
+    Lê a primeira planilha com o openpyxl em modo read-only (iter_rows(values_only=True)),
+    sem criar objetos de célula, montando blocos Arrow tipados de `chunk_rows` linhas.
+    `on_progress(rows_read, total_rows, header, first_chunk)` é chamado a cada bloco;
+    o cabeçalho e o primeiro bloco chegam antes de a planilha inteira ser lida.
+    Com `usecols` só essas colunas viram Arrow (a linha ainda é lida inteira pelo openpyxl).
+    """
+    wb = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        total_rows = max((ws.max_row or 1) - 1, 0) or None
+        rows_iter = ws.iter_rows(values_only=True)
+        raw_header = next(rows_iter, None)
+        if raw_header is None: return pd.DataFrame()
+        all_names = _excel_header(raw_header)
+        width = len(all_names)
+        keep = [j for j, n in enumerate(all_names) if usecols is None or n in usecols]
+        names = [all_names[j] for j in keep]
+
+        chunks, buffer, pending_blank, rows_read = [], [], [], 0
+        for row in rows_iter:
+            row = tuple(row[:width]) + (None,) * (width - len(row))
+            # A linha vazia é decidida na linha inteira, para a leitura projetada ter as mesmas linhas da completa.
+            blank = all(v is None or v == '' for v in row)
+            row = tuple(None if v.__class__ is str and v in EXCEL_NA_STRINGS else v for v in row)
+            if usecols is not None: row = tuple(row[j] for j in keep)
+            if blank:
+                pending_blank.append(row)  # linhas vazias no fim da planilha são descartadas
+                continue
+            buffer.extend(pending_blank)
+            pending_blank = []
+            buffer.append(row)
+            if len(buffer) >= chunk_rows:
+                chunks.append(_rows_to_arrow(buffer, names))
+                rows_read += len(buffer)
+                buffer = []
+                if on_progress: on_progress(rows_read, total_rows, names, chunks[0])
+        if buffer or not chunks:
+            chunks.append(_rows_to_arrow(buffer, names))
+            rows_read += len(buffer)
+            if on_progress: on_progress(rows_read, total_rows, names, chunks[0])
+    finally:
+        wb.close()
+    df = _concat_arrow_chunks(chunks).to_pandas()
+    # O Arrow devolve None nas colunas de texto; o pd.read_excel, NaN.
+    for col in df.columns[df.dtypes == object]: df[col] = df[col].where(df[col].notna(), np.nan)
+    return df
+
+def _excel_progress_reporter(file_label: str):
+    """Barra de progresso + prévia das colunas/primeiras linhas enquanto o resto da planilha é lido."""
+    bar, preview = st.progress(0.0, text=f"Reading {file_label}..."), st.empty()
+    shown = []
+    def report(rows_read, total_rows, names, first_chunk):
+        frac = min(rows_read / total_rows, 1.0) if total_rows else 0.0
+        bar.progress(frac, text=f"Reading {file_label}: {rows_read:,}" + (f" of ~{total_rows:,} rows" if total_rows else " rows"))
+        if not shown:
+            shown.append(True)
+            with preview.container():
+                st.caption(f"{len(names)} columns detected: " + ", ".join(map(str, names[:30])) + (" ..." if len(names) > 30 else ""))
+                st.dataframe(first_chunk.slice(0, 5).to_pandas(), hide_index=True, use_container_width=True)
+    def clear():
+        bar.empty(); preview.empty()
+    return report, clear
+
+DTYPE_SAMPLE_ROWS = 2000
+_NUMERIC_TEXT_KINDS = ('integer', 'floating', 'mixed-integer-float', 'decimal')
+
+_LEADING_ZERO = r'^[+-]?0\d'
+_DECIMAL_MARK = r'^[+-]?\d*[.,]\d+$'
+
+def _looks_measured(text: pd.Series) -> bool:
+    """Texto numérico com cara de medida: algum valor fracionário e nenhum código com zero à esquerda ('00123')."""
+    if text.str.contains(_LEADING_ZERO, regex=True).any(): return False
+    if not text.str.contains(_DECIMAL_MARK, regex=True).any(): return False
+    return pd.to_numeric(text.str.replace(',', '.', regex=False), errors='coerce').notna().all()
+
+def infer_column_dtypes(df: pd.DataFrame, text_col: Optional[str] = None) -> pd.DataFrame:
+    """
+    Decide, por amostra, se cada coluna object é numérica, categórica ou texto e converte
+    em bloco. Texto com vírgula decimal ('1,5') vira float aqui; uma coluna só vira numérica
+    se TODOS os valores preenchidos converterem, se algum for fracionário e se nenhum tiver
+    zero à esquerda (códigos como '00123' continuam texto; '0,5' não conta). `text_col` (a
+    coluna de dados) nunca vira category, como antes.
+    """
+    n = len(df)
+    if n == 0: return df
+    sample_pos = np.unique(np.linspace(0, n - 1, min(n, DTYPE_SAMPLE_ROWS)).astype(np.int64))
+    converted = {}
+    for col in df.columns[(df.dtypes == object).to_numpy()]:
+        s = df[col]
+        kind = pd.api.types.infer_dtype(s, skipna=True)
+        if kind == 'empty': continue
+        filled = s.notna()
+        if kind in _NUMERIC_TEXT_KINDS:
+            converted[col] = pd.to_numeric(s, errors='coerce')
+            continue
+
+        text = s if kind == 'string' else s.astype(str).where(filled)
+        sample = text.iloc[sample_pos].dropna()
+        if kind == 'string' and len(sample) and _looks_measured(sample.str.strip()):
+            stripped = text.str.strip()
+            as_number = pd.to_numeric(stripped.str.replace(',', '.', regex=False), errors='coerce')
+            if as_number.notna().sum() == filled.sum() and _looks_measured(stripped.dropna()):
+                converted[col] = as_number
+                continue
+
+        if col != text_col and len(sample) and sample.nunique() / len(sample) < 0.5:
+            converted[col] = text.astype('category')
+        elif text is not s:
+            converted[col] = text
+    for col, values in converted.items(): df[col] = values
+    return df
+
+# --- PARSED-UPLOAD CACHE (shared by every session on this server) ---
+PARQUET_CACHE_DIR = os.environ.get("DATASIFT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "datasift_parquet_cache"))
+PARQUET_CACHE_BUDGET_MB = float(os.environ.get("DATASIFT_CACHE_BUDGET_MB", "2048"))
+
+def upload_content_hash(uploaded_file) -> str:
+    """SHA-256 do conteúdo do upload, calculado direto sobre o buffer em memória."""
+    return hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+
+def _parquet_cache_path(cache_key: str) -> str:
+    return os.path.join(PARQUET_CACHE_DIR, f"{cache_key}.parquet")
+
+def _read_cached_table(cache_key: str) -> Optional[pd.DataFrame]:
+    path = _parquet_cache_path(cache_key)
+    try:
+        df = pd.read_parquet(path)
+        os.utime(path)  # mtime = último uso, para a evicção LRU
+        return df
+    except Exception:
+        return None
+
+def _store_cached_table(cache_key: str, df: pd.DataFrame):
+    """Grava a tabela já normalizada no cache e despeja as mais antigas acima do orçamento."""
+    try:
+        os.makedirs(PARQUET_CACHE_DIR, exist_ok=True)
+        tmp_path = _parquet_cache_path(cache_key) + f".{uuid.uuid4().hex}.tmp"
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, _parquet_cache_path(cache_key))
+    except Exception:
+        try: os.remove(tmp_path)
+        except Exception: pass
+        return
+    entries = []
+    for entry in os.scandir(PARQUET_CACHE_DIR):
+        if entry.name.endswith('.parquet'):
+            try: entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+            except OSError: pass
+    total, budget = sum(e[1] for e in entries), PARQUET_CACHE_BUDGET_MB * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if total <= budget: break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError: pass
+
+def load_dataframe(uploaded_file, content_hash: Optional[str] = None, usecols: Optional[List[str]] = None):
+    """
+    Lê e normaliza a planilha. O resultado fica num cache Parquet em disco indexado pelo
+    hash do conteúdo, então reenviar o mesmo arquivo (de qualquer sessão) pula a leitura.
+    `usecols` (lean load) projeta só essas colunas em todos os leitores.
+    """
     if uploaded_file is None: return None
     try:
         file_name = uploaded_file.name.lower()
+        content_hash = content_hash or upload_content_hash(uploaded_file)
+        # A normalização de dtypes depende da coluna de dados escolhida, então ela entra na chave.
+        usecols = tuple(sorted(usecols)) if usecols is not None else None
+        cache_key = hashlib.sha1(f"{content_hash}|{os.path.splitext(file_name)[1]}|{st.session_state.get('col_dados')}|{usecols}|{MAX_ROWS}".encode('utf-8')).hexdigest()
+        st.session_state.pop('csv_dialect', None)
+        cached = _read_cached_table(cache_key)
+        if cached is not None: return cached
+
+        # O UploadedFile já é um BytesIO: os leitores recebem uma memoryview dele (ou o próprio
+        # objeto), sem a cópia para um arquivo temporário.
         uploaded_file.seek(0)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file_name)[1]) as tmp_file:
-            shutil.copyfileobj(uploaded_file, tmp_file)
-            tmp_path = tmp_file.name
+        buffer = uploaded_file.getbuffer()
 
         df = None
         if file_name.endswith('.zip'):
-            with zipfile.ZipFile(tmp_path) as z:
+            with zipfile.ZipFile(uploaded_file) as z:
                 valid_files = [f for f in z.namelist() if not f.startswith('__MACOSX/') and 
                                (f.lower().endswith('.csv') or f.lower().endswith(('.xlsx', '.xls')))]
                 if not valid_files:
                     st.error("The ZIP file contains no valid CSV or Excel files.")
-                    os.remove(tmp_path)
                     return None
-                with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(valid_files[0])[1]) as inner_tmp:
-                    inner_tmp.write(z.read(valid_files[0]))
-                    inner_path = inner_tmp.name
-                inner_filename = valid_files[0].lower()
-                if inner_filename.endswith('.csv'):
-                    try: df = _read_csv_engine(inner_path, ';', ',', 'latin-1')
-                    except Exception: df = _read_csv_engine(inner_path, ',', '.', 'utf-8')
-                else: df = pd.read_excel(inner_path, engine='openpyxl')
-                os.remove(inner_path)
+                with st.spinner(f"Reading {len(valid_files)} file(s) from the ZIP..."):
+                    df = read_zip_members(z, valid_files, usecols)
         elif file_name.endswith('.csv'):
-            try: df = _read_csv_engine(tmp_path, ';', ',', 'latin-1')
-            except Exception: df = _read_csv_engine(tmp_path, ',', '.', 'utf-8')
+            df = read_csv_sniffed(buffer, uploaded_file.name, usecols)
+        elif file_name.endswith('.parquet'):
+            df = pd.read_parquet(pa.BufferReader(buffer), columns=list(usecols) if usecols is not None else None)
         else:
-            df = pd.read_excel(tmp_path, engine='openpyxl')
-
-        if os.path.exists(tmp_path): os.remove(tmp_path)
+            report, clear = _excel_progress_reporter(uploaded_file.name)
+            try: df = read_excel_streaming(uploaded_file, on_progress=report, usecols=usecols)
+            finally: clear()
 
         if df is not None:
-            for col in df.select_dtypes(include=['object']).columns:
-                mask = df[col].notna()
-                df.loc[mask, col] = df.loc[mask, col].astype(str)
-                try:
-                    if col != st.session_state.col_dados and df[col].nunique() / len(df[col]) < 0.5:
-                        df[col] = df[col].astype('category')
-                except Exception: pass 
+            df = infer_column_dtypes(df, text_col=st.session_state.get('col_dados'))
+            _store_cached_table(cache_key, df)
         return df
+    except MemoryBudgetExceeded:
+        raise
     except Exception as e:
         st.error(f"Error reading file: {e}")
         return None
 
-def remove_outliers_tukey(df, col_dados, iterations=5, multiplier=2.0):
-    df_clean = df.copy()
+# --- LEAN LOAD (column projection) ---
+def lean_load_columns(header: List[str]) -> List[str]:
+    """Colunas que a configuração atual usa: idade, sexo, dados, p_col das regras ativas e as extras escolhidas."""
+    wanted = [st.session_state.get('col_idade'), st.session_state.get('col_sexo'), st.session_state.get('col_dados')]
+    # Lê os widgets vivos (p_check_<id>/p_col_<id>): draw_filter_rules só copia os valores para as
+    # regras mais adiante nesta mesma execução, depois da carga.
+    for rule in st.session_state.get('filter_rules', []):
+        if st.session_state.get(f"p_check_{rule['id']}", rule.get('p_check')):
+            p_col = st.session_state.get(f"p_col_{rule['id']}", rule.get('p_col', ''))
+            wanted += [c.strip() for c in str(p_col).split(';')]
+    wanted += st.session_state.get('lean_extra_cols', [])
+    in_header = set(header)
+    needed = [c for c in dict.fromkeys(wanted) if c and c in in_header]
+    return needed or header[:1]
+
+def _column_profiles_path() -> str:
+    return os.path.join(PARQUET_CACHE_DIR, "column_profiles.json")
+
+def _header_signature(header: List[str]) -> str:
+    return hashlib.sha1(json.dumps(header).encode('utf-8')).hexdigest()
+
+def load_column_profile(header: List[str]) -> List[str]:
+    """Colunas extras salvas para exportações com este mesmo cabeçalho (perfil compartilhado no servidor)."""
+    try:
+        with open(_column_profiles_path(), encoding='utf-8') as f: profiles = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return [c for c in profiles.get(_header_signature(header), []) if c in set(header)]
+
+def save_column_profile(header: List[str], columns: List[str]):
+    try:
+        with open(_column_profiles_path(), encoding='utf-8') as f: profiles = json.load(f)
+    except (OSError, ValueError):
+        profiles = {}
+    profiles[_header_signature(header)] = list(columns)
+    os.makedirs(PARQUET_CACHE_DIR, exist_ok=True)
+    with open(_column_profiles_path(), 'w', encoding='utf-8') as f: json.dump(profiles, f)
+
+def output_frame(session: 'DatasetSession') -> pd.DataFrame:
+    """
+    Tabela usada nas exportações: a carregada, ou — em lean load com saída completa pedida —
+    a planilha com todas as colunas, lida uma única vez e só neste momento. As posições de
+    linha coincidem porque é o mesmo arquivo lido pelo mesmo leitor.
+    Se a leitura completa falha (erro ou orçamento de memória), o motivo fica em
+    `full_width_error`, as exportações seguem com as colunas carregadas e não há nova tentativa
+    até o próximo upload.
+    """
+    if not (st.session_state.get('lean_load') and st.session_state.get('full_width_output')): return session.df
+    if st.session_state.get('full_width_error'): return session.df
+    if st.session_state.get('full_width_df') is None:
+        with st.spinner("Reading every column for full-width output..."):
+            try:
+                full = load_dataframe(st.session_state.file_uploader_widget, st.session_state.get('upload_hash'))
+                error = None if full is not None and len(full) == session.n_rows else "the file could not be read again in full"
+            except MemoryBudgetExceeded as e:
+                full, error = None, (f"it would take about {e.projected_bytes / 2**20:,.0f} MB of memory, above the "
+                                     f"{MEMORY_BUDGET_MB:,.0f} MB budget")
+        if error:
+            st.session_state.full_width_error = error
+            st.warning(f"Full-width output is unavailable ({error}). Exporting the loaded columns only.")
+            return session.df
+        st.session_state.full_width_df = full
+    return st.session_state.full_width_df
+
+def process_rss_bytes() -> Optional[int]:
+    """RSS atual do processo (Linux: /proc/self/statm); None onde não há /proc."""
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def session_memory_report(session: 'DatasetSession') -> Dict[str, int]:
+    """Bytes de cada estrutura de dados da sessão. O tamanho profundo do DataFrame é calculado uma vez por tabela."""
+    report, sizes = {}, {}
+    known = st.session_state.get('frame_memory', {})
+    for label, frame in (("Base table", session.df), ("Full-width table", st.session_state.get('full_width_df'))):
+        if frame is None: continue
+        key = (id(frame), frame.shape)
+        sizes[key] = known[key] if key in known else int(frame.memory_usage(index=True, deep=True).sum())
+        report[label] = sizes[key]
+    st.session_state.frame_memory = sizes
+    selections = [st.session_state.get('filtered_rows')] + list((st.session_state.get('stratified_results') or {}).values())
+    report["Row selections"] = sum(rows.nbytes for rows in selections if rows is not None)
+    report["DuckDB engine"] = session.engine_memory_bytes()
+    return report
+
+def open_dataset_session(df: Optional[pd.DataFrame], dataset_id: Optional[str], uploaded_file=None):
+    """
+    Troca a DatasetSession da sessão do usuário, fechando a conexão da planilha anterior.
+    Com `uploaded_file` (modo out-of-core) a sessão lê direto do arquivo, sem DataFrame.
+    """
+    old = st.session_state.get('dataset_session')
+    if old is not None: old.close()
+    if uploaded_file is not None:
+        try: st.session_state.dataset_session = FileDatasetSession(uploaded_file, dataset_id)
+        except Exception as e:
+            st.error(f"Error reading file: {e}")
+            st.session_state.dataset_session = None
+    else:
+        st.session_state.dataset_session = DatasetSession(df, dataset_id) if df is not None else None
+
+# --- RESULT CACHES ---
+class CacheStats:
+    """Acertos/erros dos caches de resultado, por função, para o servidor todo (vive em st.cache_resource)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: Dict[str, Dict[str, int]] = {}
+
+    def record(self, name: str, hit: bool):
+        with self._lock:
+            counts = self.counts.setdefault(name, {'hits': 0, 'misses': 0})
+            counts['hits' if hit else 'misses'] += 1
+
+@st.cache_resource
+def get_cache_stats() -> CacheStats:
+    return CacheStats()
+
+# O corpo de uma função com st.cache_data só roda no erro de cache; ele marca _CACHE_PROBE
+# (por thread, ou seja, por execução do script de uma sessão).
+_CACHE_PROBE = threading.local()
+
+def track_cache(name: str):
+    """Envolve uma função com st.cache_data e conta em get_cache_stats() se cada chamada reaproveitou o cache."""
+    def wrap(cached_fn):
+        @functools.wraps(cached_fn)
+        def call(*args, **kwargs):
+            _CACHE_PROBE.missed = False
+            result = cached_fn(*args, **kwargs)
+            get_cache_stats().record(name, hit=not _CACHE_PROBE.missed)
+            return result
+        call.clear = cached_fn.clear
+        return call
+    return wrap
+
+def note_cache_miss():
+    _CACHE_PROBE.missed = True
+
+def export_cache_key(session: Optional['DatasetSession'], state: Any, df: pd.DataFrame) -> str:
+    """
+    Chave de cache de uma exportação sem varrer os dados: hash do upload + estado que gerou o
+    frame (regras de filtro, etc.) + colunas e dtypes do frame, em vez do hash do frame inteiro.
+    """
+    dataset = [session.dataset_id, session.n_rows, session.schema_fingerprint] if session is not None else []
+    payload = [st.session_state.get('upload_hash'), dataset, state, [(str(col), str(dtype)) for col, dtype in df.dtypes.items()], len(df)]
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def filter_state_key(filter_rules: List[Dict], global_config: Dict) -> str:
+    """Hash do estado do Filter Tool (regras sem os ids de widget + colunas globais)."""
+    definitions = [{k: v for k, v in rule.items() if k != 'id'} for rule in filter_rules]
+    return hashlib.sha1(json.dumps([definitions, global_config], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+# --- LAB VALUE PARSING ---
+_NON_NUMERIC_CHARS = r'[^0-9.\-]'
+_FLOAT_TEXT = r'^-?([0-9]+\.?[0-9]*|\.[0-9]+)$'  # o que float() aceita depois da limpeza
+
+def _parse_lab_text(x: str) -> float:
+    """Regra de uma célula, em Python: usada só para texto com dígitos não-ASCII, que os kernels do Arrow não reconhecem."""
+    x = ''.join(c for c in x.replace(',', '.') if c.isdigit() or c in '.-')
+    try: return float(x)
+    except ValueError: return np.nan
+
+def parse_lab_values(values: pd.Series) -> pd.Series:
+    """
+    Coluna bruta de resultados -> float64, com kernels do Arrow em vez de um laço por célula:
+    vírgula vira ponto, sobram só dígitos, '.' e '-', e o que não converter vira NaN
+    ('< 0,5' -> 0.5, '12,3 mg/dL' -> 12.3). Colunas já numéricas passam direto, sem o
+    caminho por str() — que descartava valores em notação científica ('5e-05') —, então
+    reaplicar a uma coluna já convertida não muda nada.
+    """
+    if pd.api.types.is_bool_dtype(values.dtype):
+        return pd.Series(np.nan, index=values.index, dtype='float64')
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        out = values.to_numpy(dtype='float64', na_value=np.nan)
+        return pd.Series(np.where(np.isfinite(out), out, np.nan), index=values.index)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # Converte só as categorias e espalha pelos códigos.
+        categories = np.append(parse_lab_values(pd.Series(values.cat.categories)).to_numpy(), np.nan)
+        return pd.Series(categories[values.cat.codes.to_numpy()], index=values.index)
+
+    try: text = pa.array(values, type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):  # coluna object com tipos misturados
+        text = pa.array(values.astype(str).where(values.notna(), None), type=pa.string(), from_pandas=True)
+    cleaned = pc.replace_substring_regex(pc.replace_substring(text, ',', '.'), _NON_NUMERIC_CHARS, '')
+    out = pc.cast(pc.if_else(pc.match_substring_regex(cleaned, _FLOAT_TEXT), cleaned, None), pa.float64())
+    out = out.to_numpy(zero_copy_only=False).copy()
+    non_ascii = np.flatnonzero(pc.fill_null(pc.invert(pc.string_is_ascii(text)), False).to_numpy(zero_copy_only=False))
+    for i in non_ascii: out[i] = _parse_lab_text(text[int(i)].as_py())
+    return pd.Series(out, index=values.index)
+
+def _sorted_quantile(s: np.ndarray, lo: int, hi: int, q: float) -> float:
+    """Quantil linear (o mesmo do Series.quantile) do trecho ordenado s[lo:hi], sem copiar nem reordenar."""
+    pos = q * (hi - lo - 1)
+    i = int(pos)
+    gamma = pos - i
+    a, b = s[lo + i], s[min(lo + i + 1, hi - 1)]
+    # Mesma interpolação do numpy (_lerp), para os limites baterem bit a bit.
+    return b - (b - a) * (1 - gamma) if gamma >= 0.5 else a + (b - a) * gamma
+
+def tukey_trim_sorted(s: np.ndarray, iterations: int = 5, multiplier: float = 2.0):
+    """
+    Cercas de Tukey iteradas sobre valores JÁ ORDENADOS (sem NaN). Cada passada só mantém os
+    valores dentro de [Q1 - k·IQR, Q3 + k·IQR], ou seja, um trecho contíguo do array ordenado:
+    as passadas apenas movem dois índices (searchsorted). Devolve (lo, hi, removidos por passada),
+    com os valores mantidos em s[lo:hi].
+    """
+    lo, hi = 0, len(s)
+    removed = []
     for _ in range(iterations):
-        if df_clean.empty:
+        if hi <= lo:
             break
-        Q1 = df_clean[col_dados].quantile(0.25)
-        Q3 = df_clean[col_dados].quantile(0.75)
-        IQR = Q3 - Q1
-        
-        lower_bound = Q1 - (multiplier * IQR)
-        upper_bound = Q3 + (multiplier * IQR)
-        
-        mask = (df_clean[col_dados] >= lower_bound) & (df_clean[col_dados] <= upper_bound)
-        if mask.all(): 
-            break 
-            
-        df_clean = df_clean[mask]
-        
-    return df_clean
+        q1, q3 = _sorted_quantile(s, lo, hi, 0.25), _sorted_quantile(s, lo, hi, 0.75)
+        iqr = q3 - q1
+        new_lo = max(lo, int(np.searchsorted(s, q1 - (multiplier * iqr), side='left')))
+        new_hi = min(hi, int(np.searchsorted(s, q3 + (multiplier * iqr), side='right')))
+        if new_lo == lo and new_hi == hi:
+            break
+        removed.append((new_lo - lo) + (hi - new_hi))
+        lo, hi = new_lo, max(new_lo, new_hi)
+    return lo, hi, removed
 
 def calcular_limites_haeckel(lri: float, lrs: float):
     # Interceptação para conversão automática do LRI para 15% do LRS
@@ -630,25 +1776,169 @@ def encontrar_limites_casados(idade: float, sexo: str, lista_limites: list) -> O
         
     return globais[0] if globais else None
 
-@st.cache_data(show_spinner=False)
-def run_harris_boyd(df, col_idade, col_dados, lista_limites=None, sexo_contexto="All"):
-    temp_df = pd.DataFrame()
-    temp_df['Age'] = pd.to_numeric(df[col_idade], errors='coerce')
-
-    def clean_val(x):
-        if pd.isna(x): return np.nan
-        x = str(x).replace(',', '.')
-        x = ''.join(c for c in x if c.isdigit() or c == '.' or c == '-')
-        try: return float(x)
-        except: return np.nan
-
-    temp_df['Data'] = df[col_dados].apply(clean_val).astype('float64')
-    temp_df = temp_df.dropna(subset=['Age', 'Data'])
-    temp_df = temp_df[temp_df['Age'] >= 0].copy()
-    temp_df = remove_outliers_tukey(temp_df, 'Data', iterations=5, multiplier=2.0)
-
-    if temp_df.empty: return pd.DataFrame(), pd.DataFrame(), [], False
-    max_age = int(temp_df['Age'].max())
+class ReferenceLimitIndex:
+    """
+    Matriz de limites de referência de um sexo compilada em tabela de intervalos. Os extremos
+    age_min/age_max (com os mesmos padrões 0 e 9999) cortam a reta das idades em regiões onde
+    encontrar_limites_casados dá sempre o mesmo resultado: cada ponto de corte e cada trecho aberto
+    entre dois cortes. A função é avaliada uma vez por região, com os parâmetros de Haeckel já
+    calculados, e casar um array de idades é um único searchsorted. As regiões antes do primeiro e
+    depois do último corte são as mesmas idades de fora da matriz, com o mesmo fallback.
+    """
+    def __init__(self, lista_limites: list, sexo: str):
+        points = set()
+        for item in lista_limites or []:
+            if item.get('age_min') is not None or item.get('age_max') is not None:
+                points.add(float(item.get('age_min') if item.get('age_min') is not None else 0))
+                points.add(float(item.get('age_max') if item.get('age_max') is not None else 9999))
+        self.breaks = np.array(sorted(points), dtype='float64')
+        # Representante de cada região: (-inf, p0), [p0], (p0, p1), [p1], ..., [pk], (pk, +inf)
+        if len(self.breaks):
+            gaps = (self.breaks[:-1] + self.breaks[1:]) / 2
+            reps = np.empty(2 * len(self.breaks) + 1)
+            reps[0], reps[-1] = self.breaks[0] - 1, self.breaks[-1] + 1
+            reps[1::2], reps[2:-1:2] = self.breaks, gaps
+        else:
+            reps = np.zeros(1)
+        self.limits = [encontrar_limites_casados(float(age), sexo, lista_limites) for age in reps]
+        self.haeckel = [calcular_limites_haeckel(lim.get('lri'), lim.get('lrs')) if lim and lim.get('lrs') is not None and lim.get('lrs') > 0 else None
+                        for lim in self.limits]
+
+    def regions(self, ages: np.ndarray) -> np.ndarray:
+        """Região de cada idade: 2i+1 se a idade é o corte i, senão 2i (o trecho antes do corte i)."""
+        ages = np.asarray(ages, dtype='float64')
+        if not len(self.breaks): return np.zeros(len(ages), dtype=np.int64)
+        i = np.searchsorted(self.breaks, ages, side='left')
+        on_break = self.breaks[np.minimum(i, len(self.breaks) - 1)] == ages
+        return 2 * i + on_break
+
+    def haeckel_for(self, ages: np.ndarray) -> list:
+        """calcular_limites_haeckel do limite casado com cada idade (None sem LRS válido)."""
+        return [self.haeckel[r] for r in self.regions(ages)]
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def reference_limit_index(lista_limites: list, sexo: str) -> ReferenceLimitIndex:
+    """ReferenceLimitIndex compilado uma vez por matriz de limites e sexo."""
+    return ReferenceLimitIndex(lista_limites, sexo)
+
+class AgeStatsCube:
+    """
+    Estatísticas suficientes por idade de uma coluna de resultados, montadas UMA vez por
+    planilha/colunas/seleção de linhas (DatasetSession.age_cube) e lidas por todos os consumidores
+    da análise: Harris-Boyd (trilhas 1 e 2), medianas das mini-tabelas e platôs do gráfico.
+
+    As linhas válidas (idade >= 0 e resultado numérico) são ordenadas uma vez por (idade, valor):
+    cada valor distinto de idade é uma célula contígua (o groupby('Age') do cálculo original; idades
+    fracionárias viram células próprias), n/soma/soma dos quadrados de qualquer faixa de idades saem
+    de somas acumuladas, e os valores já ordenados dentro da célula são o resumo (exato) de quantis.
+    O Tukey sempre deixa uma janela de valores [lo, hi], que em cada célula é um searchsorted.
+    Da ordem original só fica a posição de cada linha (`row`), usada por gather().
+    """
+    MAX_RESTRICTED = 4  # faixas de zoom memorizadas por cubo
+
+    def __init__(self, ages: np.ndarray, values: np.ndarray, key: str = ""):
+        ok = ~np.isnan(ages) & ~np.isnan(values) & (ages >= 0)
+        ages, values = ages[ok], values[ok]
+        order = np.lexsort((values, ages))
+        # Sem chave da sessão (cubo avulso), a chave de cache é o hash do conteúdo.
+        key = key or hashlib.sha1(ages.tobytes() + values.tobytes()).hexdigest()
+        self._build(ages[order], values[order], order.astype(np.int32 if len(order) < 2**31 else np.int64), key)
+
+    def _build(self, ages: np.ndarray, values: np.ndarray, row: np.ndarray, key: str):
+        self.ages, self.values, self.row, self.key = ages, values, row, key
+        self.cell_ages, starts = np.unique(self.ages, return_index=True)
+        self.bounds = np.append(starts, len(self.values)).astype(np.int64)
+        # Centrado na média para a soma dos quadrados não perder precisão.
+        self.shift = float(self.values.mean()) if len(self.values) else 0.0
+        centered = self.values - self.shift
+        self._cum1 = np.concatenate(([0.0], np.cumsum(centered)))
+        self._cum2 = np.concatenate(([0.0], np.cumsum(centered * centered)))
+        self._memo = {}
+        self._restricted = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def restrict(self, amin: float, amax: float) -> 'AgeStatsCube':
+        """
+        Cubo só com as idades em [amin, amax] (zoom do gráfico): as linhas da faixa já são um trecho
+        contíguo da ordem (idade, valor). Só as últimas MAX_RESTRICTED faixas ficam memorizadas.
+        """
+        if not len(self) or (amin <= self.cell_ages[0] and amax >= self.cell_ages[-1]): return self
+        memo_key = (amin, amax)
+        if memo_key in self._restricted:
+            self._restricted.move_to_end(memo_key)
+            return self._restricted[memo_key]
+        sl = self._age_slice(amin, amax)
+        cube = AgeStatsCube.__new__(AgeStatsCube)
+        cube._build(self.ages[sl], self.values[sl], self.row[sl], f"{self.key}|{amin}-{amax}")
+        self._restricted[memo_key] = cube
+        while len(self._restricted) > self.MAX_RESTRICTED: self._restricted.popitem(last=False)
+        return cube
+
+    def _tukey(self, iterations: int, multiplier: float) -> tuple:
+        memo_key = ('tukey', iterations, multiplier)
+        if memo_key not in self._memo:
+            s = np.sort(self.values)
+            lo, hi, removed = tukey_trim_sorted(s, iterations, multiplier)
+            self._memo[memo_key] = ((float(s[lo]), float(s[hi - 1])) if hi > lo else None, removed)
+        return self._memo[memo_key]
+
+    def tukey_window(self, iterations: int = 5, multiplier: float = 2.0) -> Optional[tuple]:
+        """(menor, maior) valor que sobrevive às cercas de Tukey iteradas; None se nada sobra."""
+        return self._tukey(iterations, multiplier)[0]
+
+    def tukey_removed(self, iterations: int = 5, multiplier: float = 2.0) -> List[int]:
+        """Pontos removidos em cada passada do Tukey."""
+        return self._tukey(iterations, multiplier)[1]
+
+    def cell_stats(self, window: Optional[tuple] = None) -> Dict[str, np.ndarray]:
+        """
+        Por idade não vazia: 'age', 'n', 's1'/'s2' (soma e soma dos quadrados centradas em `shift`),
+        'vmin'/'vmax' e as linhas ordenadas [a, b) — só os valores dentro de `window`, se dada.
+        """
+        a, b = self.bounds[:-1], self.bounds[1:]
+        if window is not None:
+            lo, hi = window
+            a, b = (np.array([s + np.searchsorted(self.values[s:e], v, side=side) for s, e in zip(a, b)], dtype=np.int64)
+                    for v, side in ((lo, 'left'), (hi, 'right')))
+        keep = b > a
+        a, b = a[keep], b[keep]
+        return {'age': self.cell_ages[keep], 'n': (b - a).astype('float64'),
+                's1': self._cum1[b] - self._cum1[a], 's2': self._cum2[b] - self._cum2[a],
+                'vmin': self.values[a], 'vmax': self.values[b - 1], 'a': a, 'b': b}
+
+    def gather(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """Valores das linhas ordenadas [a_j, b_j), devolvidos na ordem original das linhas."""
+        if not len(a): return self.values[:0]
+        idx = np.concatenate([np.arange(x, y) for x, y in zip(a, b)])
+        return self.values[idx[np.argsort(self.row[idx], kind='stable')]]
+
+    def _age_slice(self, amin: float, amax: float) -> slice:
+        i0, i1 = np.searchsorted(self.cell_ages, amin, side='left'), np.searchsorted(self.cell_ages, amax, side='right')
+        return slice(int(self.bounds[i0]), int(self.bounds[i1]))
+
+    def ages_between(self, amin: float, amax: float) -> np.ndarray:
+        return self.cell_ages[(self.cell_ages >= amin) & (self.cell_ages <= amax)]
+
+    def median(self, amin: float, amax: float) -> float:
+        rows = self.values[self._age_slice(amin, amax)]
+        return float(np.median(rows)) if len(rows) else np.nan
+
+    def mean(self, amin: float, amax: float) -> float:
+        sl = self._age_slice(amin, amax)
+        n = sl.stop - sl.start
+        return (self._cum1[sl.stop] - self._cum1[sl.start]) / n + self.shift if n else np.nan
+
+@track_cache('run_harris_boyd')
+@st.cache_data(show_spinner=False, hash_funcs={AgeStatsCube: lambda cube: cube.key})
+def run_harris_boyd(cube: AgeStatsCube, lista_limites=None, sexo_contexto="All"):
+    """Harris-Boyd + corte clínico sobre o cubo (as linhas válidas, depois do Tukey)."""
+    note_cache_miss()
+    window = cube.tukey_window(iterations=5, multiplier=2.0)
+    if window is None: return pd.DataFrame(), pd.DataFrame(), [], False
+    cells = cube.cell_stats(window)
+    max_age = int(cells['age'].max())
     if max_age < 1: return pd.DataFrame(), pd.DataFrame(), [], False
 
     # =========================================================================
@@ -658,72 +1948,92 @@ def run_harris_boyd(df, col_idade, col_dados, lista_limites=None, sexo_contexto=
     # =========================================================================
     MIN_N = 30  # minimum subjects per partition to attempt a cut
 
-    def find_best_cut(df_sub: pd.DataFrame):
-        """Return the single most statistically significant cut in df_sub, or None."""
-        if len(df_sub) < 2 * MIN_N:
-            return None
-
-        min_a = int(df_sub['Age'].min())
-        max_a = int(df_sub['Age'].max())
-        best_cut = None
-        best_z = 0.0
+    # Cada idade do cubo é um grupo; um corte 'Age <= k' separa um intervalo contíguo de grupos,
+    # então n, soma e soma dos quadrados de cada lado saem de somas acumuladas. min/max por grupo
+    # detectam lados constantes (variância exatamente 0).
+    keys = cells['age']
+    b_n, b_s1, b_s2, b_vmin, b_vmax = cells['n'], cells['s1'], cells['s2'], cells['vmin'], cells['vmax']
 
-        for age_cutoff in range(min_a, max_a):
-            g1 = df_sub[df_sub['Age'] <= age_cutoff]['Data']
-            g2 = df_sub[df_sub['Age'] > age_cutoff]['Data']
-            n1, n2 = len(g1), len(g2)
+    def find_best_cut(lo: int, hi: int):
+        """Return the single most statistically significant cut among age groups [lo, hi), or None."""
+        n_total = b_n[lo:hi].sum()
+        if n_total < 2 * MIN_N:
+            return None
 
-            if n1 < MIN_N or n2 < MIN_N:
-                continue
+        cutoffs = np.arange(int(keys[lo]), int(keys[hi - 1]))
+        if not len(cutoffs):
+            return None
+        split = np.searchsorted(keys[lo:hi], cutoffs, side='right')  # nº de grupos no lado <= corte
+        cum_n, cum_s1, cum_s2 = (np.concatenate(([0.0], np.cumsum(b[lo:hi]))) for b in (b_n, b_s1, b_s2))
+        n1, s1, q1 = cum_n[split], cum_s1[split], cum_s2[split]
+        n2, s2, q2 = n_total - n1, cum_s1[-1] - s1, cum_s2[-1] - q1
+        valid = (n1 >= MIN_N) & (n2 >= MIN_N)
+        if not valid.any():
+            return None
 
-            mean1, mean2 = float(np.mean(g1)), float(np.mean(g2))
-            var1,  var2  = float(np.var(g1, ddof=1)), float(np.var(g2, ddof=1))
-            sd1,   sd2   = np.sqrt(var1), np.sqrt(var2)
+        left = np.clip(split - 1, 0, hi - lo - 1)
+        right = np.clip(split, 0, hi - lo - 1)
+        const1 = np.minimum.accumulate(b_vmin[lo:hi])[left] == np.maximum.accumulate(b_vmax[lo:hi])[left]
+        const2 = np.minimum.accumulate(b_vmin[lo:hi][::-1])[::-1][right] == np.maximum.accumulate(b_vmax[lo:hi][::-1])[::-1][right]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean1, mean2 = s1 / n1, s2 / n2
+            var1 = np.where(const1, 0.0, np.maximum(q1 - s1 * mean1, 0.0) / (n1 - 1))
+            var2 = np.where(const2, 0.0, np.maximum(q2 - s2 * mean2, 0.0) / (n2 - 1))
+            sd1, sd2 = np.sqrt(var1), np.sqrt(var2)
 
             # Fallback seguro: se min(sd1, sd2) for 0, a razão se iguala a 1.0 (não ativando o gatilho falso > 1.5)
-            sd_ratio = max(sd1, sd2) / min(sd1, sd2) if min(sd1, sd2) > 0 else 1.0
-            
+            sd_min = np.minimum(sd1, sd2)
+            sd_ratio = np.where(sd_min > 0, np.maximum(sd1, sd2) / sd_min, 1.0)
+
             denom = np.sqrt((var1 / n1) + (var2 / n2))
-            if denom == 0:
-                continue
-                
-            z = abs(mean1 - mean2) / denom
-            z_crit = 3 * np.sqrt((n1 + n2) / 120) if (n1 + n2) < 120 else 3.0
-
-            is_significant = (sd_ratio > 1.5 or z > z_crit)
-
-            # Keep only the most extreme significant cut in this partition
-            if is_significant and z > best_z:
-                best_z = z
-                best_cut = {
-                    'age': age_cutoff,
-                    'Age Cutoff': f"<= {age_cutoff} vs > {age_cutoff}",
-                    'Z-score': round(z, 2),
-                    'SD Ratio': round(sd_ratio, 2),
-                    'Mean (<= Cutoff)': round(mean1, 2),
-                    'Mean (> Cutoff)': round(mean2, 2),
-                }
-        return best_cut
-
-    def recursive_partition(df_sub: pd.DataFrame, found: list, depth: int = 0):
+            z = np.abs(mean1 - mean2) / denom
+        z_crit = 3 * np.sqrt(n_total / 120) if n_total < 120 else 3.0
+
+        # Keep only the most extreme significant cut in this partition (first one on ties)
+        is_significant = valid & (denom > 0) & ((sd_ratio > 1.5) | (z > z_crit)) & (z > 0)
+        if not is_significant.any():
+            return None
+        i = int(np.argmax(np.where(is_significant, z, -np.inf)))
+        age_cutoff = int(cutoffs[i])
+
+        # Os números exibidos do corte escolhido são recalculados com np.mean/np.var sobre os
+        # dois lados na ordem original das linhas, para arredondarem como no cálculo direto.
+        mid = lo + split[i]
+        g1 = cube.gather(cells['a'][lo:mid], cells['b'][lo:mid])
+        g2 = cube.gather(cells['a'][mid:hi], cells['b'][mid:hi])
+        mean1_c, mean2_c = float(np.mean(g1)), float(np.mean(g2))
+        var1_c, var2_c = float(np.var(g1, ddof=1)), float(np.var(g2, ddof=1))
+        sd1_c, sd2_c = np.sqrt(var1_c), np.sqrt(var2_c)
+        sd_ratio_c = max(sd1_c, sd2_c) / min(sd1_c, sd2_c) if min(sd1_c, sd2_c) > 0 else 1.0
+        z_c = abs(mean1_c - mean2_c) / np.sqrt((var1_c / len(g1)) + (var2_c / len(g2)))
+        return {
+            'age': age_cutoff,
+            'Age Cutoff': f"<= {age_cutoff} vs > {age_cutoff}",
+            'Z-score': round(z_c, 2),
+            'SD Ratio': round(sd_ratio_c, 2),
+            'Mean (<= Cutoff)': round(mean1_c, 2),
+            'Mean (> Cutoff)': round(mean2_c, 2),
+        }
+
+    def recursive_partition(lo: int, hi: int, found: list, depth: int = 0):
         """
-        Recursively split df_sub.
+        Recursively split the age groups [lo, hi).
         Each call adds at most ONE cut (the best one in this sub-range),
         then dives into the two resulting halves.
         depth cap = 6  →  maximum 2^6 - 1 = 63 cuts, in practice 2–5.
         """
         if depth >= 6:
             return
-        best = find_best_cut(df_sub)
+        best = find_best_cut(lo, hi)
         if best is None:
             return
         found.append(best)
-        cut_age = best['age']
-        recursive_partition(df_sub[df_sub['Age'] <= cut_age], found, depth + 1)
-        recursive_partition(df_sub[df_sub['Age'] > cut_age],  found, depth + 1)
+        mid = lo + int(np.searchsorted(keys[lo:hi], best['age'], side='right'))
+        recursive_partition(lo, mid, found, depth + 1)
+        recursive_partition(mid, hi, found, depth + 1)
 
     possible_cuts_hb = []
-    recursive_partition(temp_df, possible_cuts_hb)
+    recursive_partition(0, len(keys), possible_cuts_hb)
     possible_cuts_hb.sort(key=lambda x: x['age'])
 
     df_possible = pd.DataFrame(possible_cuts_hb) if possible_cuts_hb else pd.DataFrame()
@@ -731,17 +2041,18 @@ def run_harris_boyd(df, col_idade, col_dados, lista_limites=None, sexo_contexto=
     # =========================================================================
     # TRACK 2: DYNAMIC CRITICAL BOUNDARY EVALUATION (HAECKEL VS AEDM)
     # =========================================================================
-    global_mean = temp_df['Data'].mean()
-    global_sd   = temp_df['Data'].std(ddof=1)
+    n_all = b_n.sum()
+    global_mean = b_s1.sum() / n_all + cube.shift
+    global_sd   = np.sqrt(max(b_s2.sum() - b_s1.sum() ** 2 / n_all, 0.0) / (n_all - 1)) if n_all > 1 else np.nan
     global_cv   = (global_sd / global_mean) if global_mean > 0 else 0.10
     cv_tolerance_margin = global_cv * 0.50
 
-    age_groups = temp_df.groupby('Age')['Data'].agg(['mean', 'count']).reset_index()
-    age_groups = age_groups.sort_values(by='Age').to_dict('records')
+    age_groups = [{'Age': age, 'mean': s1 / n + cube.shift, 'count': int(n)} for age, s1, n in zip(keys.tolist(), b_s1.tolist(), b_n.tolist())]
 
     clinical_cuts = []
     idades_sugeridas = []
     any_haeckel_applied = False
+    haeckel_by_age = reference_limit_index(lista_limites, sexo_contexto).haeckel_for(keys)
 
     if age_groups:
         current_bracket_means = [age_groups[0]['mean']]
@@ -754,11 +2065,7 @@ def run_harris_boyd(df, col_idade, col_dados, lista_limites=None, sexo_contexto=
             is_significant = False
             margin_disp    = 0
 
-            limite_casado = encontrar_limites_casados(current_age_data['Age'], sexo_contexto, lista_limites)
-
-            h_local = None
-            if limite_casado and limite_casado.get('lrs') is not None and limite_casado.get('lrs') > 0:
-                h_local = calcular_limites_haeckel(limite_casado.get('lri'), limite_casado.get('lrs'))
+            h_local = haeckel_by_age[i]
 
             if h_local and reference_mean > 0:
                 any_haeckel_applied = True
@@ -773,8 +2080,9 @@ def run_harris_boyd(df, col_idade, col_dados, lista_limites=None, sexo_contexto=
 
             if is_significant and current_age_data['count'] >= 5:
                 cutoff_age = int(age_groups[i - 1]['Age'])
-                m_less    = temp_df[temp_df['Age'] <= cutoff_age]['Data'].mean()
-                m_greater = temp_df[temp_df['Age'] > cutoff_age]['Data'].mean()
+                mid = int(np.searchsorted(keys, cutoff_age, side='right'))
+                m_less    = np.mean(cube.gather(cells['a'][:mid], cells['b'][:mid]))
+                m_greater = np.mean(cube.gather(cells['a'][mid:], cells['b'][mid:]))
 
                 clinical_cuts.append({
                     'age': cutoff_age,
@@ -794,16 +2102,11 @@ def run_harris_boyd(df, col_idade, col_dados, lista_limites=None, sexo_contexto=
     return df_possible, df_ideal, idades_sugeridas, any_haeckel_applied
 
 
-def plot_dispersion_chart(df, col_idade, col_dados, col_sexo, intervalo, chart_type, group_by_sex, selected_sexes, show_trendlines, lista_limites, age_filter_range):
+def plot_dispersion_chart(df, col_idade, col_dados, col_sexo, intervalo, chart_type, group_by_sex, selected_sexes, show_trendlines, lista_limites, age_filter_range, cubes=None):
+    """`cubes` ({sexo ou 'All': AgeStatsCube}) evita remontar as estatísticas das linhas de platô."""
     temp_df = pd.DataFrame()
     temp_df['Age'] = pd.to_numeric(df[col_idade], errors='coerce')
-    def clean_val(x):
-        if pd.isna(x): return np.nan
-        x = str(x).replace(',', '.')
-        x = ''.join(c for c in x if c.isdigit() or c == '.' or c == '-')
-        try: return float(x)
-        except: return np.nan
-    temp_df['Data'] = pd.to_numeric(df[col_dados].apply(clean_val), errors='coerce')
+    temp_df['Data'] = parse_lab_values(df[col_dados])
     
     if col_sexo and col_sexo in df.columns: temp_df['Sex'] = df[col_sexo].astype(str)
     else: group_by_sex = False
@@ -848,13 +2151,18 @@ def plot_dispersion_chart(df, col_idade, col_dados, col_sexo, intervalo, chart_t
         if show_trendlines:
             metric_str = 'mean' if chart_type == 'Moving Average' else 'median'
             def draw_segments(df_sub, color, s_context):
-                _, _, cuts, _ = run_harris_boyd(df_sub, 'Age', 'Data', lista_limites, s_context)
+                cube = (cubes or {}).get(s_context)
+                if cube is None: cube = AgeStatsCube(df_sub['Age'].to_numpy(dtype='float64'), df_sub['Data'].to_numpy(dtype='float64'))
+                else: cube = cube.restrict(*age_filter_range)
+                _, _, cuts, _ = run_harris_boyd(cube, lista_limites, s_context)
                 starts, ends = [0] + [c + 1 for c in cuts], cuts + [999]
                 for s, e in zip(starts, ends):
-                    mask = (df_sub['Age'] >= s) & (df_sub['Age'] <= e)
-                    if mask.sum() == 0: continue
-                    val = df_sub[mask]['Data'].mean() if metric_str == 'mean' else df_sub[mask]['Data'].median()
-                    x_positions = [categories.index(lbl) for lbl in df_sub[mask]['Age_Label'].unique() if lbl in categories]
+                    ages = cube.ages_between(s, e)
+                    if not len(ages): continue
+                    val = cube.mean(s, e) if metric_str == 'mean' else cube.median(s, e)
+                    bins = (ages // intervalo) * intervalo if intervalo > 1 else ages
+                    labels = [f"{int(b)} to {int(b + intervalo - 1)}" for b in np.unique(bins)] if intervalo > 1 else np.unique(bins.astype(int).astype(str))
+                    x_positions = [categories.index(lbl) for lbl in labels if lbl in categories]
                     if not x_positions: continue
                     ax.hlines(y=val, xmin=min(x_positions)-0.4, xmax=max(x_positions)+0.4, color=color, linestyle='--', linewidth=2.5, alpha=0.8, zorder=10)
 
@@ -882,15 +2190,90 @@ def plot_dispersion_chart(df, col_idade, col_dados, col_sexo, intervalo, chart_t
     plt.tight_layout()
     return fig
 
+# `_df` não entra no hash do st.cache_data (prefixo _): o cache é indexado só por `cache_key` (export_cache_key).
+@track_cache('to_excel')
 @st.cache_data(show_spinner="Preparing file for export...")
-def to_excel(df):
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer: df.to_excel(writer, index=False, sheet_name='Sheet1')
-    return output.getvalue()
+def to_excel(_df, cache_key: str):
+    note_cache_miss()
+    return datasift_export.frame_to_excel_bytes(_df)
 
+@track_cache('to_csv')
 @st.cache_data(show_spinner="Preparing CSV for export...")
-def to_csv(df):
-    return df.to_csv(index=False, sep=';', decimal=',', encoding='utf-8-sig').encode('utf-8-sig')
+def to_csv(_df, cache_key: str):
+    note_cache_miss()
+    return datasift_export.frame_to_csv_bytes(_df)
+
+@st.cache_resource
+def get_export_pool():
+    """Pool de processos do servidor para serializar estratos (o openpyxl é CPU-bound e preso ao GIL)."""
+    return ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=multiprocessing.get_context('spawn'))
+
+class StrataExport:
+    """
+    Arquivos de um resultado de estratificação, em disco: cada estrato é serializado uma
+    única vez (em paralelo no pool de processos) e o mesmo arquivo serve o botão individual
+    e o membro do ZIP, que também é montado num arquivo temporário, sem buffer em memória.
+    """
+    def __init__(self, ext: str):
+        self.ext = ext
+        self.dir = tempfile.mkdtemp(prefix='datasift_strata_')
+        self.zip_path = None
+        self._paths = {}
+
+    def path(self, name: str) -> Optional[str]:
+        """Arquivo já serializado do estrato `name` (None se ainda não foi gerado)."""
+        return self._paths.get(name)
+
+    def serialize(self, session: 'DatasetSession', strata: Dict[str, np.ndarray], names: List[str], progress_bar=None):
+        is_excel = self.ext == 'xlsx'
+        pending = [name for name in names if name not in self._paths]
+        # Nomes de estrato podem ter caracteres inválidos em arquivo; em disco usa-se a posição.
+        positions = {name: j for j, name in enumerate(strata)}
+        targets = {name: os.path.join(self.dir, f"{positions[name]}.{self.ext}") for name in pending}
+        if len(pending) > 1 and (os.cpu_count() or 1) > 1:
+            try:
+                pool = get_export_pool()
+                source = output_frame(session)
+                # No máximo um estrato por worker em voo: cada submissão materializa e serializa a
+                # cópia do estrato, então submeter tudo de uma vez dobraria o pico de memória.
+                queue = iter(pending)
+                in_flight = {}
+                def submit_next():
+                    name = next(queue, None)
+                    if name is not None: in_flight[pool.submit(datasift_export.write_frame, source.take(strata[name]), targets[name], is_excel)] = name
+                for _ in range(os.cpu_count() or 1): submit_next()
+                done = 0
+                while in_flight:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        self._paths[in_flight.pop(future)] = future.result()
+                        done += 1
+                        if progress_bar: progress_bar.progress(done / len(pending), text=f"Serialized {done}/{len(pending)} strata...")
+                        submit_next()
+                return
+            except BrokenProcessPool:
+                get_export_pool.clear()  # recria o pool na próxima exportação; termina em série abaixo
+        for done, name in enumerate(pending, 1):
+            if name not in self._paths:
+                self._paths[name] = datasift_export.write_frame(output_frame(session).take(strata[name]), targets[name], is_excel)
+            if progress_bar: progress_bar.progress(done / len(pending), text=f"Serialized {done}/{len(pending)} strata...")
+
+    def build_zip(self, session: 'DatasetSession', strata: Dict[str, np.ndarray], progress_bar=None) -> str:
+        self.serialize(session, strata, list(strata), progress_bar)
+        # xlsx já é um ZIP comprimido; recomprimir só gastaria CPU.
+        compression = zipfile.ZIP_STORED if self.ext == 'xlsx' else zipfile.ZIP_DEFLATED
+        zip_path = os.path.join(self.dir, "all_strata.zip")
+        with zipfile.ZipFile(zip_path, 'w', compression) as zf:
+            for name in strata: zf.write(self._paths[name], arcname=f"{name}.{self.ext}")
+        self.zip_path = zip_path
+        return zip_path
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def drop_strata_export():
+    export = st.session_state.pop('strata_export', None)
+    if export is not None: export.close()
 
 # --- USER INTERFACE BUILDER FUNCTIONS ---
 def draw_filter_rules(sex_column_values, column_options):
@@ -1078,28 +2461,148 @@ def main():
     with st.expander("📁 1. Global Settings (Upload Spreadsheet)", expanded=True):
         def reset_results_on_upload():
             if 'filtered_result' in st.session_state: del st.session_state['filtered_result']
-            if 'filtered_df' in st.session_state: del st.session_state['filtered_df']
+            if 'filtered_rows' in st.session_state: del st.session_state['filtered_rows']
+            if 'filter_attribution' in st.session_state: del st.session_state['filter_attribution']
             if 'stratified_results' in st.session_state: del st.session_state['stratified_results']
+            drop_strata_export()
             if 'analysis_params' in st.session_state: del st.session_state['analysis_params']
             if 'analysis_results' in st.session_state: del st.session_state['analysis_results']
+            if 'full_width_df' in st.session_state: del st.session_state['full_width_df']
+            st.session_state.pop('full_width_error', None)
             st.session_state.confirm_stratify = False
             
-        uploaded_file = st.file_uploader("Select spreadsheet", type=['csv', 'xlsx', 'xls', 'zip'], on_change=reset_results_on_upload, key="file_uploader_widget", label_visibility="collapsed")
+        def switch_load_mode():
+            reset_results_on_upload()
+            st.session_state.pop('memory_budget_exceeded', None)
+            st.session_state.id_arquivo_atual = None  # força recarregar o upload no novo modo
+
+        def continue_out_of_core():
+            st.session_state.out_of_core_mode = True
+            switch_load_mode()
+
+        def load_within_budget(uploaded_file, usecols=None):
+            """load_dataframe; se a leitura passaria do orçamento de memória, guarda o aviso e devolve None."""
+            try:
+                return load_dataframe(uploaded_file, st.session_state.upload_hash, usecols=usecols)
+            except MemoryBudgetExceeded as e:
+                st.session_state.memory_budget_exceeded = e.projected_bytes
+                return None
+
+        uploaded_file = st.file_uploader("Select spreadsheet", type=['csv', 'xlsx', 'xls', 'zip', 'parquet'], on_change=reset_results_on_upload, key="file_uploader_widget", label_visibility="collapsed")
+        out_of_core = st.checkbox(
+            "Out-of-core mode (files larger than memory)",
+            key="out_of_core_mode",
+            on_change=switch_load_mode,
+            help="CSV/Parquet only. The file is filtered by DuckDB straight from disk and the result is written to a temporary CSV, "
+                 "without loading the table into memory. Analysis and stratification are not available in this mode.",
+        )
+        lean_load = st.checkbox(
+            "Lean load (read only the columns in use)",
+            key="lean_load",
+            on_change=switch_load_mode,
+            help="Reads the header first and loads only the age, sex and data columns, the columns of active filter rules "
+                 "and any extra columns you pick. New columns are read when the configuration needs them.",
+        )
 
         if "dados_salvos" not in st.session_state: st.session_state.dados_salvos = None
         if "id_arquivo_atual" not in st.session_state: st.session_state.id_arquivo_atual = None
+        if "dataset_session" not in st.session_state: st.session_state.dataset_session = None
 
         if uploaded_file is not None:
             if st.session_state.id_arquivo_atual != uploaded_file.file_id:
-                st.session_state.dados_salvos = load_dataframe(uploaded_file)
+                st.session_state.pop('memory_budget_exceeded', None)
+                st.session_state.upload_hash = upload_content_hash(uploaded_file)
+                streaming = out_of_core and uploaded_file.name.lower().endswith(FileDatasetSession.SUPPORTED)
+                st.session_state.upload_header = read_upload_header(uploaded_file) if lean_load and not streaming else None
+                st.session_state.loaded_columns = None
+                if st.session_state.upload_header:
+                    st.session_state.lean_extra_cols = load_column_profile(st.session_state.upload_header)
+                if streaming:
+                    st.session_state.dados_salvos = None
+                    with st.spinner("Writing file to disk for out-of-core processing..."):
+                        open_dataset_session(None, uploaded_file.file_id, uploaded_file=uploaded_file)
+                elif st.session_state.upload_header:
+                    # Lean load: a projeção é lida logo abaixo. Larga já a planilha anterior, para que
+                    # uma leitura que falhe (erro ou orçamento) não deixe o arquivo velho no lugar do novo.
+                    st.session_state.dados_salvos = None
+                    open_dataset_session(None, None)
+                else:
+                    if out_of_core: st.info("Out-of-core mode supports CSV and Parquet files only; loading this file into memory.")
+                    st.session_state.dados_salvos = load_within_budget(uploaded_file)
+                    open_dataset_session(st.session_state.dados_salvos, uploaded_file.file_id)
                 st.session_state.id_arquivo_atual = uploaded_file.file_id
+
+            # Lean load: (re)lê só as colunas em uso quando a configuração passa a precisar de outra.
+            header = st.session_state.get('upload_header')
+            if header and 'memory_budget_exceeded' not in st.session_state:
+                needed = lean_load_columns(header)
+                loaded = st.session_state.get('loaded_columns')
+                if loaded is None or not set(needed) <= set(loaded):
+                    columns = needed if loaded is None else list(dict.fromkeys(loaded + needed))
+                    with st.spinner(f"Reading {len(columns)} of {len(header)} columns..."):
+                        lean_df = load_within_budget(uploaded_file, usecols=columns)
+                    if lean_df is not None:
+                        st.session_state.dados_salvos = lean_df
+                        st.session_state.loaded_columns = columns
+                        open_dataset_session(lean_df, uploaded_file.file_id)
         else:
             st.session_state.dados_salvos = None
             st.session_state.id_arquivo_atual = None
+            st.session_state.pop('memory_budget_exceeded', None)
+            open_dataset_session(None, None)
+
+        projected = st.session_state.get('memory_budget_exceeded')
+        if projected is not None:
+            st.warning(f"Loading this file would take about {projected / 2**20:,.0f} MB of memory, above the "
+                       f"{MEMORY_BUDGET_MB:,.0f} MB budget (DATASIFT_MEMORY_BUDGET_MB). The load was stopped.")
+            if uploaded_file is not None and uploaded_file.name.lower().endswith(FileDatasetSession.SUPPORTED):
+                st.button("Continue in out-of-core mode", on_click=continue_out_of_core, type="primary")
 
         df = st.session_state.dados_salvos
-        column_options = df.columns.tolist() if df is not None else []
+        if df is not None and st.session_state.dataset_session is None:
+            open_dataset_session(df, st.session_state.id_arquivo_atual)
+        session = st.session_state.dataset_session
+        lean_header = st.session_state.get('upload_header') if uploaded_file is not None else None
+        column_options = lean_header or (session.columns if session is not None else [])
+
+        if lean_header:
+            lc1, lc2 = st.columns([3, 1])
+            lc1.multiselect("Extra columns to load", options=lean_header, key="lean_extra_cols",
+                            help="Columns loaded besides the age, sex and data columns and the columns of active filter rules.")
+            lc2.markdown("<div style='height: 1.8rem;'></div>", unsafe_allow_html=True)
+            if lc2.button("Save column profile", help="Remember these extra columns for uploads with the same header.", use_container_width=True):
+                save_column_profile(lean_header, st.session_state.lean_extra_cols)
+                st.toast("Column profile saved.")
+            st.checkbox("Full-width output (exported files include every column)", key="full_width_output",
+                        help="The full table is read only when a file is exported.")
+            st.caption(f"Lean load: {len(st.session_state.get('loaded_columns') or [])} of {len(lean_header)} columns in memory.")
+            if st.session_state.get('full_width_output') and st.session_state.get('full_width_error'):
+                st.caption(f"Full-width output is unavailable for this upload ({st.session_state.full_width_error}); exports contain the loaded columns.")
         
+        if MAX_ROWS and df is not None and len(df) >= MAX_ROWS and uploaded_file.name.lower().endswith('.csv'):
+            st.warning(f"Only the first {MAX_ROWS:,} rows were loaded (row cap DATASIFT_MAX_ROWS).")
+
+        if session is not None and session.df is not None:
+            with st.popover("Memory usage"):  # o card já é um expander, que não pode conter outro
+                report = session_memory_report(session)
+                rss = process_rss_bytes()
+                mcols = st.columns(len(report) + 1)
+                for mcol, (label, n_bytes) in zip(mcols, report.items()): mcol.metric(label, f"{n_bytes / 2**20:,.1f} MB")
+                upload_mb = uploaded_file.size / 2**20 if uploaded_file is not None else 0
+                mcols[-1].metric("Process RSS", f"{rss / 2**20:,.0f} MB" if rss else "n/a",
+                                 f"{rss / 2**20 / upload_mb:.1f}x upload" if rss and upload_mb else None, delta_color="off",
+                                 help="Resident memory of the whole server process (shared by every open session).")
+                st.caption("Filtered results, sex subgroups and strata are kept as row positions over the base table, not as copies.")
+                cache_counts = get_cache_stats().counts
+                if cache_counts:
+                    st.caption("Result caches (hits / misses, whole server): " + " · ".join(
+                        f"`{name}` {counts['hits']:,} / {counts['misses']:,}" for name, counts in sorted(cache_counts.items())))
+
+        dialect = st.session_state.get('csv_dialect')
+        if dialect and session is not None:
+            sep_label = {'\t': 'tab', ';': ';', ',': ',', '|': '|'}.get(dialect['sep'], dialect['sep'])
+            st.caption(f"Detected CSV format for {dialect['file']}: separator `{sep_label}` · decimal `{dialect['decimal']}` · encoding `{dialect['encoding']}`")
+
         c1, c2, c3, c4 = st.columns(4)
         with c1: st.selectbox("Age Column", options=column_options, key="col_idade", index=None, placeholder="Select Age column")
         with c2: st.selectbox("Sex/Gender Column", options=column_options, key="col_sexo", index=None, placeholder="Select Sex/Gender")
@@ -1110,20 +2613,26 @@ def main():
         st.session_state.age_column_is_valid = True
         sex_column_values = []
 
-        if df is not None:
+        if session is not None:
             if st.session_state.col_sexo:
-                try:
-                    unique_sex_values = df[st.session_state.col_sexo].dropna().unique()
+                if session.has_column(st.session_state.col_sexo):
+                    unique_sex_values = session.distinct_values(st.session_state.col_sexo, limit=11)
                     if len(unique_sex_values) > 10: st.session_state.sex_column_is_valid = False
-                    else: sex_column_values = [""] + list(unique_sex_values)
-                except KeyError: st.session_state.sex_column_is_valid = False
+                    else: sex_column_values = [""] + unique_sex_values
+                else: st.session_state.sex_column_is_valid = False
 
             if st.session_state.col_idade:
-                try:
-                    age_col = df[st.session_state.col_idade].dropna()
-                    numeric_ages = pd.to_numeric(age_col, errors='coerce')
-                    if (numeric_ages.isna().sum() / len(age_col) if len(age_col) > 0 else 0) > 0.2: st.session_state.age_column_is_valid = False
-                except KeyError: st.session_state.age_column_is_valid = False
+                if session.has_column(st.session_state.col_idade):
+                    if session.non_numeric_ratio(st.session_state.col_idade) > 0.2: st.session_state.age_column_is_valid = False
+                else: st.session_state.age_column_is_valid = False
+
+            # Text columns parsed to numbers at load time (e.g. "12,5" -> 12.5), with the
+            # cells that could not be parsed and are therefore ignored by numeric rules.
+            parse_report = session.parse_report
+            unparsed = parse_report[parse_report['Unparsed values'] > 0]
+            if not parse_report.empty:
+                if st.checkbox(f"Show numeric parsing report ({len(parse_report)} text columns normalized, {len(unparsed)} with unparsed values)", key="show_parse_report"):
+                    st.dataframe(parse_report.sort_values('Unparsed values', ascending=False), hide_index=True, use_container_width=True)
 
     is_ready_for_processing = st.session_state.age_column_is_valid and st.session_state.sex_column_is_valid
     
@@ -1147,25 +2656,60 @@ def main():
         st.markdown('</div></div>', unsafe_allow_html=True)
 
         if st.button("Generate Filtered Sheet", type="primary", use_container_width=True, disabled=not is_ready_for_processing):
-            if df is None: st.error("Please upload a spreadsheet in Global Settings first.")
+            st.session_state.filter_state_key = filter_state_key(st.session_state.filter_rules, {"coluna_idade": st.session_state.col_idade, "coluna_sexo": st.session_state.col_sexo})
+            if session is None: st.error("Please upload a spreadsheet in Global Settings first.")
+            elif df is None:
+                # Out-of-core: the survivors go straight from the source file to a CSV on disk.
+                if 'filter_attribution' in st.session_state: del st.session_state['filter_attribution']
+                with st.spinner("Applying filters..."):
+                    progress_bar = st.progress(0, text="Initializing...")
+                    processor = get_data_processor()
+                    global_config = {"coluna_idade": st.session_state.col_idade, "coluna_sexo": st.session_state.col_sexo}
+                    n_written = processor.export_filtered(session, st.session_state.filter_rules, global_config, progress_bar)
+                    if n_written:
+                        timestamp = datetime.now(ZoneInfo("America/Sao_Paulo")).strftime("%Y%m%d_%H%M%S")
+                        st.session_state.filtered_result = (session.output_path, f"Filtered_Sheet_{timestamp}.csv")
+                        st.caption(f"{n_written:,} rows written (CSV; out-of-core mode always exports CSV).")
+                    elif n_written == 0: st.success("No rows remaining after filters applied.")
             else:
+                if 'filter_attribution' in st.session_state: del st.session_state['filter_attribution']
                 with st.spinner("Applying filters..."):
                     progress_bar = st.progress(0, text="Initializing...")
                     processor = get_data_processor()
                     global_config = {"coluna_idade": st.session_state.col_idade, "coluna_sexo": st.session_state.col_sexo}
-                    filtered_df = processor.apply_filters(df, st.session_state.filter_rules, global_config, progress_bar)
-                    if not filtered_df.empty:
+                    kept_rows = processor.apply_filters(session, st.session_state.filter_rules, global_config, progress_bar)
+                    if len(kept_rows):
+                        export_df = output_frame(session).take(kept_rows)
                         is_excel = "Excel" in st.session_state.output_format
-                        file_bytes = to_excel(filtered_df) if is_excel else to_csv(filtered_df)
+                        export_key = export_cache_key(session, st.session_state.filter_state_key, export_df)
+                        file_bytes = to_excel(export_df, export_key) if is_excel else to_csv(export_df, export_key)
                         timestamp = datetime.now(ZoneInfo("America/Sao_Paulo")).strftime("%Y%m%d_%H%M%S")
                         st.session_state.filtered_result = (file_bytes, f"Filtered_Sheet_{timestamp}.{'xlsx' if is_excel else 'csv'}")
-                        # Keep the filtered DataFrame in memory so it can feed the
+                        # Keep the surviving row positions so the filtered result can feed the
                         # Stratification Tool directly (no download/re-upload round-trip).
-                        # It is a subset of the original (<= rows) and is cleared on new upload.
-                        st.session_state.filtered_df = filtered_df
+                        # Only the positions are stored; rows are taken from the base table on use.
+                        st.session_state.filtered_rows = kept_rows
                     else: st.success("No rows remaining after filters applied.")
-        if 'filtered_result' in st.session_state:
-            st.download_button("⬇️ Download Final Filtered Sheet", data=st.session_state.filtered_result[0], file_name=st.session_state.filtered_result[1], use_container_width=True, type="secondary")
+        attribution = st.session_state.get('filter_attribution')
+        if 'filtered_result' in st.session_state or attribution is not None:
+            col_dl, col_audit = st.columns([1, 1.4], gap="large")
+            if 'filtered_result' in st.session_state:
+                file_data, file_name = st.session_state.filtered_result
+                if isinstance(file_data, str):  # out-of-core result: path of the CSV written by DuckDB
+                    # download_button reads the whole payload anyway; read it here so the handle is closed.
+                    if os.path.exists(file_data):
+                        with open(file_data, 'rb') as f: file_data = f.read()
+                    else: file_data = b""
+                col_dl.download_button("⬇️ Download Final Filtered Sheet", data=file_data, file_name=file_name, use_container_width=True, type="secondary")
+            if attribution is not None:
+                # Audit trail: how many rows each active rule removed, alone and uniquely.
+                with col_audit:
+                    st.markdown("**Exclusions per rule**")
+                    st.dataframe(attribution, hide_index=True, use_container_width=True)
+                    is_excel = "Excel" in st.session_state.output_format
+                    report_key = export_cache_key(session, [st.session_state.get('filter_state_key'), 'attribution'], attribution)
+                    st.download_button("⬇️ Export exclusion report", data=to_excel(attribution, report_key) if is_excel else to_csv(attribution, report_key),
+                                       file_name=f"Filter_Exclusion_Report.{'xlsx' if is_excel else 'csv'}", use_container_width=True, type="secondary", key="dl_filter_attribution")
 
     # --- TAB 3: ANALYSIS & STRATIFICATION ---
     with tab_stratify:
@@ -1177,8 +2721,8 @@ def main():
             # --- DATA SOURCE SELECTOR (original upload vs. last filtered result) ---
             # Lets the user run the analysis/stratification on the sheet just produced
             # by the Filter Tool without downloading and re-uploading it.
-            source_df = df
-            if st.session_state.get('filtered_df') is not None:
+            source_rows = None
+            if st.session_state.get('filtered_rows') is not None:
                 choice = st.radio(
                     "Data source for analysis & stratification",
                     ["Uploaded spreadsheet", "Last filtered result"],
@@ -1187,11 +2731,12 @@ def main():
                     help="Use the spreadsheet you uploaded, or the sheet produced by the Filter Tool — no re-upload needed.",
                 )
                 if choice == "Last filtered result":
-                    source_df = st.session_state.filtered_df
+                    source_rows = st.session_state.filtered_rows
                 st.caption(
-                    f"Using **{choice}** — {len(source_df):,} rows "
-                    f"(uploaded: {len(df):,} · filtered: {len(st.session_state.filtered_df):,})."
+                    f"Using **{choice}** — {len(session.view(source_rows)):,} rows "
+                    f"(uploaded: {len(df):,} · filtered: {len(st.session_state.filtered_rows):,})."
                 )
+            source = session.view(source_rows)
 
             if not st.session_state.col_idade or not st.session_state.col_dados:
                 st.info("⚠️ Select the **'Age Column'** and **'Data Column'** in Global Settings to enable visual analysis and stratification.")
@@ -1203,10 +2748,10 @@ def main():
                 st.markdown("#### 📈 Visual & Analytical Settings")
                 
                 # --- CÁLCULO SEGURO DOS LIMITES DE IDADE ---
-                age_series = pd.to_numeric(source_df[st.session_state.col_idade], errors='coerce').dropna()
-                if not age_series.empty:
-                    min_age_data = int(age_series.min())
-                    max_age_data = int(age_series.max())
+                min_age_num, max_age_num = session.numeric_range(st.session_state.col_idade, source_rows)
+                if min_age_num is not None:
+                    min_age_data = int(min_age_num)
+                    max_age_data = int(max_age_num)
                 else:
                     min_age_data, max_age_data = 0, 100
                 
@@ -1247,7 +2792,22 @@ def main():
 
                         # 1. PRÉ-CALCULAR O GRÁFICO
                         age_range_safe = p.get('age_filter_range', (min_age_data, max_age_data))
-                        fig = plot_dispersion_chart(source_df, st.session_state.col_idade, st.session_state.col_dados, st.session_state.col_sexo, p['intervalo_plot'], p['chart_type'], p['group_by_sex_plot'], p['selected_sexes_for_plot'], p['show_trendlines'], p['ref_limits_list'], age_range_safe)
+                        analysis_cols = [st.session_state.col_idade, st.session_state.col_dados, st.session_state.col_sexo]
+                        parsed = {st.session_state.col_dados: session.lab_values(st.session_state.col_dados)}
+
+                        # Um AgeStatsCube por seleção de linhas (cada sexo e o total), compartilhado
+                        # pelas linhas de platô, pelo Harris-Boyd e pelas medianas das mini-tabelas.
+                        def cube_for(rows):
+                            return session.age_cube(st.session_state.col_idade, st.session_state.col_dados, rows)
+                        sex_rows = {}
+                        if st.session_state.col_sexo and st.session_state.sex_column_is_valid:
+                            for sex_val in p['selected_sexes_for_plot']:
+                                sex_rows[str(sex_val)] = session.rows_with_value(st.session_state.col_sexo, sex_val, source_rows)
+                        plot_cubes = {sex: cube_for(rows) for sex, rows in sex_rows.items()}
+                        if not p['group_by_sex_plot']:
+                            plot_cubes['All'] = cube_for(np.sort(np.concatenate(list(sex_rows.values()))) if sex_rows else source_rows)
+
+                        fig = plot_dispersion_chart(source.frame(analysis_cols, parsed), st.session_state.col_idade, st.session_state.col_dados, st.session_state.col_sexo, p['intervalo_plot'], p['chart_type'], p['group_by_sex_plot'], p['selected_sexes_for_plot'], p['show_trendlines'], p['ref_limits_list'], age_range_safe, plot_cubes)
 
                         # --- NOVA PARTE: CONVERTER PARA IMAGEM FIXA ---
                         img_buffer = None
@@ -1267,13 +2827,15 @@ def main():
                             sex_options_hboyd = [v for v in sex_column_values if v]
                             for sex_val in sex_options_hboyd:
                                 if sex_val not in p['selected_sexes_for_plot']: continue
-                                sub_df = source_df[source_df[st.session_state.col_sexo].astype(str) == str(sex_val)].copy()
-                                if sub_df.empty: continue
+                                sub_rows = sex_rows.get(str(sex_val))
+                                if sub_rows is None: sub_rows = session.rows_with_value(st.session_state.col_sexo, sex_val, source_rows)
+                                if not len(sub_rows): continue
+                                sub_cube = plot_cubes[str(sex_val)] if str(sex_val) in plot_cubes else cube_for(sub_rows)
 
-                                df_possiveis, df_ideais, cuts_ideais, h_activated = run_harris_boyd(sub_df, st.session_state.col_idade, st.session_state.col_dados, p['ref_limits_list'], str(sex_val))
+                                df_possiveis, df_ideais, cuts_ideais, h_activated = run_harris_boyd(sub_cube, p['ref_limits_list'], str(sex_val))
                                 if h_activated: any_haeckel_activated_at_all = True
 
-                                max_age_sub = int(pd.to_numeric(sub_df[st.session_state.col_idade], errors='coerce').max())
+                                max_age_sub = int(session.numeric_range(st.session_state.col_idade, sub_rows)[1] or 0)
                                 titulo_metodo_2 = "EDA Haeckel (Practical approach)" if h_activated else "Empirical Analysis of Dispersion and Means (Empirical approach)"
 
                                 hboyd_render_data.append({
@@ -1282,7 +2844,7 @@ def main():
                                     'cuts_ideais': cuts_ideais,
                                     'max_age': max_age_sub,
                                     'titulo_metodo_2': titulo_metodo_2,
-                                    'sub_df': sub_df
+                                    'cube': sub_cube
                                 })
 
                                 if not df_possiveis.empty:
@@ -1290,9 +2852,10 @@ def main():
                                 if not df_ideais.empty:
                                     df_i = df_ideais.copy(); df_i.insert(0, 'Sex', str(sex_val)); df_ideais_global_list.append(df_i)
                         else:
-                            df_possiveis, df_ideais, cuts_ideais, h_activated = run_harris_boyd(source_df, st.session_state.col_idade, st.session_state.col_dados, p['ref_limits_list'], "All")
+                            full_cube = cube_for(source_rows)
+                            df_possiveis, df_ideais, cuts_ideais, h_activated = run_harris_boyd(full_cube, p['ref_limits_list'], "All")
                             if h_activated: any_haeckel_activated_at_all = True
-                            max_age_full = int(pd.to_numeric(source_df[st.session_state.col_idade], errors='coerce').max())
+                            max_age_full = int(session.numeric_range(st.session_state.col_idade, source_rows)[1] or 0)
                             titulo_metodo_2 = "EDA Haeckel (Practical approach)" if h_activated else "Empirical Analysis of Dispersion and Means (Empirical approach)"
 
                             hboyd_render_data.append({
@@ -1301,7 +2864,7 @@ def main():
                                 'cuts_ideais': cuts_ideais,
                                 'max_age': max_age_full,
                                 'titulo_metodo_2': titulo_metodo_2,
-                                'sub_df': source_df
+                                'cube': full_cube
                             })
 
                             if not df_possiveis.empty: df_possiveis_global_list.append(df_possiveis)
@@ -1339,8 +2902,12 @@ def main():
                             if res['group_by_sex_plot'] and st.session_state.col_sexo:
                                 st.markdown(f"<hr style='border-color: rgba(7, 59, 76, 0.2); margin: 10px 0;'><p style='font-size:1.0rem; color:{COLOR_PRIMARY}; margin-bottom:2px;'><b>Sex: {data['sex_val']}</b></p>", unsafe_allow_html=True)
 
-                            render_mini_tabela("Harris-Boyd (Statistical approach)", data['df_possiveis_age'], data['max_age'], data['sub_df'], st.session_state.col_idade, st.session_state.col_dados)
-                            render_mini_tabela(data['titulo_metodo_2'], data['cuts_ideais'], data['max_age'], data['sub_df'], st.session_state.col_idade, st.session_state.col_dados)
+                            render_mini_tabela("Harris-Boyd (Statistical approach)", data['df_possiveis_age'], data['max_age'], data['cube'])
+                            render_mini_tabela(data['titulo_metodo_2'], data['cuts_ideais'], data['max_age'], data['cube'])
+                            removed = data['cube'].tukey_removed(iterations=5, multiplier=2.0)
+                            if removed:
+                                st.caption(f"Tukey outlier removal: {sum(removed):,} of {len(data['cube']):,} points removed "
+                                           f"(per pass: {' · '.join(f'{r:,}' for r in removed)}).")
                         st.markdown("</div>", unsafe_allow_html=True)
 
                     # --- MULTIPARAMETRIC HAECKEL AUDIT TABLES ---
@@ -1464,7 +3031,8 @@ def main():
                             processor = get_data_processor()
                             age_rules = [r for r in st.session_state.stratum_rules if r.get('val1')]
                             sex_rules = [{'value': gender_val, 'name': str(gender_val)} for gender_val, is_selected in st.session_state.get('strat_gender_selection', {}).items() if is_selected]
-                            st.session_state.stratified_results = processor.apply_stratification(source_df.copy(), {'ages': age_rules, 'sexes': sex_rules}, {"coluna_idade": st.session_state.col_idade, "coluna_sexo": st.session_state.col_sexo}, progress_bar)
+                            drop_strata_export()
+                            st.session_state.stratified_results = processor.apply_stratification(session, {'ages': age_rules, 'sexes': sex_rules}, {"coluna_idade": st.session_state.col_idade, "coluna_sexo": st.session_state.col_sexo}, progress_bar, rows=source_rows)
                         st.session_state.confirm_stratify = False
                         st.rerun()
                     if c2.button("Cancel"):
@@ -1490,61 +3058,68 @@ def main():
                             + ", ".join(small_strata)
                         )
 
+                    # Strata are kept as row-position arrays; files are serialized only on request,
+                    # to disk, and each stratum's file is shared by the ZIP and its own button.
+                    export = st.session_state.get('strata_export')
+                    if export is not None and export.ext != ext:
+                        drop_strata_export()
+                        export = None
+                    if export is None:
+                        export = st.session_state.strata_export = StrataExport(ext)
+
                     # --- Single ZIP with every stratum (avoids many separate clicks) ---
-                    zip_buffer = io.BytesIO()
-                    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-                        for filename, df_to_download in results.items():
-                            file_bytes = to_excel(df_to_download) if is_excel else to_csv(df_to_download)
-                            zf.writestr(f"{filename}.{ext}", file_bytes)
-                    zip_ts = datetime.now(ZoneInfo("America/Sao_Paulo")).strftime("%Y%m%d_%H%M%S")
-                    st.download_button(
-                        f"⬇️ Download all {len(results)} strata (.zip)",
-                        data=zip_buffer.getvalue(),
-                        file_name=f"Stratified_Sheets_{zip_ts}.zip",
-                        mime="application/zip",
-                        use_container_width=True,
-                        type="primary",
-                        key="dl_all_strata_zip",
-                    )
+                    if export.zip_path is not None:
+                        zip_ts = datetime.now(ZoneInfo("America/Sao_Paulo")).strftime("%Y%m%d_%H%M%S")
+                        with open(export.zip_path, 'rb') as zip_file:
+                            st.download_button(
+                                f"⬇️ Download all {len(results)} strata (.zip)",
+                                data=zip_file,
+                                file_name=f"Stratified_Sheets_{zip_ts}.zip",
+                                mime="application/zip",
+                                use_container_width=True,
+                                type="primary",
+                                key="dl_all_strata_zip",
+                            )
+                    elif st.button(f"📦 Prepare ZIP with all {len(results)} strata", use_container_width=True, type="primary", key="prep_all_strata_zip"):
+                        progress_bar = st.progress(0, text="Serializing strata...")
+                        export.build_zip(session, results, progress_bar)
+                        st.rerun()
 
                     # --- Individual downloads, each showing its sample size (N) ---
                     with st.expander("Download individual strata", expanded=False):
-                        for filename, df_to_download in results.items():
-                            n = len(df_to_download)
+                        for filename, stratum_rows in results.items():
+                            n = len(stratum_rows)
                             flag = "  ⚠️ N<120" if n < MIN_REF_N else ""
-                            file_bytes = to_excel(df_to_download) if is_excel else to_csv(df_to_download)
-                            st.download_button(
-                                f"📄 {filename}  ·  n={n:,}{flag}",
-                                data=file_bytes,
-                                file_name=f"{filename}.{ext}",
-                                key=f"dl_{filename}",
-                                type="secondary",
-                            )
+                            stratum_path = export.path(filename)
+                            if stratum_path is not None:
+                                with open(stratum_path, 'rb') as stratum_file:
+                                    st.download_button(
+                                        f"⬇️ {filename}  ·  n={n:,}{flag}",
+                                        data=stratum_file,
+                                        file_name=f"{filename}.{ext}",
+                                        key=f"dl_{filename}",
+                                        type="primary",
+                                    )
+                            elif st.button(f"📄 {filename}  ·  n={n:,}{flag}", key=f"prep_{filename}", type="secondary", help="Prepare this stratum for download"):
+                                with st.spinner(f"Preparing {filename}..."):
+                                    export.serialize(session, results, [filename])
+                                st.rerun()
+        elif session is not None:
+            st.info("⚠️ Analysis and stratification need the spreadsheet in memory. Turn off out-of-core mode in Global Settings to use them.")
         else:
             st.info("⚠️ Please upload a spreadsheet to access the analysis and stratification tools.")
         st.markdown('</div></div>', unsafe_allow_html=True)
 
-# Nova função render_mini_tabela que recebe o df para cálculo da mediana
-def render_mini_tabela(titulo, cuts, max_age, df_context, col_idade, col_dados):
+# Nova função render_mini_tabela que recebe o cubo da seleção para cálculo da mediana
+def render_mini_tabela(titulo, cuts, max_age, cube):
     st.markdown(f"<p style='font-size:0.85rem; color:#41A0C4; font-weight: 600; margin-bottom:5px; margin-top:15px; text-transform: uppercase;'>{titulo}:</p>", unsafe_allow_html=True)
     if not cuts:
         st.markdown(f"<p style='font-weight:bold; font-size:0.95rem; color:{COLOR_SECONDARY};'>No stratification needed</p>", unsafe_allow_html=True)
         return
     
-    # Limpa e filtra as colunas para o cálculo exato da mediana
-    def clean_val(x):
-        if pd.isna(x): return np.nan
-        x = str(x).replace(',', '.')
-        x = ''.join(c for c in x if c.isdigit() or c == '.' or c == '-')
-        try: return float(x)
-        except: return np.nan
-        
-    t_age = pd.to_numeric(df_context[col_idade], errors='coerce')
-    t_data = pd.to_numeric(df_context[col_dados].apply(clean_val), errors='coerce')
-
     def get_med_str(amin, amax):
-        # Filtra a faixa etária especificada e extrai a mediana
-        m = t_data[(t_age >= amin) & (t_age <= amax)].median()
+        # Mediana exata da faixa etária: as linhas já estão ordenadas por (idade, valor) no cubo
+        m = cube.median(amin, amax)
         if pd.isna(m): return "- Mediana: N/A"
         
         # Formata com 2 casas decimais e substitui ponto por vírgula no padrão brasileiro
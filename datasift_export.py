@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Serialização das planilhas exportadas pelo Data Sift.
+
+Fica num módulo à parte (e não no script do Streamlit) para que as funções possam
+ser enviadas a um ProcessPoolExecutor: os workers importam este módulo pelo nome.
+"""
+import io
+
+import pandas as pd
+
+
+def frame_to_excel_bytes(df: pd.DataFrame) -> bytes:
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer: df.to_excel(writer, index=False, sheet_name='Sheet1')
+    return output.getvalue()
+
+
+def frame_to_csv_bytes(df: pd.DataFrame) -> bytes:
+    return df.to_csv(index=False, sep=';', decimal=',', encoding='utf-8-sig').encode('utf-8-sig')
+
+
+def write_frame(df: pd.DataFrame, path: str, is_excel: bool) -> str:
+    """Grava `df` em `path` no formato de saída escolhido e devolve o caminho (roda nos workers)."""
+    data = frame_to_excel_bytes(df) if is_excel else frame_to_csv_bytes(df)
+    with open(path, 'wb') as f: f.write(data)
+    return path
@@ -30,7 +30,7 @@ import io
 import os
 import re
 import zipfile
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -148,44 +148,64 @@ def parse_limite(txt: str):
 # --------------------------------------------------------------------------- #
 # 2. Leitura robusta da planilha (csv / xlsx / xls / zip)
 # --------------------------------------------------------------------------- #
-def _ler_csv(path):
-    """Tenta o padrão brasileiro (;, decimal ,) e cai para (, decimal .)."""
+def _ler_csv(fonte):
+    """Tenta o padrão brasileiro (;, decimal ,) e cai para (, decimal .).
+
+    ``fonte`` é um caminho ou os bytes do CSV; bytes ganham um buffer novo a cada
+    tentativa, já que a primeira leitura consome o anterior.
+    """
+    def abrir():
+        return io.BytesIO(fonte) if isinstance(fonte, bytes) else fonte
     try:
-        return pd.read_csv(path, sep=";", decimal=",", encoding="latin-1", engine="python")
+        return pd.read_csv(abrir(), sep=";", decimal=",", encoding="latin-1", engine="python")
     except Exception:
-        return pd.read_csv(path, sep=",", decimal=".", encoding="utf-8", engine="python")
+        return pd.read_csv(abrir(), sep=",", decimal=".", encoding="utf-8", engine="python")
+
+
+COLUNA_ORIGEM = "Arquivo de origem"
+
+
+def _ler_zip(z: zipfile.ZipFile, membros: list[str]) -> pd.DataFrame:
+    """Lê todos os membros válidos do ZIP direto da memória, em paralelo.
+
+    Cada membro é descomprimido e interpretado numa thread própria (sem extrair
+    para disco) e os resultados são concatenados na ordem do arquivo. Com mais de
+    um membro (ex.: um CSV por dia), a coluna ``COLUNA_ORIGEM`` indica de qual
+    arquivo veio cada linha.
+    """
+    def ler_membro(membro):
+        dados = z.read(membro)
+        if membro.lower().endswith(".csv"):
+            return _ler_csv(dados)
+        return pd.read_excel(io.BytesIO(dados), engine="openpyxl")
+
+    with ThreadPoolExecutor(max_workers=min(len(membros), os.cpu_count() or 1)) as pool:
+        partes = list(pool.map(ler_membro, membros))
+    if len(partes) == 1:
+        return partes[0]
+    return pd.concat([p.assign(**{COLUNA_ORIGEM: os.path.basename(m)})
+                      for p, m in zip(partes, membros)], ignore_index=True)
 
 
 @st.cache_data(show_spinner="Lendo planilha...")
 def carregar_planilha(conteudo: bytes, nome: str) -> pd.DataFrame:
-    """Recebe os bytes do arquivo enviado e devolve um DataFrame."""
+    """Recebe os bytes do arquivo enviado e devolve um DataFrame.
+
+    Tudo é lido direto da memória (``io.BytesIO`` sobre os próprios bytes, sem
+    cópia), sem passar por arquivo temporário.
+    """
     nome = nome.lower()
-    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(nome)[1]) as tmp:
-        tmp.write(conteudo)
-        tmp_path = tmp.name
-    try:
-        if nome.endswith(".zip"):
-            with zipfile.ZipFile(tmp_path) as z:
-                validos = [f for f in z.namelist()
-                           if not f.startswith("__MACOSX/")
-                           and f.lower().endswith((".csv", ".xlsx", ".xls"))]
-                if not validos:
-                    raise ValueError("O ZIP não contém CSV ou Excel válidos.")
-                with tempfile.NamedTemporaryFile(delete=False,
-                                                 suffix=os.path.splitext(validos[0])[1]) as inner:
-                    inner.write(z.read(validos[0]))
-                    inner_path = inner.name
-                df = (_ler_csv(inner_path) if validos[0].lower().endswith(".csv")
-                      else pd.read_excel(inner_path, engine="openpyxl"))
-                os.remove(inner_path)
-        elif nome.endswith(".csv"):
-            df = _ler_csv(tmp_path)
-        else:
-            df = pd.read_excel(tmp_path, engine="openpyxl")
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
-    return df
+    if nome.endswith(".zip"):
+        with zipfile.ZipFile(io.BytesIO(conteudo)) as z:
+            validos = [f for f in z.namelist()
+                       if not f.startswith("__MACOSX/")
+                       and f.lower().endswith((".csv", ".xlsx", ".xls"))]
+            if not validos:
+                raise ValueError("O ZIP não contém CSV ou Excel válidos.")
+            return _ler_zip(z, validos)
+    if nome.endswith(".csv"):
+        return _ler_csv(conteudo)
+    return pd.read_excel(io.BytesIO(conteudo), engine="openpyxl")
 
 
 def montar_datahora(df: pd.DataFrame, col_data: str | None, col_hora: str | None):
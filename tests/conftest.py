@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Carrega "Data Sift.py" como módulo (o nome tem espaço) e dá um session_state fora do `streamlit run`."""
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def app():
+    spec = importlib.util.spec_from_file_location("datasift_app", os.path.join(ROOT, "Data Sift.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class _SessionState(dict):
+    __getattr__ = dict.get
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        del self[name]
+
+
+@pytest.fixture
+def session_state(app, monkeypatch):
+    """st.session_state só funciona dentro do `streamlit run`; nos testes é um dict com acesso por atributo."""
+    state = _SessionState()
+    monkeypatch.setattr(app.st, "session_state", state)
+    return state
+
+
+class _Progress:
+    def progress(self, *args, **kwargs):
+        pass
+
+    def empty(self):
+        pass
+
+
+@pytest.fixture
+def progress_bar():
+    return _Progress()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""AgeStatsCube: gather na ordem original das linhas e restrict() sobre o trecho ordenado, com memo limitado."""
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def rows():
+    rng = np.random.default_rng(22)
+    ages = rng.integers(0, 80, 5000).astype('float64')
+    ages[::7] += 0.5
+    values = np.round(rng.normal(10, 3, 5000), 1)
+    ages[::13], values[::17] = np.nan, np.nan
+    ages[::101] = -1
+    return ages, values
+
+
+def test_gather_returns_rows_in_original_order(app, rows):
+    ages, values = rows
+    cube = app.AgeStatsCube(ages, values)
+    cells = cube.cell_stats(cube.tukey_window())
+    pick = slice(3, 40)
+    ok = ~np.isnan(ages) & ~np.isnan(values) & (ages >= 0)
+    lo, hi = cells['age'][pick][[0, -1]]
+    window = cube.tukey_window()
+    expected = values[ok & (ages >= lo) & (ages <= hi) & (values >= window[0]) & (values <= window[1])]
+    np.testing.assert_array_equal(cube.gather(cells['a'][pick], cells['b'][pick]), expected)
+
+
+def test_restrict_matches_a_cube_built_on_the_range(app, rows):
+    ages, values = rows
+    cube = app.AgeStatsCube(ages, values, "k")
+    zoom = cube.restrict(18, 65.5)
+    m = (ages >= 18) & (ages <= 65.5)
+    fresh = app.AgeStatsCube(ages[m], values[m])
+    np.testing.assert_array_equal(zoom.ages, fresh.ages)
+    np.testing.assert_array_equal(zoom.values, fresh.values)
+    assert zoom.tukey_window() == fresh.tukey_window()
+    a, b = zoom.cell_stats(), fresh.cell_stats()
+    for k in a: np.testing.assert_allclose(a[k], b[k], rtol=0, atol=1e-9)
+    np.testing.assert_array_equal(zoom.gather(a['a'], a['b']), fresh.gather(b['a'], b['b']))
+    assert zoom.key == "k|18-65.5"
+
+
+def test_restrict_memo_is_bounded(app, rows):
+    cube = app.AgeStatsCube(*rows, "k")
+    first = cube.restrict(10, 20)
+    assert cube.restrict(10, 20) is first
+    for lo in range(11, 11 + cube.MAX_RESTRICTED): cube.restrict(lo, 30)
+    assert len(cube._restricted) == cube.MAX_RESTRICTED
+    assert cube.restrict(10, 20) is not first
+    assert cube.restrict(0, 1000) is cube
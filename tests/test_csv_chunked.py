@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""read_csv_chunked: mesmo resultado do read_csv inteiro, teto de linhas e orçamento de memória."""
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+N_ROWS = 20_000
+
+
+@pytest.fixture(scope="module")
+def csv_bytes():
+    rng = np.random.default_rng(18)
+    df = pd.DataFrame({'Nome': [f"P{i}" for i in range(N_ROWS)], 'Idade': rng.integers(0, 90, N_ROWS),
+                       'Resultado': np.round(rng.normal(10, 3, N_ROWS), 2)})
+    return df.to_csv(index=False, sep=';', decimal=',').encode('utf-8')
+
+
+@pytest.fixture(params=['pyarrow', 'c'])
+def dialect(request, app, csv_bytes):
+    d = app.sniff_csv_dialect(csv_bytes[:app.CSV_SAMPLE_BYTES])
+    assert (d['sep'], d['decimal']) == (';', ',')
+    d['engine'] = request.param
+    return d
+
+
+@pytest.fixture
+def small_chunks(app, monkeypatch):
+    monkeypatch.setattr(app, 'CSV_BLOCK_BYTES', 1 << 14)
+    monkeypatch.setattr(app, 'CSV_CHUNK_ROWS', 1000)
+
+
+class Progress:
+    def __init__(self): self.calls = []
+    def __call__(self, rows, bytes_read, total_bytes): self.calls.append((rows, bytes_read, total_bytes))
+
+
+def test_chunks_match_a_single_read(app, csv_bytes, dialect, small_chunks):
+    progress = Progress()
+    df = app.read_csv_chunked(memoryview(csv_bytes), dialect, on_progress=progress, budget_bytes=0)
+    pd.testing.assert_frame_equal(df, pd.read_csv(io.BytesIO(csv_bytes), sep=';', decimal=','))
+    assert len(progress.calls) > 2
+    assert [c[0] for c in progress.calls] == sorted(c[0] for c in progress.calls)
+    assert progress.calls[-1] == (N_ROWS, len(csv_bytes), len(csv_bytes))
+
+
+@pytest.mark.parametrize("max_rows", [1, 999, 1000, 12_345])
+def test_row_cap(app, csv_bytes, dialect, small_chunks, max_rows):
+    progress = Progress()
+    df = app.read_csv_chunked(memoryview(csv_bytes), dialect, on_progress=progress, max_rows=max_rows, budget_bytes=0)
+    pd.testing.assert_frame_equal(df, pd.read_csv(io.BytesIO(csv_bytes), sep=';', decimal=',', nrows=max_rows))
+    assert progress.calls[-1] == (max_rows, len(csv_bytes), len(csv_bytes))
+
+
+def test_budget_stops_after_the_first_chunk(app, csv_bytes, dialect, small_chunks):
+    progress = Progress()
+    with pytest.raises(app.MemoryBudgetExceeded) as exc:
+        app.read_csv_chunked(memoryview(csv_bytes), dialect, on_progress=progress, budget_bytes=200_000)
+    assert progress.calls == []
+    # A projeção vem do primeiro bloco, extrapolada para o arquivo todo.
+    full = pd.read_csv(io.BytesIO(csv_bytes), sep=';', decimal=',').memory_usage(index=False, deep=True).sum()
+    assert 0.5 * full < exc.value.projected_bytes < 2 * full
+
+
+def test_budget_projects_to_the_capped_row_count(app, csv_bytes, dialect, small_chunks):
+    capped = pd.read_csv(io.BytesIO(csv_bytes), sep=';', decimal=',', nrows=500).memory_usage(index=False, deep=True).sum()
+    df = app.read_csv_chunked(memoryview(csv_bytes), dialect, max_rows=500, budget_bytes=2 * capped)
+    assert len(df) == 500
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""Leitura de CSV latin-1 cujo primeiro byte fora do ASCII só aparece depois da amostra do sniff."""
+import pytest
+
+
+@pytest.fixture(scope="module")
+def latin1_csv(app):
+    rows = ["Nome;Idade;Resultado"]
+    size = len(rows[0])
+    while size <= app.CSV_SAMPLE_BYTES:
+        rows.append(f"PACIENTE{len(rows)};{len(rows) % 90};{len(rows) % 7},5")
+        size += len(rows[-1]) + 1
+    rows.append("JOSÉ;30;1,5")
+    return "\n".join(rows).encode("latin-1"), len(rows) - 1
+
+
+def _check(df, n_rows):
+    assert len(df) == n_rows
+    assert df["Nome"].iloc[0] == "PACIENTE1"
+    assert df["Nome"].iloc[-1] == "JOSÉ"
+
+
+def test_sniff_sees_only_ascii(app, latin1_csv):
+    data, _ = latin1_csv
+    assert app.sniff_csv_dialect(data[:app.CSV_SAMPLE_BYTES])["encoding"] == "utf-8"
+
+
+@pytest.mark.parametrize("block_bytes", [None, 1 << 16])
+def test_chunked_read_restarts_in_latin1(app, latin1_csv, monkeypatch, block_bytes):
+    data, n_rows = latin1_csv
+    if block_bytes: monkeypatch.setattr(app, "CSV_BLOCK_BYTES", block_bytes)
+    dialect = app.sniff_csv_dialect(data[:app.CSV_SAMPLE_BYTES])
+    _check(app.read_csv_chunked(memoryview(data), dialect, budget_bytes=0), n_rows)
+    assert dialect["encoding"] == app.FALLBACK_CSV_ENCODING
+
+
+@pytest.mark.parametrize("engine", ["pyarrow", "c"])
+def test_parse_csv_restarts_in_latin1(app, latin1_csv, engine):
+    data, n_rows = latin1_csv
+    _check(app._parse_csv(data, ";", ",", "utf-8", engine), n_rows)
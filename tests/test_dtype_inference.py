@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""infer_column_dtypes: vírgula decimal vira número, códigos com zero à esquerda continuam texto."""
+import numpy as np
+import pandas as pd
+
+
+def _frame(**cols):
+    return pd.DataFrame({k: pd.Series(v, dtype=object) for k, v in cols.items()})
+
+
+def test_decimal_comma_text_becomes_float(app):
+    df = app.infer_column_dtypes(_frame(Valor=['1,5', '2', None, ' 0,25 ', '-3,0']))
+    assert df['Valor'].dtype == np.float64
+    np.testing.assert_array_equal(df['Valor'].to_numpy(), [1.5, 2.0, np.nan, 0.25, -3.0])
+
+
+def test_zero_padded_codes_stay_text(app):
+    codes = ['00123', '00456', '1,5', '789']
+    df = app.infer_column_dtypes(_frame(Codigo=codes), text_col='Codigo')
+    assert df['Codigo'].dtype == object
+    assert df['Codigo'].tolist() == codes
+
+
+def test_integer_only_text_stays_text(app):
+    ids = [str(i) for i in range(100)]
+    df = app.infer_column_dtypes(_frame(Id=ids), text_col='Id')
+    assert df['Id'].tolist() == ids
+
+
+def test_partly_numeric_column_stays_text(app):
+    values = ['1,5', 'hemolisado', '2,0', '<0,5']
+    df = app.infer_column_dtypes(_frame(Resultado=values), text_col='Resultado')
+    assert df['Resultado'].tolist() == values
+
+
+def test_numeric_objects_and_categories(app):
+    df = app.infer_column_dtypes(_frame(
+        Idade=[30, 41.5, None, 7] * 10,
+        Sexo=['M', 'F', 'F', 'M'] * 10,
+        Texto=['a', 'b', 'a', 'b'] * 10,
+    ), text_col='Texto')
+    assert df['Idade'].dtype == np.float64
+    assert isinstance(df['Sexo'].dtype, pd.CategoricalDtype)
+    assert df['Texto'].dtype == object
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""read_excel_streaming deve dar o mesmo DataFrame que o pd.read_excel que ele substituiu."""
+import io
+import os
+
+import openpyxl
+import pandas as pd
+import pytest
+
+from conftest import ROOT
+
+WORKBOOK = os.path.join(ROOT, "Base de Dados.xlsx")
+
+
+@pytest.mark.parametrize("chunk_rows", [50_000, 37, 1])
+def test_bundled_workbook_matches_read_excel(app, chunk_rows):
+    pd.testing.assert_frame_equal(app.read_excel_streaming(WORKBOOK, chunk_rows=chunk_rows), pd.read_excel(WORKBOOK))
+
+
+def test_bundled_workbook_projection(app):
+    expected = pd.read_excel(WORKBOOK)
+    usecols = tuple(expected.columns[[0, 2, 5]])
+    pd.testing.assert_frame_equal(app.read_excel_streaming(WORKBOOK, usecols=usecols), expected[list(usecols)])
+
+
+def test_empty_cells_and_na_markers_are_missing(app):
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(["Codigo", "Valor", "Obs"])
+    ws.append(["A1", 1.5, "NA"])
+    ws.append(["N/A", "", "texto"])
+    ws.append(["NULL", 2.25, ""])
+    ws.append([None, None, None])
+    ws.append(["B2", 3, "#N/A"])
+    ws.append(["", "", ""])  # linhas vazias no fim são descartadas
+    buffer = io.BytesIO()
+    wb.save(buffer)
+
+    buffer.seek(0)
+    expected = pd.read_excel(buffer)
+    got = app.read_excel_streaming(io.BytesIO(buffer.getvalue()), chunk_rows=2)
+    pd.testing.assert_frame_equal(got, expected)
+    assert got["Valor"].dtype == "float64"
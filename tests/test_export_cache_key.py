@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""export_cache_key/filter_state_key: chaves baratas que mudam com o que muda a exportação, e o placar de acertos."""
+import pandas as pd
+import pytest
+
+from test_filter_attribution import GLOBAL_CONFIG, rule
+
+
+@pytest.fixture
+def frame():
+    return pd.DataFrame({'Idade': [30, 41, 7], 'Sexo': ['M', 'F', 'F'], 'Resultado': [1.5, 12.25, 3.0]})
+
+
+@pytest.fixture
+def session(app, frame):
+    s = app.DatasetSession(frame, 'export-key')
+    yield s
+    s.close()
+
+
+def test_key_tracks_upload_state_and_frame_layout(app, session, session_state, frame):
+    session_state.upload_hash = 'abc'
+    key = app.export_cache_key(session, 'state', frame)
+    assert app.export_cache_key(session, 'state', frame.copy()) == key
+    changed = [
+        app.export_cache_key(session, 'other state', frame),
+        app.export_cache_key(session, 'state', frame.iloc[:2]),
+        app.export_cache_key(session, 'state', frame[['Sexo', 'Idade', 'Resultado']]),
+        app.export_cache_key(session, 'state', frame.astype({'Idade': 'float64'})),
+        app.export_cache_key(None, 'state', frame),
+    ]
+    session_state.upload_hash = 'def'
+    changed.append(app.export_cache_key(session, 'state', frame))
+    assert len({key, *changed}) == len(changed) + 1
+
+
+def test_filter_state_key_ignores_widget_ids(app):
+    rules = [rule('Idade', '<', '18'), rule('Sexo', '=', 'F')]
+    key = app.filter_state_key(rules, GLOBAL_CONFIG)
+    assert app.filter_state_key([dict(r, id='x') for r in rules], GLOBAL_CONFIG) == key
+    assert app.filter_state_key(rules[::-1], GLOBAL_CONFIG) != key
+    assert app.filter_state_key([dict(rules[0], p_val1='19'), rules[1]], GLOBAL_CONFIG) != key
+    assert app.filter_state_key(rules, dict(GLOBAL_CONFIG, coluna_sexo=None)) != key
+
+
+def test_track_cache_counts_hits_and_misses(app, monkeypatch):
+    # Fora do `streamlit run` nem o st.cache_data nem o st.cache_resource guardam nada: um memo
+    # em dict faz o papel do cache, e o placar do servidor é fixado aqui.
+    stats = app.CacheStats()
+    monkeypatch.setattr(app, 'get_cache_stats', lambda: stats)
+    memo = {}
+    def cached(_df, cache_key):
+        if cache_key not in memo:
+            app.note_cache_miss()
+            memo[cache_key] = app.datasift_export.frame_to_csv_bytes(_df)
+        return memo[cache_key]
+    cached.clear = memo.clear
+    export = app.track_cache('export')(cached)
+    frame = pd.DataFrame({'x': [1.5]})
+    assert export(frame, 'a') == export(frame.copy(), 'a') == export(frame, 'a')
+    export(frame, 'b')
+    assert stats.counts['export'] == {'hits': 2, 'misses': 2}
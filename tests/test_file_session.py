@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""FileDatasetSession (modo out-of-core): caminhos com aspa e o CSV exportado no formato do export em memória."""
+import codecs
+import io
+import tempfile
+
+import pandas as pd
+import pytest
+
+
+class _Upload(io.BytesIO):
+    def __init__(self, data: bytes, name: str):
+        super().__init__(data)
+        self.name = name
+
+
+@pytest.fixture
+def quoted_tmp(tmp_path, monkeypatch):
+    d = tmp_path / "lab's exports"
+    d.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(d))
+    return d
+
+
+@pytest.fixture
+def frame():
+    return pd.DataFrame({'Idade': [30, 41, 7, 65], 'Sexo': ['M', 'F', 'F', 'M'],
+                         'Resultado': [1.5, 12.25, None, 3.0]})
+
+
+def _export(app, upload):
+    session = app.FileDatasetSession(upload, "test")
+    try:
+        n = session.copy_where(f"{session.quote('Sexo')} = ?", ['F'])
+        with open(session.output_path, 'rb') as f: data = f.read()
+    finally:
+        session.close()
+    return n, data
+
+
+def test_parquet_export_matches_in_memory_format(app, quoted_tmp, frame):
+    buf = io.BytesIO()
+    frame.to_parquet(buf, index=False)
+    n, data = _export(app, _Upload(buf.getvalue(), "base.parquet"))
+    assert n == 2
+    assert data.startswith(codecs.BOM_UTF8)
+    expected = frame[frame['Sexo'] == 'F'].reset_index(drop=True)
+    got = pd.read_csv(io.BytesIO(data), sep=';', decimal=',', encoding='utf-8-sig')
+    pd.testing.assert_frame_equal(got, expected)
+    in_memory = pd.read_csv(io.BytesIO(app.datasift_export.frame_to_csv_bytes(expected)), sep=';', decimal=',', encoding='utf-8-sig')
+    pd.testing.assert_frame_equal(got, in_memory)
+
+
+def test_csv_export_keeps_values_and_adds_bom(app, quoted_tmp):
+    text = "Idade;Sexo;Resultado\n30;M;1,5\n41;F;12,25\n7;F;\n".encode('latin-1')
+    n, data = _export(app, _Upload(text, "base.csv"))
+    assert n == 2
+    assert data.startswith(codecs.BOM_UTF8)
+    got = pd.read_csv(io.BytesIO(data), sep=';', decimal=',', encoding='utf-8-sig')
+    assert got['Resultado'].tolist()[0] == 12.25
+    assert got['Idade'].tolist() == [41, 7]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Tabela de exclusões por regra (DataProcessor._exclusion_attribution)."""
+import uuid
+
+import numpy as np
+import pandas as pd
+import pytest
+
+GLOBAL_CONFIG = {"coluna_idade": "Idade", "coluna_sexo": "Sexo"}
+
+
+def rule(col, op, val, **extra):
+    return {'id': str(uuid.uuid4()), 'p_check': True, 'p_col': col, 'p_op1': op, 'p_val1': val,
+            'p_expand': False, 'c_check': False, **extra}
+
+
+@pytest.fixture
+def session(app):
+    rng = np.random.default_rng(0)
+    n = 1003  # não múltiplo de 8: os bits de preenchimento do packbits entram na conta
+    df = pd.DataFrame({'Idade': rng.integers(0, 90, n), 'Sexo': rng.choice(['M', 'F'], n),
+                       'TXT': rng.choice(['abc', 'xyz'], n), 'Valor': rng.normal(10, 3, n)})
+    s = app.DatasetSession(df, 'attribution')
+    yield s
+    s.close()
+
+
+def attribution(app, session, rules, session_state, progress_bar):
+    kept = app.DataProcessor().apply_filters(session, rules, GLOBAL_CONFIG, progress_bar)
+    return kept, session_state.filter_attribution.set_index('Rule')
+
+
+def test_identical_rules_exclude_nothing_alone(app, session, session_state, progress_bar):
+    df = session.df
+    kept, table = attribution(app, session, [rule('TXT', '=', 'abc'), rule('TXT', '=', 'abc')], session_state, progress_bar)
+    n_abc = int((df['TXT'] == 'abc').sum())
+    rows = table.iloc[:2]
+    assert rows['Excluded (total)'].tolist() == [n_abc, n_abc]
+    assert rows['Excluded (only this rule)'].tolist() == [0, 0]
+    assert rows['Shared with other rules'].tolist() == [n_abc, n_abc]
+    assert table.loc['All active rules', 'Excluded (total)'] == n_abc
+    assert len(kept) == len(df) - n_abc
+
+
+def test_overlapping_rules(app, session, session_state, progress_bar):
+    df = session.df
+    rules = [rule('Valor', '>', '12'), rule('Idade', '<', '30'), rule('TXT', '=', 'xyz')]
+    kept, table = attribution(app, session, rules, session_state, progress_bar)
+    hits = np.vstack([df['Valor'] > 12, df['Idade'] < 30, df['TXT'] == 'xyz'])
+    only = hits & (hits.sum(axis=0) == 1)
+    assert table['Excluded (total)'].iloc[:3].tolist() == hits.sum(axis=1).tolist()
+    assert table['Excluded (only this rule)'].iloc[:3].tolist() == only.sum(axis=1).tolist()
+    assert table.loc['All active rules', 'Excluded (total)'] == int(hits.any(axis=0).sum())
+    assert kept.tolist() == np.flatnonzero(~hits.any(axis=0)).tolist()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""run_harris_boyd sobre o AgeStatsCube contra o cálculo direto (máscaras por corte, groupby por idade)."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from test_tukey import reference_tukey
+
+LIMITS = [{'sex': 'All', 'age_min': 0, 'age_max': 17, 'lri': 8.0, 'lrs': 12.0},
+          {'sex': 'All', 'age_min': 18, 'age_max': None, 'lri': 9.0, 'lrs': 14.0}]
+
+
+def reference_harris_boyd(app, ages, values, lista_limites=None, sexo="All"):
+    """O run_harris_boyd original, com o DataFrame já limpo (idade >= 0, valor numérico)."""
+    df = pd.DataFrame({'Age': ages, 'Data': values}).dropna()
+    df = df[df['Age'] >= 0]
+    kept, _ = reference_tukey(df['Data'].to_numpy())
+    df = df[(df['Data'] >= kept.min()) & (df['Data'] <= kept.max())]
+
+    def best_cut(sub):
+        if len(sub) < 60: return None
+        best, best_z = None, 0.0
+        for k in range(int(sub['Age'].min()), int(sub['Age'].max())):
+            g1, g2 = sub[sub['Age'] <= k]['Data'], sub[sub['Age'] > k]['Data']
+            if len(g1) < 30 or len(g2) < 30: continue
+            m1, m2 = float(np.mean(g1)), float(np.mean(g2))
+            v1, v2 = float(np.var(g1, ddof=1)), float(np.var(g2, ddof=1))
+            s1, s2 = np.sqrt(v1), np.sqrt(v2)
+            ratio = max(s1, s2) / min(s1, s2) if min(s1, s2) > 0 else 1.0
+            denom = np.sqrt(v1 / len(g1) + v2 / len(g2))
+            if denom == 0: continue
+            z = abs(m1 - m2) / denom
+            z_crit = 3 * np.sqrt(len(sub) / 120) if len(sub) < 120 else 3.0
+            if (ratio > 1.5 or z > z_crit) and z > best_z:
+                best_z = z
+                best = {'age': k, 'Age Cutoff': f"<= {k} vs > {k}", 'Z-score': round(z, 2), 'SD Ratio': round(ratio, 2),
+                        'Mean (<= Cutoff)': round(m1, 2), 'Mean (> Cutoff)': round(m2, 2)}
+        return best
+
+    def partition(sub, found, depth=0):
+        if depth >= 6: return
+        best = best_cut(sub)
+        if best is None: return
+        found.append(best)
+        partition(sub[sub['Age'] <= best['age']], found, depth + 1)
+        partition(sub[sub['Age'] > best['age']], found, depth + 1)
+
+    cuts = []
+    partition(df, cuts)
+    possible = pd.DataFrame(sorted(cuts, key=lambda c: c['age'])) if cuts else pd.DataFrame()
+
+    mean, sd = df['Data'].mean(), df['Data'].std(ddof=1)
+    margin = ((sd / mean) if mean > 0 else 0.10) * 0.5
+    groups = df.groupby('Age')['Data'].agg(['mean', 'count']).reset_index().to_dict('records')
+    clinical, ages_out, haeckel_used = [], [], False
+    bracket = [groups[0]['mean']]
+    for prev, cur in zip(groups, groups[1:]):
+        ref = np.mean(bracket)
+        pct = abs(cur['mean'] - ref) / ref if ref > 0 else 0
+        lim = app.encontrar_limites_casados(cur['Age'], sexo, lista_limites)
+        h = app.calcular_limites_haeckel(lim.get('lri'), lim.get('lrs')) if lim and lim.get('lrs') is not None and lim.get('lrs') > 0 else None
+        if h and ref > 0:
+            haeckel_used = True
+            pd_margin = 1.645 * (h['slope'] * ref + h['intercept'])
+            significant, shown = abs(cur['mean'] - ref) > pd_margin, round(pd_margin, 3)
+        else:
+            significant, shown = pct > margin, round(margin * 100, 2)
+        if significant and cur['count'] >= 5:
+            k = int(prev['Age'])
+            clinical.append({'age': k, 'Age Cutoff': f"<= {k} vs > {k}", 'Diff %': round(pct * 100, 2), 'Limit Threshold': shown,
+                             'Mean (<= Cutoff)': round(df[df['Age'] <= k]['Data'].mean(), 2),
+                             'Mean (> Cutoff)': round(df[df['Age'] > k]['Data'].mean(), 2)})
+            ages_out.append(k)
+            bracket = [cur['mean']]
+        else:
+            bracket.append(cur['mean'])
+    ideal = pd.DataFrame(clinical).sort_values(by='age') if clinical else pd.DataFrame()
+    return possible, ideal, ages_out, haeckel_used
+
+
+def dataset(seed, kind):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(300, 3000))
+    ages = rng.integers(0, 90, n).astype('float64')
+    if kind == 'fractional': ages += rng.choice([0, 0.5, 0.25], n)
+    values = 10 + 0.05 * ages + rng.normal(0, 1 + 0.02 * ages, n)
+    if kind == 'rounded': values = np.round(values)
+    if kind == 'constant': values = np.where(ages < 30, 5.0, values) + 1000
+    ages[rng.random(n) < 0.02] = np.nan
+    ages[rng.random(n) < 0.01] = -3
+    return ages, values
+
+
+@pytest.mark.parametrize("limits", [None, LIMITS], ids=['cv', 'haeckel'])
+@pytest.mark.parametrize("kind", ['integer', 'fractional', 'rounded', 'constant'])
+@pytest.mark.parametrize("seed", range(3))
+def test_cut_tables_match_direct_computation(app, seed, kind, limits):
+    ages, values = dataset(seed, kind)
+    got = app.run_harris_boyd(app.AgeStatsCube(ages, values), limits, 'All')
+    expected = reference_harris_boyd(app, ages, values, limits)
+    pd.testing.assert_frame_equal(got[0], expected[0])
+    pd.testing.assert_frame_equal(got[1].reset_index(drop=True), expected[1].reset_index(drop=True))
+    assert got[2:] == expected[2:]
+
+
+def test_no_rows_or_single_age(app):
+    empty = app.run_harris_boyd(app.AgeStatsCube(np.array([np.nan]), np.array([1.0])))
+    assert empty[0].empty and empty[1].empty and empty[2:] == ([], False)
+    babies = app.run_harris_boyd(app.AgeStatsCube(np.zeros(100), np.arange(100.0)))
+    assert babies[0].empty and babies[2] == []
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""parse_lab_values contra o clean_val por célula que ele substituiu."""
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def clean_val(x):
+    """O clean_val original (Series.apply por célula)."""
+    if pd.isna(x): return np.nan
+    x = str(x).replace(',', '.')
+    x = ''.join(c for c in x if c.isdigit() or c == '.' or c == '-')
+    try: return float(x)
+    except: return np.nan  # noqa: E722
+
+
+TEXT = ['12,5', '< 0,5', '12,3 mg/dL', '1.2.3', '--5', '-', '.', '5.', '-.5', ',75', '', '  7 ', 'hemolisado',
+        '1e5', '3-4', '٣,٥', '²', '12 345', 'NaN', 'inf', None, np.nan, '0,000', '-0', '+8', '9' * 20]
+
+
+def assert_same(got, expected):
+    np.testing.assert_array_equal(got.to_numpy(), expected.to_numpy().astype('float64'))
+    assert got.dtype == np.float64
+    assert got.index.equals(expected.index)
+
+
+@pytest.mark.parametrize("dtype", [object, 'string', 'category'])
+def test_text_matches_clean_val(app, dtype):
+    values = pd.Series(TEXT, index=range(100, 100 + len(TEXT))).astype(dtype)
+    assert_same(app.parse_lab_values(values), pd.Series(TEXT, index=values.index).apply(clean_val))
+
+
+def test_mixed_object_column_matches_clean_val(app):
+    values = pd.Series(['1,5', 2, 3.25, None, 'x', True, 5e-05], dtype=object)
+    assert_same(app.parse_lab_values(values), values.apply(clean_val))
+
+
+def test_random_text_matches_clean_val(app):
+    rng = np.random.default_rng(21)
+    alphabet = list('0123456789,.-+ <>abcé٣')
+    values = pd.Series([''.join(rng.choice(alphabet, rng.integers(0, 8))) for _ in range(5000)], dtype=object)
+    assert_same(app.parse_lab_values(values), values.apply(clean_val))
+
+
+def test_numeric_columns_pass_through_and_parsing_is_idempotent(app):
+    values = pd.Series([1.5, 5e-05, np.nan, np.inf, -2.0])
+    got = app.parse_lab_values(values)
+    np.testing.assert_array_equal(got.to_numpy(), [1.5, 5e-05, np.nan, np.nan, -2.0])
+    assert_same(app.parse_lab_values(got), got)
+    assert app.parse_lab_values(pd.Series([1, 2], dtype='Int64')).tolist() == [1.0, 2.0]
+    assert app.parse_lab_values(pd.Series([True, False])).isna().all()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Cache Parquet dos uploads já lidos: chave por conteúdo/coluna de dados/projeção e despejo LRU por mtime."""
+import hashlib
+import os
+
+import pandas as pd
+import pytest
+
+from test_file_session import _Upload
+
+CSV = "Idade;Sexo;Resultado\n30;M;1,5\n41;F;12,25\n7;F;3\n".encode('utf-8')
+
+
+@pytest.fixture
+def cache_dir(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'PARQUET_CACHE_DIR', str(tmp_path))
+    return tmp_path
+
+
+def entries(cache_dir):
+    return sorted(p.name for p in cache_dir.glob('*.parquet'))
+
+
+@pytest.fixture
+def no_parsing(app, monkeypatch):
+    def fail(*args, **kwargs): raise AssertionError("the upload was parsed again")
+    return lambda: monkeypatch.setattr(app, 'read_csv_sniffed', fail)
+
+
+def test_second_upload_of_same_content_is_a_hit(app, cache_dir, session_state, no_parsing):
+    first = app.load_dataframe(_Upload(CSV, "base.csv"))
+    assert len(entries(cache_dir)) == 1
+    no_parsing()
+    again = app.load_dataframe(_Upload(CSV, "renamed.CSV"))
+    pd.testing.assert_frame_equal(again, first)
+    assert again['Resultado'].tolist() == [1.5, 12.25, 3.0]
+
+
+def test_key_includes_data_column_projection_and_extension(app, cache_dir, session_state):
+    app.load_dataframe(_Upload(CSV, "base.csv"))
+    session_state.col_dados = 'Resultado'
+    app.load_dataframe(_Upload(CSV, "base.csv"))
+    app.load_dataframe(_Upload(CSV, "base.csv"), usecols=['Resultado', 'Idade'])
+    app.load_dataframe(_Upload(CSV, "base.csv"), usecols=['Idade', 'Resultado'])  # mesma projeção
+    assert len(entries(cache_dir)) == 3
+    content = app.upload_content_hash(_Upload(CSV, "x.csv"))
+    key = hashlib.sha1(f"{content}|.csv|Resultado|None|{app.MAX_ROWS}".encode('utf-8')).hexdigest()
+    assert f"{key}.parquet" in entries(cache_dir)
+
+
+def test_least_recently_used_entries_are_evicted_over_budget(app, cache_dir, session_state, monkeypatch):
+    frame = pd.DataFrame({'x': range(1000)})
+    app._store_cached_table('a', frame)
+    size_mb = os.path.getsize(cache_dir / 'a.parquet') / 2**20
+    monkeypatch.setattr(app, 'PARQUET_CACHE_BUDGET_MB', 2.5 * size_mb)
+    app._store_cached_table('b', frame)
+    os.utime(cache_dir / 'a.parquet', (1, 1))
+    os.utime(cache_dir / 'b.parquet', (2, 2))
+    assert app._read_cached_table('a') is not None  # leitura renova o mtime de 'a'
+    app._store_cached_table('c', frame)
+    assert entries(cache_dir) == ['a.parquet', 'c.parquet']
+
+
+def test_tables_pyarrow_cannot_write_are_not_cached(app, cache_dir):
+    app._store_cached_table('mixed', pd.DataFrame({'x': [1, 'a', 2.5]}))
+    assert entries(cache_dir) == []
+    assert list(cache_dir.iterdir()) == []
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Compilação das regras de filtro em Predicate: dobra de constantes, colunas ausentes e parâmetros (?)."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from test_filter_attribution import GLOBAL_CONFIG, rule
+
+
+@pytest.fixture
+def session(app):
+    df = pd.DataFrame({'Idade': [5, 17, 30, 45, 80, 62],
+                       'Sexo': ['M', 'F', 'F', 'M', 'F', 'M'],
+                       'Nome': ["O'Brien", 'ana', "x') OR TRUE --", ' Ana ', None, 'bob'],
+                       'Valor': ['1,5', '12,5', 'hemolisado', '30', '', '7']})
+    s = app.DatasetSession(df, 'predicate')
+    yield s
+    s.close()
+
+
+def test_constant_folding(app):
+    P = app.Predicate
+    leaf = P('num', 'x', '>', 1.0)
+    assert P.all_of([leaf, P.FALSE]) is P.FALSE
+    assert P.all_of([P.TRUE, leaf]) is leaf
+    assert P.all_of([]) is P.TRUE
+    assert P.any_of([P.FALSE, leaf]) is leaf
+    assert P.any_of([leaf, P.TRUE]) is P.TRUE
+    assert P.any_of([P.FALSE]) is P.FALSE
+    both = P.all_of([leaf, P('text', 'y', '=', 'a')])
+    assert both.kind == 'AND' and len(both.args) == 2
+
+
+def test_values_are_bound_as_parameters(app):
+    sql, params = app.Predicate.any_of([app.Predicate('text', '"Nome"', '=', "o'brien"),
+                                        app.Predicate('between', 'v', 10.0, 20.0)]).compile()
+    assert "o'brien" not in sql and sql.count('?') == 3
+    assert params == ["o'brien", 10.0, 20.0]
+
+
+def test_unknown_operator_and_non_numeric_column_fold_to_false(app, session):
+    dp = app.DataProcessor()
+    assert dp._build_single_cond('"Idade"', 'LIKE', '5') is app.Predicate.FALSE
+    assert dp._build_single_cond('"Sexo"', '>', '5', session.numeric_expr('Sexo')) is app.Predicate.FALSE
+
+
+def kept(app, session, rules, progress_bar):
+    return app.DataProcessor().apply_filters(session, rules, GLOBAL_CONFIG, progress_bar).tolist()
+
+
+def test_missing_column_excludes_nothing(app, session, session_state, progress_bar):
+    assert kept(app, session, [rule('Nope', '=', '1')], progress_bar) == list(range(6))
+    # Uma coluna ausente numa regra de várias colunas (';') derruba a regra inteira.
+    assert kept(app, session, [rule('Idade;Nope', '>', '10')], progress_bar) == list(range(6))
+
+
+def test_text_values_with_quotes_match_literally(app, session, session_state, progress_bar):
+    assert kept(app, session, [rule('Nome', '=', "o'brien")], progress_bar) == [1, 2, 3, 4, 5]
+    assert kept(app, session, [rule('Nome', '=', "x') OR TRUE --")], progress_bar) == [0, 1, 3, 4, 5]
+    # Comparação de texto ignora caixa e espaços nas pontas; célula vazia não casa com a regra.
+    assert kept(app, session, [rule('Nome', 'Is not equal to', 'ANA')], progress_bar) == [1, 3, 4]
+
+
+def test_decimal_comma_and_between(app, session, session_state, progress_bar):
+    assert kept(app, session, [rule('Valor', '>', '10,0')], progress_bar) == [0, 2, 4, 5]
+    # Limites fora de ordem são ordenados: exclui 10 <= Idade <= 40.
+    between = rule('Idade', '≥', '40', p_expand=True, p_op_central='BETWEEN', p_op2='≤', p_val2='10')
+    assert kept(app, session, [between], progress_bar) == [0, 3, 4, 5]
+
+
+def test_plan_is_compiled_once(app, session, session_state, progress_bar):
+    dp = app.DataProcessor()
+    rules = [rule('Idade', '<', '18'), rule('Sexo', '=', 'f')]
+    first = dp.apply_filters(session, rules, GLOBAL_CONFIG, progress_bar)
+    # Outro id, mesma definição: mesmo plano.
+    again = dp.apply_filters(session, [dict(r, id='other') for r in rules], GLOBAL_CONFIG, progress_bar)
+    assert len(dp._plans) == 1
+    np.testing.assert_array_equal(first, again)
+    assert first.tolist() == [3, 5]
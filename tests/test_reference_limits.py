@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""ReferenceLimitIndex contra encontrar_limites_casados chamado idade a idade."""
+import numpy as np
+import pytest
+
+
+def random_matrix(rng):
+    limits = []
+    for j in range(int(rng.integers(0, 6))):
+        limits.append({'id': str(j), 'sex': str(rng.choice(['All', 'M', 'F', '', 'Todos'])),
+                       'age_min': None if rng.random() < .3 else int(rng.integers(0, 60)),
+                       'age_max': None if rng.random() < .3 else int(rng.integers(0, 99)),
+                       'lri': None if rng.random() < .3 else float(rng.uniform(0, 10)),
+                       'lrs': None if rng.random() < .2 else float(rng.uniform(1, 20))})
+    return limits
+
+
+def direct_haeckel(app, age, sex, limits):
+    lim = app.encontrar_limites_casados(age, sex, limits)
+    return app.calcular_limites_haeckel(lim.get('lri'), lim.get('lrs')) if lim and lim.get('lrs') is not None and lim.get('lrs') > 0 else None
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_matches_per_age_lookup(app, seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(50):
+        limits, sex = random_matrix(rng), str(rng.choice(['M', 'F', 'All']))
+        ages = np.unique(np.concatenate([rng.integers(-5, 110, 60).astype(float), rng.uniform(0, 100, 20),
+                                         [0, 9999, 10000, 59, 60]]))
+        index = app.ReferenceLimitIndex(limits, sex)
+        for age, region, haeckel in zip(ages, index.regions(ages), index.haeckel_for(ages)):
+            assert index.limits[region] is app.encontrar_limites_casados(age, sex, limits)
+            assert haeckel == direct_haeckel(app, age, sex, limits)
+
+
+def test_break_points_are_their_own_region(app):
+    limits = [{'sex': 'All', 'age_min': 0, 'age_max': 17, 'lri': 8.0, 'lrs': 12.0},
+              {'sex': 'M', 'age_min': 18, 'age_max': None, 'lri': 9.0, 'lrs': 14.0},
+              {'sex': 'F', 'age_min': 18, 'age_max': 60, 'lri': 7.0, 'lrs': 13.0}]
+    index = app.ReferenceLimitIndex(limits, 'F')
+    ages = np.array([-1, 0, 17, 17.5, 18, 60, 60.5, 9999, 12000])
+    # Fora das faixas vale o limite do próprio sexo; 17,5 cai no buraco entre duas faixas e, sem
+    # limite global, fica sem limite, como no matcher original.
+    lrs = [index.limits[r]['lrs'] if index.limits[r] else None for r in index.regions(ages)]
+    assert lrs == [13.0, 12.0, 12.0, None, 13.0, 13.0, 13.0, 13.0, 13.0]
+    for age, limit in zip(ages, (index.limits[r] for r in index.regions(ages))):
+        assert limit is app.encontrar_limites_casados(age, 'F', limits)
+
+
+def test_empty_matrix(app):
+    index = app.ReferenceLimitIndex([], 'M')
+    assert index.haeckel_for(np.array([1.0, 50.0])) == [None, None]
+    assert app.reference_limit_index([], 'M').haeckel_for(np.array([3.0])) == [None]
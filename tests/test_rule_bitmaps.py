@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Bitmaps de exclusão por regra: chave da regra, reaproveitamento entre cliques e despejo LRU."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from test_filter_attribution import GLOBAL_CONFIG, rule
+
+
+@pytest.fixture
+def session(app):
+    rng = np.random.default_rng(4)
+    n = 501
+    df = pd.DataFrame({'Idade': rng.integers(0, 90, n), 'Sexo': rng.choice(['M', 'F'], n), 'Valor': rng.normal(10, 3, n)})
+    s = app.DatasetSession(df, 'bitmaps')
+    yield s
+    s.close()
+
+
+def run(app, session, rules, progress_bar):
+    return app.DataProcessor().apply_filters(session, rules, GLOBAL_CONFIG, progress_bar)
+
+
+def test_rule_key_ignores_ui_id_but_not_definition_or_context(app, session):
+    r = rule('Idade', '<', '18')
+    key = session.rule_key(r, GLOBAL_CONFIG)
+    assert session.rule_key(dict(r, id='other'), GLOBAL_CONFIG) == key
+    assert session.rule_key(dict(r, p_val1='19'), GLOBAL_CONFIG) != key
+    assert session.rule_key(r, dict(GLOBAL_CONFIG, coluna_idade='Valor')) != key
+    other = app.DatasetSession(session.df, 'another upload')
+    try: assert other.rule_key(r, GLOBAL_CONFIG) != key
+    finally: other.close()
+
+
+def test_only_changed_rules_are_recomputed(app, session, session_state, progress_bar):
+    df = session.df
+    age, value = rule('Idade', '<', '18'), rule('Valor', '>', '12')
+    run(app, session, [age, value], progress_bar)
+    age_key, value_key = (session.rule_key(r, GLOBAL_CONFIG) for r in (age, value))
+    cached = session._bitmaps[age_key]
+
+    edited = dict(value, p_val1='14')
+    assert not session.has_exclusion_bitmap(session.rule_key(edited, GLOBAL_CONFIG))
+    kept = run(app, session, [age, edited], progress_bar)
+    assert session._bitmaps[age_key] is cached
+    assert session.has_exclusion_bitmap(session.rule_key(edited, GLOBAL_CONFIG))
+    assert session.has_exclusion_bitmap(value_key)  # continua em cache para quando a regra voltar
+    assert kept.tolist() == np.flatnonzero(~((df['Idade'] < 18) | (df['Valor'] > 14))).tolist()
+
+    # Desligar uma regra só recombina os bitmaps que ficaram.
+    kept = run(app, session, [age, dict(edited, p_check=False)], progress_bar)
+    assert kept.tolist() == np.flatnonzero(~(df['Idade'] < 18)).tolist()
+
+
+def test_bitmaps_are_evicted_least_recently_used(app, session, session_state, progress_bar, monkeypatch):
+    monkeypatch.setattr(session, 'MAX_CACHED_BITMAPS', 2)
+    a, b, c = (rule('Idade', '<', str(v)) for v in (10, 20, 30))
+    run(app, session, [a], progress_bar)
+    run(app, session, [b], progress_bar)
+    run(app, session, [a], progress_bar)  # 'a' volta a ser o mais recente
+    run(app, session, [c], progress_bar)
+    keys = [session.rule_key(r, GLOBAL_CONFIG) for r in (a, b, c)]
+    assert [session.has_exclusion_bitmap(k) for k in keys] == [True, False, True]
+
+
+def test_bitmap_is_packed_and_padding_is_clear(app, session, session_state, progress_bar):
+    r = rule('Idade', '≥', '0')
+    run(app, session, [r], progress_bar)
+    bitmap = session._bitmaps[session.rule_key(r, GLOBAL_CONFIG)]
+    assert bitmap.dtype == np.uint8 and len(bitmap) == (session.n_rows + 7) // 8
+    assert np.unpackbits(bitmap).sum() == session.n_rows
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Estratos como posições int32; StrataExport serializa cada estrato sob demanda, uma vez só."""
+import io
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from test_stratification import AGES, SEXES, session, stratify  # noqa: F401
+
+
+@pytest.fixture
+def serial(app, monkeypatch):
+    monkeypatch.setattr(app.os, 'cpu_count', lambda: 1)
+
+
+@pytest.fixture
+def export(app):
+    e = app.StrataExport('csv')
+    yield e
+    e.close()
+
+
+def read(data):
+    return pd.read_csv(io.BytesIO(data), sep=';', decimal=',', encoding='utf-8-sig')
+
+
+def test_strata_are_int32_positions(app, session, session_state, progress_bar):
+    strata = stratify(app, session, {'ages': AGES, 'sexes': SEXES}, progress_bar)
+    assert all(rows.dtype == np.int32 for rows in strata.values())
+
+
+def test_serialize_on_demand(app, session, session_state, progress_bar, serial, export):
+    strata = stratify(app, session, {'ages': AGES, 'sexes': SEXES}, progress_bar)
+    first = next(iter(strata))
+    assert export.path(first) is None
+    export.serialize(session, strata, [first])
+    assert [name for name in strata if export.path(name)] == [first]
+    with open(export.path(first), 'rb') as f:
+        expected = app.datasift_export.frame_to_csv_bytes(session.df.take(strata[first]))
+        assert f.read() == expected
+
+
+def test_zip_reuses_serialized_strata(app, session, session_state, progress_bar, serial, export):
+    strata = stratify(app, session, {'ages': AGES, 'sexes': SEXES}, progress_bar)
+    first = next(iter(strata))
+    export.serialize(session, strata, [first])
+    path = export.path(first)
+    zip_path = export.build_zip(session, strata)
+    assert export.path(first) == path
+    with zipfile.ZipFile(zip_path) as zf:
+        assert zf.namelist() == [f"{name}.csv" for name in strata]
+        for name, rows in strata.items():
+            pd.testing.assert_frame_equal(read(zf.read(f"{name}.csv")), read(app.datasift_export.frame_to_csv_bytes(session.df.take(rows))))
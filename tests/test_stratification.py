@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""apply_stratification: uma varredura para todos os estratos, inclusive com faixas de idade sobrepostas."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from test_filter_attribution import GLOBAL_CONFIG
+
+
+@pytest.fixture
+def session(app):
+    rng = np.random.default_rng(8)
+    n = 777
+    ages = rng.integers(0, 90, n).astype(object)
+    ages[::50] = None
+    ages[::61] = 'n/d'
+    df = pd.DataFrame({'Idade': ages, 'Sexo': rng.choice(['M', 'F', 'f'], n), 'Valor': rng.normal(10, 3, n)})
+    s = app.DatasetSession(df, 'strata')
+    yield s
+    s.close()
+
+
+AGES = [{'op1': '≥', 'val1': '0', 'op2': '≤', 'val2': '18'},
+        {'op1': '≥', 'val1': '10', 'op2': '<', 'val2': '40'},
+        {'op1': '>', 'val1': '30'}]
+SEXES = [{'value': 'M'}, {'value': 'F'}]
+
+
+def expected_rows(df, age_rule, sex_value, rows=None):
+    age = pd.to_numeric(df['Idade'], errors='coerce')
+    ops = {'≥': age.ge, '≤': age.le, '<': age.lt, '>': age.gt}
+    mask = pd.Series(True, index=df.index)
+    for op, val in ((age_rule.get('op1'), age_rule.get('val1')), (age_rule.get('op2'), age_rule.get('val2'))):
+        if op: mask &= ops[op](float(val))
+    if sex_value: mask &= df['Sexo'].str.lower() == sex_value.lower()
+    if rows is not None: mask &= df.index.isin(rows)
+    return np.flatnonzero(mask.to_numpy())
+
+
+def stratify(app, session, config, progress_bar, rows=None):
+    return app.DataProcessor().apply_stratification(session, config, GLOBAL_CONFIG, progress_bar, rows)
+
+
+def test_overlapping_age_rules_put_rows_in_every_matching_stratum(app, session, session_state, progress_bar):
+    strata = stratify(app, session, {'ages': AGES, 'sexes': SEXES}, progress_bar)
+    assert list(strata) == ['0_to_18_years_M', '10_to_39_years_M', 'Over_30_years_M',
+                            '0_to_18_years_F', '10_to_39_years_F', 'Over_30_years_F']
+    for (sex, age_rule), rows in zip([(s['value'], a) for s in SEXES for a in AGES], strata.values()):
+        np.testing.assert_array_equal(rows, expected_rows(session.df, age_rule, sex))
+    overlap = np.intersect1d(strata['0_to_18_years_F'], strata['10_to_39_years_F'])
+    assert len(overlap) and (pd.to_numeric(session.df['Idade'].iloc[overlap]).between(10, 18)).all()
+
+
+def test_age_only_and_restricted_rows(app, session, session_state, progress_bar):
+    source = np.arange(0, session.n_rows, 3)
+    strata = stratify(app, session, {'ages': AGES[:2], 'sexes': []}, progress_bar, rows=source)
+    assert list(strata) == ['0_to_18_years', '10_to_39_years']
+    for rows, age_rule in zip(strata.values(), AGES[:2]):
+        np.testing.assert_array_equal(rows, expected_rows(session.df, age_rule, None, source))
+
+
+def test_unmapped_column_reports_an_error(app, session, session_state, progress_bar):
+    strata = app.DataProcessor().apply_stratification(session, {'ages': AGES, 'sexes': []}, {'coluna_idade': 'Nope'}, progress_bar)
+    assert strata == {}
+    assert "Nope" in session_state.stratification_error
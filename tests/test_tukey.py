@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""tukey_trim_sorted e a janela do AgeStatsCube contra o laço original de cercas de Tukey (quantis do pandas)."""
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def reference_tukey(values, iterations=5, multiplier=2.0):
+    """O remove_outliers_tukey original, sobre uma Series."""
+    s = pd.Series(values)
+    removed = []
+    for _ in range(iterations):
+        if s.empty: break
+        q1, q3 = s.quantile(0.25), s.quantile(0.75)
+        iqr = q3 - q1
+        mask = (s >= q1 - multiplier * iqr) & (s <= q3 + multiplier * iqr)
+        if mask.all(): break
+        removed.append(int((~mask).sum()))
+        s = s[mask]
+    return s.to_numpy(), removed
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_trim_sorted_matches_iterated_fences(app, seed):
+    rng = np.random.default_rng(seed)
+    values = np.round(np.concatenate([rng.lognormal(2, 0.6, 400), rng.uniform(0, 500, seed)]), 1)
+    kept, removed = reference_tukey(values)
+    s = np.sort(values)
+    lo, hi, got_removed = app.tukey_trim_sorted(s)
+    np.testing.assert_array_equal(s[lo:hi], np.sort(kept))
+    assert got_removed == removed
+
+
+def test_cube_window_matches_iterated_fences(app):
+    rng = np.random.default_rng(7)
+    values = np.append(rng.normal(5, 1, 300), [40.0, 41.0, -30.0])
+    cube = app.AgeStatsCube(rng.integers(0, 90, len(values)).astype('float64'), values)
+    kept, removed = reference_tukey(values)
+    assert cube.tukey_window() == (kept.min(), kept.max())
+    assert cube.tukey_removed() == removed
+
+
+def test_constant_values_are_kept(app):
+    s = np.full(50, 3.0)
+    assert app.tukey_trim_sorted(s) == (0, 50, [])